@@ -0,0 +1,124 @@
+"""
+Benchmark: a client that stops reading, in a busy lobby.
+50 rooms send a 0x4306 room update every tick (a match clock),
+plus some chat. Shows the memory held for that client (transport
+buffer + outbound queue), and what it gets once it reads again:
+only the latest info of every room, with valid packet counts.
+
+Usage: PYTHONPATH=lib python3 bench/backpressure_bench.py [ticks]
+"""
+
+import struct
+import sys
+
+from fiveserver.protocol import PacketReceiver
+from fiveserver import outbound, stream
+
+
+NUM_ROOMS = 50
+ROOM_INFO_SIZE = 255
+BUFFER_SIZE = 64 * 1024  # twisted's FileDescriptor.bufferSize
+
+
+class Factory:
+
+    serverConfig = type('ServerConfig', (), {'Debug': False})
+
+
+class StalledTransport:
+    """
+    Buffers writes like a twisted transport whose
+    peer does not read, pausing its producer when full
+    """
+
+    def __init__(self):
+        self.buffered = []
+        self.bufferedBytes = 0
+        self.producer = None
+        self.aborted = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def write(self, data):
+        self.buffered.append(data)
+        self.bufferedBytes += len(data)
+        if self.bufferedBytes > BUFFER_SIZE:
+            self.producer.pauseProducing()
+
+    def abortConnection(self):
+        self.aborted = True
+
+    def getPeer(self):
+        return 'stalled client'
+
+    def drain(self):
+        """
+        The peer reads everything
+        """
+        data = b''.join(self.buffered)
+        self.buffered, self.bufferedBytes = [], 0
+        self.producer.resumeProducing()
+        return data
+
+
+class LobbyClient(PacketReceiver):
+
+    SUPERSEDED_UPDATES = frozenset([0x4306])
+
+
+def roomInfo(roomId, clock):
+    return struct.pack('!iB', roomId, clock) + b'\0' * (ROOM_INFO_SIZE - 5)
+
+
+def main():
+    try: ticks = int(sys.argv[1])
+    except IndexError: ticks = 1000
+
+    client = LobbyClient()
+    client.factory = Factory()
+    client.transport = StalledTransport()
+    client.connectionMade()
+
+    sent = 0
+    for tick in range(ticks):
+        for roomId in range(1, NUM_ROOMS + 1):
+            frame = stream.BroadcastFrame(0x4306, roomInfo(roomId, tick % 256))
+            client.sendBroadcast(frame)
+            sent += len(frame.data) + 24
+        client.sendData(0x4402, b'chat %d' % tick)
+        sent += 24 + len(b'chat %d' % tick)
+
+    stats = outbound.getStats()
+    print('%d ticks, %d room updates + %d chat lines: %d bytes sent' % (
+        ticks, ticks * NUM_ROOMS, ticks, sent))
+    print('held for the client: %d bytes in transport buffer, '
+          '%d bytes / %d packets queued' % (
+        client.transport.bufferedBytes, stats['bytes'], stats['packets']))
+    print('superseded updates: %d, disconnected: %s' % (
+        stats['superseded'], client.transport.aborted))
+
+    if client.transport.aborted:
+        return 0
+
+    # client reads again: everything that is left arrives in order
+    data = b''
+    while client.transport.bufferedBytes:
+        data += client.transport.drain()
+    packets = list(stream.PacketFramer().feed(data))
+    counts = [pkt.header.packet_count for pkt in packets]
+    assert counts == list(range(1, len(packets) + 1))
+    latest = dict()
+    for pkt in packets:
+        if pkt.header.id == 0x4306:
+            roomId, clock = struct.unpack('!iB', pkt.data[:5])
+            latest[roomId] = clock
+    assert latest == dict(
+        (roomId, (ticks - 1) % 256) for roomId in range(1, NUM_ROOMS + 1))
+    print('received after reading again: %d packets, %d bytes' % (
+        len(packets), len(data)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
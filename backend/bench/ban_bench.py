@@ -0,0 +1,111 @@
+"""
+Benchmark: FiveServerConfig.isBanned with a banned list of thousands
+of networks, as compiled by makeFastBannedList into a BanIndex,
+against the previous linear scan over (net, mask) pairs. Lookups are
+of distinct addresses (no LRU cache hits), then of a small set of
+returning addresses (as in a reconnect storm).
+
+Usage: PYTHONPATH=lib python3 bench/ban_bench.py [entries] [lookups]
+"""
+
+import random
+import socket
+import struct
+import sys
+import time
+
+from fiveserver.config import FiveServerConfig
+
+
+class BannedList:
+
+    def __init__(self, entries):
+        self.Banned = entries
+
+
+def makeEntries(count, rng):
+    entries = []
+    for i in range(count):
+        quads = [rng.randrange(1, 224) for q in range(4)]
+        kind = rng.randrange(3)
+        if kind == 0:
+            entries.append('%d.%d.%d.%d' % tuple(quads))
+        elif kind == 1:
+            entries.append('%d.%d.%d' % tuple(quads[:3]))
+        else:
+            entries.append('%d.%d.%d.0/%d' % (
+                tuple(quads[:3]) + (rng.randrange(12, 30),)))
+    return entries
+
+
+def scanIsBanned(fastBannedList, ipAddress):
+    for net, mask in fastBannedList:
+        ip = struct.unpack('!I',socket.inet_aton(ipAddress))[0]
+        if (net & mask) == (ip & mask):
+            return True
+    return False
+
+
+def makeScanList(entries):
+    """
+    (net, mask) pairs, as the previous makeFastBannedList
+    built them (valid IPv4 entries only)
+    """
+    scanList = []
+    for spec in entries:
+        parts = spec.split('/')
+        quads = [0,0,0,0]
+        for i, quad in enumerate(parts[0].split('.')):
+            if quad != '':
+                quads[i] = int(quad)
+        if len(parts) == 2:
+            bits = int(parts[1])
+        else:
+            bits = sum([8 for quad in quads if quad!=0])
+        net = struct.unpack('!I', bytes(quads))[0]
+        scanList.append((net, (2**bits-1)<<(32-bits)))
+    return scanList
+
+
+def timeIt(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    try: numEntries = int(sys.argv[1])
+    except IndexError: numEntries = 5000
+    try: numLookups = int(sys.argv[2])
+    except IndexError: numLookups = 20000
+
+    rng = random.Random(1)
+    config = FiveServerConfig.__new__(FiveServerConfig)
+    config.bannedList = BannedList(makeEntries(numEntries, rng))
+    config.makeFastBannedList()
+    scanList = makeScanList(config.bannedList.Banned)
+
+    distinct = ['%d.%d.%d.%d' % tuple(rng.randrange(256) for q in range(4))
+                for i in range(numLookups)]
+    returning = [rng.choice(distinct[:200]) for i in range(numLookups)]
+    for ip in distinct[:2000]:
+        assert config.isBanned(ip) == scanIsBanned(scanList, ip)
+        assert config.isBanned('::ffff:' + ip) == config.isBanned(ip)
+    banned = sum(1 for ip in distinct if config.isBanned(ip))
+
+    print('%d entries -> %d ranges; %d of %d random addresses banned' % (
+        numEntries, len(config.bannedIndex), banned, len(distinct)))
+    scanKeys = distinct[:max(1, numLookups // 50)]
+    print('linear scan               %10.2f us per lookup' % timeIt(
+        lambda ip: scanIsBanned(scanList, ip), scanKeys))
+    config.makeFastBannedList()
+    print('index, distinct addresses %10.2f us per lookup' % timeIt(
+        config.isBanned, distinct))
+    print('index, returning clients  %10.2f us per lookup' % timeIt(
+        config.isBanned, returning))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
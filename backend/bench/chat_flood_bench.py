@@ -0,0 +1,120 @@
+"""
+Benchmark: one client spamming lobby chat (100 messages per second
+for 10 seconds, on a simulated clock) into a lobby of 200 players,
+with no flood control and with the default Chat.floodControl limits.
+Every message that gets through is sent to the whole lobby, so the
+packets written (and the CPU spent writing them) follow the policy
+rather than the client.
+
+Usage: PYTHONPATH=lib python3 bench/chat_flood_bench.py [players]
+"""
+
+import sys
+import time
+
+from fiveserver import floodcontrol
+from fiveserver.config import FiveServerConfig, YamlConfig
+from fiveserver.model import lobby, user
+from fiveserver.protocol import PacketReceiver, pes6
+
+from cork_bench import CountingTransport
+from chat_history_bench import makeProfile
+
+
+MESSAGES = 1000
+INTERVAL = 0.01  # seconds between spam messages
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Factory:
+
+    def __init__(self, configuration, aLobby):
+        self.configuration = configuration
+        self.serverConfig = configuration.serverConfig
+        self.aLobby = aLobby
+
+    def getLobbies(self):
+        return [self.aLobby]
+
+
+class ChatPacket:
+
+    def __init__(self, text):
+        self.data = b'\0\1\0\0\0\0\0\0\0\0' + text + b'\0'
+
+
+def makeConfiguration(floodControl):
+    configuration = FiveServerConfig.__new__(FiveServerConfig)
+    configuration.serverConfig = YamlConfig(None, newYamlFile='bench.yaml')
+    configuration.serverConfig.Debug = False
+    configuration.serverConfig.Chat = dict(
+        bannedWords=[], warningMessage='removed',
+        floodControl=floodControl)
+    configuration.makeChatFilter()
+    configuration.makeChatFloodPolicy()
+    return configuration
+
+
+def makeLobby(numPlayers, configuration):
+    aLobby = lobby.Lobby('Bench', numPlayers)
+    factory = Factory(configuration, aLobby)
+    services = []
+    for i in range(numPlayers):
+        service = pes6.MainService()
+        service.factory = factory
+        service.transport = CountingTransport()
+        # only the connection set-up: no ban/capacity checks
+        PacketReceiver.connectionMade(service)
+        service._chatBuckets = dict()
+        usr = user.User('hash%d' % i)
+        usr.profile = makeProfile(i)
+        service._user = usr
+        usr.state = user.UserState()
+        usr.state.lobbyId = 0
+        aLobby.enter(usr, service)
+        services.append(service)
+    return aLobby, services
+
+
+def spam(numPlayers, floodControl):
+    configuration = makeConfiguration(floodControl)
+    clock = configuration.chatFloodPolicy.clock = Clock()
+    aLobby, services = makeLobby(numPlayers, configuration)
+    spammer = services[0]
+    before = floodcontrol.getStats()
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        spammer.chat_4400(ChatPacket(b'spam message number %d' % i))
+        clock.now += INTERVAL
+    elapsed = time.perf_counter() - start
+    stats = floodcontrol.getStats()
+    return (stats['dropped'] - before['dropped'],
+            sum(service.transport.writes for service in services),
+            elapsed)
+
+
+def main():
+    try: numPlayers = int(sys.argv[1])
+    except IndexError: numPlayers = 200
+
+    print('%d messages in %0.0f s into a lobby of %d players' % (
+        MESSAGES, MESSAGES * INTERVAL, numPlayers))
+    for label, floodControl in [
+            ('no flood control', False),
+            ('default limits', None)]:
+        dropped, writes, elapsed = spam(numPlayers, floodControl)
+        print('%-18s %5d messages dropped, %7d packets, %8.1f ms' % (
+            label, dropped, writes, elapsed * 1e3))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Benchmark: replaying a full lobby chat history (50 messages) to
+a player entering the lobby. Previously every message was encoded
+again for every player, and sent as a packet of its own; now the
+history keeps one pre-encoded 0x4402 frame per message, and the
+replay is a single write.
+
+Usage: PYTHONPATH=lib python3 bench/chat_history_bench.py [iterations]
+"""
+
+import struct
+import sys
+import time
+
+from fiveserver.model import lobby, user, util
+from fiveserver.protocol import PacketReceiver, pes6
+
+from cork_bench import Factory, CountingTransport
+
+
+def oldSendChatHistory(service, aLobby, who):
+    for chatMessage in list(aLobby.chatHistory):
+        chatType = b'\0\1'
+        if chatMessage.toProfile is not None:
+            if who.profile.id not in [
+                chatMessage.fromProfile.id, chatMessage.toProfile.id]:
+                continue
+            special = chatMessage.special
+        else:
+            special = b'\0\0\0\0'
+        data = b'%s%s%s%s%s' % (
+                chatType,
+                special,
+                struct.pack('!i', chatMessage.fromProfile.id),
+                util.padWithZeros(chatMessage.fromProfile.name,48),
+                chatMessage.text.encode('utf-8')[:126]+b'\0\0')
+        who.sendData(0x4402, data)
+
+
+def makeProfile(i):
+    profile = user.Profile(0)
+    profile.id = 1000 + i
+    profile.name = 'player%d' % i
+    return profile
+
+
+def makeLobby():
+    aLobby = lobby.Lobby('Bench', 100)
+    for i in range(lobby.MAX_MESSAGES):
+        if i % 10 == 9:
+            message = lobby.ChatMessage(makeProfile(i),
+                'private message number %d' % i, makeProfile(0), b'\0\0\0\1')
+        else:
+            message = lobby.ChatMessage(makeProfile(i),
+                'hello everybody, this is lobby chat line %d' % i)
+        aLobby.addToChatHistory(message)
+    return aLobby
+
+
+def makeService():
+    service = pes6.MainService()
+    service.factory = Factory()
+    service.transport = CountingTransport()
+    # only the connection set-up: no ban/capacity checks
+    PacketReceiver.connectionMade(service)
+    usr = user.User('hash0')
+    usr.profile = makeProfile(0)
+    usr.lobbyConnection = service
+    return service, usr
+
+
+def main():
+    try: iterations = int(sys.argv[1])
+    except IndexError: iterations = 2000
+
+    aLobby = makeLobby()
+    old, oldUser = makeService()
+    new, newUser = makeService()
+    oldSendChatHistory(old, aLobby, oldUser)
+    new.sendChatHistory(aLobby, newUser)
+    assert b''.join(old.transport.chunks) == b''.join(new.transport.chunks)
+
+    for label, service, who, func in [
+            ('encoded every time', old, oldUser, oldSendChatHistory),
+            ('pre-encoded', new, newUser, pes6.MainService.sendChatHistory)]:
+        service.transport.reset()
+        start = time.perf_counter()
+        for i in range(iterations):
+            func(service, aLobby, who)
+        elapsed = (time.perf_counter() - start) / iterations
+        print('%-20s %8.1f us per replay, %3d writes' % (
+            label, elapsed * 1e6, service.transport.writes // iterations))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Benchmark: a list response (start marker, 50 records, end marker),
+as sent by getUserList_4210 / getRoomList_4300, written packet by
+packet vs. corked into a single transport write.
+
+The transport only counts writes and bytes, so the numbers are
+the Python-side cost of the send path (serialize, XOR, write calls);
+Twisted itself would coalesce the syscalls of one reactor turn
+either way.
+
+Usage: PYTHONPATH=lib python3 bench/cork_bench.py [iterations]
+"""
+
+import sys
+import time
+
+from fiveserver.protocol import PacketReceiver
+from fiveserver import stream
+
+
+NUM_RECORDS = 50
+RECORD_SIZE = 131
+
+
+class Factory:
+
+    serverConfig = type('ServerConfig', (), {'Debug': False})
+
+
+class CountingTransport:
+
+    def __init__(self):
+        self.writes = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.writes += 1
+        self.chunks.append(data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def reset(self):
+        self.writes = 0
+        self.chunks = []
+
+
+def makeReceiver():
+    receiver = PacketReceiver()
+    receiver.factory = Factory()
+    receiver.transport = CountingTransport()
+    receiver.connectionMade()
+    return receiver
+
+
+def sendList(receiver, records):
+    receiver.sendZeros(0x4211, 4)
+    for data in records:
+        receiver.sendData(0x4212, data)
+    receiver.sendZeros(0x4213, 4)
+
+
+def sendListCorked(receiver, records):
+    with receiver.corked():
+        sendList(receiver, records)
+
+
+def main():
+    try: iterations = int(sys.argv[1])
+    except IndexError: iterations = 5000
+
+    records = [bytes([i]) * RECORD_SIZE for i in range(NUM_RECORDS)]
+
+    # same bytes on the wire, both ways
+    plain, corked = makeReceiver(), makeReceiver()
+    sendList(plain, records)
+    sendListCorked(corked, records)
+    assert b''.join(plain.transport.chunks) == b''.join(
+        corked.transport.chunks)
+    decoded = list(stream.PacketFramer().feed(
+        b''.join(corked.transport.chunks)))
+    assert len(decoded) == NUM_RECORDS + 2
+    assert [pkt.data for pkt in decoded[1:-1]] == records
+
+    for label, func in [
+            ('packet by packet', sendList),
+            ('corked', sendListCorked)]:
+        receiver = makeReceiver()
+        start = time.perf_counter()
+        for i in range(iterations):
+            func(receiver, records)
+            receiver.transport.reset()
+        elapsed = (time.perf_counter() - start) / iterations
+        func(receiver, records)
+        print('%-18s %8.1f us per list, %3d writes' % (
+            label, elapsed * 1e6, receiver.transport.writes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
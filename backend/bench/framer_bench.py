@@ -0,0 +1,72 @@
+"""
+Benchmark: incremental PacketFramer vs. the old re-slicing parser,
+on a synthetic stream of coalesced heartbeat (0x0005) and
+chat (0x4400) packets.
+
+Usage: PYTHONPATH=lib python3 bench/framer_bench.py [num-packets]
+"""
+
+import sys
+import time
+
+from fiveserver import stream
+from fiveserver.model import packet
+
+
+class ReslicingParser:
+    """
+    Previous PacketReceiver.dataReceived logic, kept as the reference.
+    """
+
+    def __init__(self):
+        self._recvd = b''
+
+    def feed(self, data):
+        packets = []
+        self._recvd += data
+        while len(self._recvd) >= 8:
+            hdr = packet.makePacketHeader(stream.xorData(self._recvd[:8], 0))
+            if len(self._recvd) < hdr.length + 24:
+                break
+            packets.append(packet.makePacket(
+                stream.xorData(self._recvd[:hdr.length + 24], 8)))
+            self._recvd = self._recvd[hdr.length + 24:]
+        return packets
+
+
+def makeStream(numPackets):
+    frames = []
+    chat = b'\0\x01\0\0\0\0\0\0\0\0' + b'hello everybody, gg!' + b'\0\0'
+    for i in range(numPackets):
+        if i % 2:
+            pkt = packet.Packet(packet.PacketHeader(0x0005, 0, i), b'')
+        else:
+            pkt = packet.Packet(
+                packet.PacketHeader(0x4400, len(chat), i), chat)
+        frames.append(stream.xorData(bytes(pkt), 0))
+    return b''.join(frames)
+
+
+def run(parser, data, chunkSize):
+    count = 0
+    start = time.perf_counter()
+    for i in range(0, len(data), chunkSize):
+        count += len(parser.feed(data[i:i+chunkSize]))
+    return count, time.perf_counter() - start
+
+
+def main():
+    try: numPackets = int(sys.argv[1])
+    except IndexError: numPackets = 10000
+    data = makeStream(numPackets)
+    print('%d packets, %d bytes' % (numPackets, len(data)))
+    for chunkSize in [1460, 16*1024, len(data)]:
+        n1, old = run(ReslicingParser(), data, chunkSize)
+        n2, new = run(stream.PacketFramer(), data, chunkSize)
+        assert n1 == n2 == numPackets
+        print('chunk %7d: re-slicing %8.1f ms, framer %8.1f ms, x%.1f' % (
+            chunkSize, old*1e3, new*1e3, old/new))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
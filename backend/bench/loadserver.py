@@ -0,0 +1,141 @@
+"""
+Sixserver for load tests: the real PES6 services (protocol,
+lobbies, rooms, matches), but with the in-memory data layer
+of bench/standin.py instead of MySQL, seeded with the users
+and profiles of the bots of bench/pes6_bots.py.
+
+Settings come from the given sixserver.yaml (default: the example
+config), with the overrides needed for a local run: no debug
+output or packet capture, no IP auto-detect, no user limit.
+Started by pes6_bots.py --spawn-server, or by hand:
+
+Usage: PYTHONPATH=lib python3 bench/loadserver.py [options]
+"""
+
+import argparse
+import os
+import resource
+import sys
+
+try:
+    from twisted.internet import epollreactor
+    epollreactor.install()
+except:
+    pass
+
+from twisted.internet import reactor
+from twisted.python import log as twistedLog
+
+from fiveserver.config import FiveServerConfig, YamlConfig
+from fiveserver.protocol import PacketServiceFactory
+from fiveserver.protocol import pes6
+from fiveserver import log, handlerstats, logic, outbound, watchdog, idle
+
+import standin
+
+
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def makeConfig(args):
+    scfg = YamlConfig(args.config)
+    scfg.Debug = False
+    scfg.ServerIP = '127.0.0.1'
+    scfg.MaxUsers = args.users + 1
+    scfg.ShowStats = args.show_stats
+    scfg.RoomUpdateInterval = args.room_update_interval
+    scfg.Disconnects = {'CountAsLoss': {'Enabled': False}}
+    scfg.Roster = {'enforceHash': False, 'compareHash': True}
+    if args.lobbies:
+        scfg.Lobbies = ['Load %d' % (i + 1) for i in range(args.lobbies)]
+    return scfg
+
+
+def printHandlerStats():
+    print('%-16s %6s %8s %10s %8s %8s %8s' % (
+        'handler', 'id', 'calls', 'cpu-ms', 'p50', 'p99', 'max'))
+    for stats in handlerstats.getStats():
+        print('%-16s %6s %8d %10.1f %8.3f %8.3f %8.3f' % (
+            stats['service'], stats['packetId'], stats['calls'],
+            stats['cpu'] * 1000, stats['p50'], stats['p99'], stats['max']))
+    sys.stdout.flush()
+
+
+def printReactorLag():
+    stats = watchdog.getStats()
+    print('reactor lag: %d ticks, p50 %.3f p95 %.3f p99 %.3f max %.3f ms, '
+          '%d stalls' % (stats['ticks'], stats['p50'], stats['p95'],
+          stats['p99'], stats['max'], stats['stalls']))
+    sys.stdout.flush()
+
+
+def main():
+    fsroot = os.environ.get('FSROOT', '.')
+    parser = argparse.ArgumentParser(
+        description='Sixserver with a stand-in database, for load tests')
+    parser.add_argument('--config',
+        default=fsroot + '/etc/conf/sixserver.yaml.example')
+    parser.add_argument('--port', type=int, default=20200,
+        help='port of the main service (default: %(default)s)')
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--users', type=int, default=10000,
+        help='number of bot users to seed (default: %(default)s)')
+    parser.add_argument('--lobbies', type=int, default=0,
+        help='replace the configured lobbies with this many')
+    parser.add_argument('--db-latency', type=float, default=0.0,
+        help='seconds added to every stand-in DB call')
+    parser.add_argument('--show-stats', action='store_true',
+        help='serve profile stats (ShowStats) from the stand-in DB')
+    parser.add_argument('--room-update-interval', type=float, default=0.2)
+    parser.add_argument('--handler-stats', action='store_true',
+        help='print per-handler stats on shutdown')
+    parser.add_argument('--idle-timeout', type=float, default=0,
+        help='drop connections silent for this many seconds')
+    parser.add_argument('--reactor-lag', action='store_true',
+        help='measure reactor loop lag, print it on shutdown')
+    parser.add_argument('--verbose', action='store_true',
+        help='log to stdout')
+    args = parser.parse_args()
+
+    if args.verbose:
+        twistedLog.startLogging(sys.stdout)
+    raiseFileLimit()
+    scfg = makeConfig(args)
+    log.setDebug(False)
+    handlerstats.setEnabled(args.handler_stats)
+    outbound.setMaxQueueBytes(scfg.get('OutboundQueueLimit'))
+
+    db = standin.StandInDatabase(args.db_latency)
+    db.seed(args.users)
+    userData = standin.UserData(db)
+    profileData = standin.ProfileData(db)
+    matchData = standin.MatchData(db)
+    profileLogic = logic.ProfileLogic(
+        matchData, profileData, scfg.get('StatsCacheSize'))
+    config = FiveServerConfig(
+        scfg, None, userData, profileData, matchData, profileLogic)
+
+    factory = PacketServiceFactory(config)
+    factory.protocol = pes6.MainService
+    reactor.listenTCP(args.port, factory,
+        backlog=1024, interface=args.interface)
+    if args.handler_stats:
+        reactor.addSystemEventTrigger('before', 'shutdown', printHandlerStats)
+    if args.idle_timeout:
+        idle.start(args.idle_timeout)
+    if args.reactor_lag:
+        watchdog.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', printReactorLag)
+    print('loadserver: pid %d, %d users, main service on %s:%d' % (
+        os.getpid(), args.users, args.interface, args.port))
+    sys.stdout.flush()
+    reactor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Benchmark: Lobby.getPlayerByProfileId / getRoomById (used by private
+chat, ping, setOwner, getStunInfo, joinRoom, ...) with the profile-id
+and room-id indexes, against the previous linear scans, as lobbies
+grow to thousands of players and rooms. Also Room.getPlayerPosition
+and getPlayerParticipate, used for every player of every room info.
+
+Usage: PYTHONPATH=lib python3 bench/lobby_index_bench.py [iterations]
+"""
+
+import functools
+import random
+import sys
+import time
+
+from fiveserver.model import lobby, user
+
+from schema_bench import makeRoom
+
+
+SIZES = [10, 100, 1000, 5000]
+
+
+def scanPlayerByProfileId(aLobby, id):
+    for usr in aLobby.players.values():
+        if usr.profile.id == id:
+            return usr
+    return None
+
+
+def scanRoomById(aLobby, roomId):
+    for room in aLobby.rooms.values():
+        if room.id == roomId:
+            return room
+    return None
+
+
+def indexPlayerPosition(room, usr):
+    return room.players.index(usr)
+
+
+def indexPlayerParticipate(room, usr):
+    try:
+        return room.participatingPlayers.index(usr)
+    except ValueError:
+        return 0xff
+
+
+def makeLobby(size):
+    aLobby = lobby.Lobby('Bench', size)
+    for i in range(size):
+        usr = user.User('hash%d' % i)
+        usr.profile = user.Profile(0)
+        usr.profile.id = 1000 + i
+        aLobby.enter(usr, None)
+        room = lobby.Room(aLobby)
+        room.name = 'room %d' % i
+        aLobby.addRoom(room)
+    return aLobby
+
+
+def timeIt(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    try: iterations = int(sys.argv[1])
+    except IndexError: iterations = 2000
+
+    print('%8s %16s %16s %16s %16s' % ('size',
+        'scan profile', 'index profile', 'scan room', 'index room'))
+    for size in SIZES:
+        aLobby = makeLobby(size)
+        rng = random.Random(size)
+        profileIds = [1000 + rng.randrange(size) for i in range(iterations)]
+        roomIds = [1 + rng.randrange(size) for i in range(iterations)]
+        for profileId, roomId in zip(profileIds[:100], roomIds[:100]):
+            assert aLobby.getPlayerByProfileId(profileId) is \
+                scanPlayerByProfileId(aLobby, profileId)
+            assert aLobby.getRoomById(roomId) is scanRoomById(aLobby, roomId)
+        print('%8d %13.3f us %13.3f us %13.3f us %13.3f us' % (size,
+            timeIt(lambda id: scanPlayerByProfileId(aLobby, id), profileIds),
+            timeIt(aLobby.getPlayerByProfileId, profileIds),
+            timeIt(lambda id: scanRoomById(aLobby, id), roomIds),
+            timeIt(aLobby.getRoomById, roomIds)))
+
+    room, players = makeRoom(4)
+    keys = players * (iterations // 4)
+    print('room of 4: position %0.3f us (list.index %0.3f us), '
+          'participation %0.3f us (list.index %0.3f us)' % (
+        timeIt(room.getPlayerPosition, keys),
+        timeIt(functools.partial(indexPlayerPosition, room), keys),
+        timeIt(room.getPlayerParticipate, keys),
+        timeIt(functools.partial(indexPlayerParticipate, room), keys)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
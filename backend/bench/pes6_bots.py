@@ -0,0 +1,475 @@
+"""
+Headless PES6 bot clients: a load generator for the main service.
+
+Every bot speaks the real framing (stream.xorData, model.packet)
+and logs in with a Blowfish-encrypted 0x3003, just like the game.
+Bots play in pairs: both log in, select profile and lobby, the
+host creates a room (0x4310), the guest joins it (0x4320), both
+participate (0x4363), the host starts the match, sets up players
+and teams, then walks it through the match states (0x4377),
+goals (0x4375) and clock updates (0x4385) to the end, when the
+result gets recorded. Then both leave the match screen (0x436f).
+
+Reported at the end: latency percentiles of every step (request
+sent until its response arrived), bytes and packets on the wire
+(TCP payload), and the CPU used by the server and by the bots.
+
+With --spawn-server, a server with the in-memory stand-in
+database is started for the run (bench/loadserver.py). Otherwise
+start one by hand, seeded with at least as many users as bots,
+and pass its pid with --server-pid to get its CPU usage.
+
+Usage: PYTHONPATH=lib python3 bench/pes6_bots.py --spawn-server \\
+           [--bots 1000] [--matches 1] [options]
+"""
+
+import argparse
+import binascii
+import math
+import os
+import random
+import resource
+import struct
+import subprocess
+import sys
+import time
+
+try:
+    from twisted.internet import epollreactor
+    epollreactor.install()
+except:
+    pass
+
+from Crypto.Cipher import Blowfish
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import Protocol
+
+from fiveserver import stream
+from fiveserver.model import packet, util
+from fiveserver.model.lobby import MatchState
+
+import standin
+
+
+# default key of FiveServerConfig (CIPHER_KEY in the environment)
+CIPHER_KEY = os.environ.get('CIPHER_KEY',
+    '27501fd04e6b82c831024dac5c6305221974deb9388a2190'
+    '1d576cbbe2f377ef23d75486010f37819afe6c321a0146d2'
+    '1544ec365bf7289a')
+
+# same roster for all bots, so that they can play each other
+ROSTER_HASH = binascii.a2b_hex('0123456789abcdef0123456789abcdef')
+
+PLAYERS_PER_LOBBY = 100
+HEARTBEAT_INTERVAL = 10.0
+
+
+class BotError(Exception):
+    pass
+
+
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def makeAuthData(i):
+    """
+    0x3003 payload of bot number i: Blowfish-encrypted block with
+    the roster hash at [58:74]; the server reads the user hash from
+    the raw (not decrypted) bytes at [32:48].
+    """
+    plain = bytearray(80)
+    plain[58:74] = ROSTER_HASH
+    cipher = Blowfish.new(binascii.a2b_hex(CIPHER_KEY), Blowfish.MODE_ECB)
+    data = bytearray(cipher.encrypt(bytes(plain)))
+    data[32:48] = binascii.a2b_hex(standin.botHash(i))
+    return bytes(data)
+
+
+def makeLobbyData(lobbyId, port):
+    return b'%s%s%s%s%s%s' % (
+        struct.pack('!B', lobbyId),
+        util.padWithZeros('127.0.0.1', 16),
+        struct.pack('!H', port),
+        util.padWithZeros('127.0.0.1', 16),
+        struct.pack('!H', port),
+        struct.pack('!H', 0))
+
+
+class Run:
+    """
+    Results of a load-test run, shared by all bots
+    """
+
+    def __init__(self):
+        self.latencies = dict()  # step -> [ms, ...]
+        self.errors = dict()     # step -> count
+        self.steps = []
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.packetsSent = 0
+        self.packetsReceived = 0
+        self.connected = 0
+        self.matches = 0
+        self.failedPairs = 0
+        self.failures = dict()   # error message -> count
+
+    def addLatency(self, step, ms):
+        try:
+            self.latencies[step].append(ms)
+        except KeyError:
+            self.latencies[step] = [ms]
+            self.steps.append(step)
+
+    def addFailure(self, error):
+        self.failedPairs += 1
+        message = '%s: %s' % (error.__class__.__name__, error)
+        self.failures[message] = self.failures.get(message, 0) + 1
+
+    def addError(self, step):
+        self.errors[step] = self.errors.get(step, 0) + 1
+        if step not in self.latencies:
+            self.latencies[step] = []
+            self.steps.append(step)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Bot(Protocol):
+    """
+    One game client. request() sends a packet and returns a Deferred,
+    fired with the first matching response packet.
+    """
+
+    def __init__(self, index, run, timeout):
+        self.index = index
+        self.run = run
+        self.timeout = timeout
+        self.profileId = index + 1
+        self.rooms = dict()      # room name (bytes) -> room id
+        self._waiting = []       # [(packetId, match, deferred)]
+        self._heartbeat = None
+
+    def connectionMade(self):
+        self._framer = stream.PacketFramer()
+        self._count = 1
+        # small request packets: do not let Nagle hold them back
+        self.transport.setTcpNoDelay(True)
+        self.run.connected += 1
+        self._heartbeat = task.LoopingCall(self.sendData, 0x0005, b'')
+        self._heartbeat.start(HEARTBEAT_INTERVAL, now=False)
+
+    def connectionLost(self, reason):
+        self.run.connected -= 1
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+        waiting, self._waiting = self._waiting, []
+        for packetId, match, d in waiting:
+            d.errback(BotError('connection lost'))
+
+    def dataReceived(self, data):
+        self.run.bytesReceived += len(data)
+        for pkt in self._framer.feed(data):
+            self.run.packetsReceived += 1
+            self.packetReceived(pkt)
+
+    def packetReceived(self, pkt):
+        if pkt.header.id == 0x4306:
+            roomId = struct.unpack('!i', pkt.data[0:4])[0]
+            self.rooms[util.stripZeros(pkt.data[6:70])] = roomId
+        for i, (packetId, match, d) in enumerate(self._waiting):
+            if packetId == pkt.header.id and (match is None or match(pkt)):
+                del self._waiting[i]
+                d.callback(pkt)
+                break
+
+    def sendData(self, packetId, data):
+        pkt = packet.Packet(
+            packet.PacketHeader(packetId, len(data), self._count), data)
+        frame = stream.xorData(pkt.serialize(), 0)
+        self.transport.write(frame)
+        self._count += 1
+        self.run.bytesSent += len(frame)
+        self.run.packetsSent += 1
+
+    def expect(self, packetId, match=None):
+        d = defer.Deferred()
+        entry = (packetId, match, d)
+        self._waiting.append(entry)
+        def _failed(failure):
+            try: self._waiting.remove(entry)
+            except ValueError:
+                pass
+            return failure
+        d.addTimeout(self.timeout, reactor)
+        d.addErrback(_failed)
+        return d
+
+    @defer.inlineCallbacks
+    def request(self, step, packetId, data, replyId, match=None,
+                success=None):
+        """
+        Send a packet, wait for the reply and account for
+        the latency. success: expected reply payload prefix.
+        """
+        d = self.expect(replyId, match)
+        started = time.perf_counter()
+        self.sendData(packetId, data)
+        try:
+            reply = yield d
+            if success is not None and not reply.data.startswith(success):
+                raise BotError('0x%04x: unexpected reply 0x%04x: %r' % (
+                    packetId, replyId, reply.data[:8]))
+        except Exception:
+            self.run.addError(step)
+            raise
+        self.run.addLatency(step, (time.perf_counter() - started) * 1000.0)
+        defer.returnValue(reply)
+
+    @defer.inlineCallbacks
+    def login(self, lobbyId):
+        port = 10000 + self.index % 50000
+        yield self.request('login 0x3003', 0x3003,
+            makeAuthData(self.index), 0x3004, success=b'\0\0\0\0')
+        yield self.request('profile 0x4100', 0x4100, b'\0', 0x4103)
+        yield self.request('lobbies 0x4200', 0x4200, b'\x01', 0x4201)
+        yield self.request('lobby 0x4202', 0x4202,
+            makeLobbyData(lobbyId, port), 0x4203, success=b'\0\0\0\0')
+
+    def roomUpdate(self, roomId):
+        return lambda pkt: struct.unpack('!i', pkt.data[0:4])[0] == roomId
+
+
+@defer.inlineCallbacks
+def playMatch(host, guest, roomId, options):
+    for bot in [host, guest]:
+        yield bot.request('participate 0x4363', 0x4363, b'\x01', 0x4364,
+            success=b'\0\0\0\0')
+    yield host.request('start 0x4360', 0x4360, b'', 0x4361)
+    # home: host, away: guest. Settings are done when the
+    # room update with the team selection goes out
+    players = b'%s%s%s' % (
+        struct.pack('!iB3x', host.profileId, 0),
+        struct.pack('!iB3x', guest.profileId, 1),
+        b'\0' * 16)
+    done = host.expect(0x4306, host.roomUpdate(roomId))
+    yield host.request('players 0x4369', 0x4369, players, 0x436a)
+    yield done
+    for bot in [host, guest]:
+        yield bot.request('team 0x4373', 0x4373,
+            struct.pack('!H', random.randint(0, 200)), 0x4374)
+
+    def state(value):
+        return host.request('state 0x4377', 0x4377,
+            struct.pack('!B', value), 0x4378)
+
+    yield state(MatchState.FIRST_HALF)
+    minutes = list(range(0, 91, options.clock_step))[1:]
+    goalChance = options.goals / float(len(minutes))
+    halfTime = False
+    for minute in minutes:
+        yield task.deferLater(reactor, options.tick, lambda: None)
+        if random.random() < goalChance:
+            yield host.request('goal 0x4375', 0x4375,
+                random.choice([b'\0', b'\x01']), 0x4376)
+        yield host.request('clock 0x4385', 0x4385,
+            struct.pack('!B', minute), 0x4386)
+        if minute >= 45 and not halfTime:
+            halfTime = True
+            yield state(MatchState.HALF_TIME)
+            yield state(MatchState.SECOND_HALF)
+    yield state(MatchState.FINISHED)
+    for bot in [host, guest]:
+        yield bot.request('exit match 0x436f', 0x436f, b'\0', 0x4370)
+
+
+@defer.inlineCallbacks
+def playPair(run, pairIndex, options):
+    endpoint = TCP4ClientEndpoint(
+        reactor, options.host, options.port, timeout=options.timeout)
+    lobbyId = pairIndex % options.lobbies
+    bots = []
+    try:
+        for index in [pairIndex * 2, pairIndex * 2 + 1]:
+            started = time.perf_counter()
+            try:
+                bot = yield connectProtocol(
+                    endpoint, Bot(index, run, options.timeout))
+            except Exception:
+                run.addError('connect')
+                raise
+            run.addLatency('connect',
+                (time.perf_counter() - started) * 1000.0)
+            bots.append(bot)
+        host, guest = bots
+        yield defer.gatherResults(
+            [bot.login(lobbyId) for bot in bots], consumeErrors=True)
+        roomName = b'load-%d' % pairIndex
+        yield host.request('create room 0x4310', 0x4310,
+            util.padWithZeros(roomName, 64) + b'\0' * 16, 0x4311,
+            success=b'\0\0\0\0')
+        roomId = host.rooms[roomName]
+        yield guest.request('join room 0x4320', 0x4320,
+            struct.pack('!i', roomId) + b'\0' * 15, 0x4348)
+        for i in range(options.matches):
+            yield playMatch(host, guest, roomId, options)
+            run.matches += 1
+    except Exception as info:
+        run.addFailure(info)
+    for bot in bots:
+        bot.transport.loseConnection()
+
+
+def readCpu(pid):
+    """
+    CPU seconds (user + system) used so far by a process
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def spawnServer(options):
+    args = [sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                'loadserver.py'),
+            '--port', str(options.port),
+            '--interface', options.host,
+            '--users', str(options.bots),
+            '--lobbies', str(options.lobbies),
+            '--db-latency', str(options.db_latency)]
+    if options.show_stats:
+        args.append('--show-stats')
+    if options.handler_stats:
+        args.append('--handler-stats')
+    server = subprocess.Popen(args, stdout=subprocess.PIPE,
+        universal_newlines=True)
+    line = server.stdout.readline()
+    if not line:
+        raise BotError('server did not start')
+    print(line.strip())
+    return server
+
+
+def report(run, options, elapsed, serverCpu, botsCpu):
+    print()
+    print('%d bots, %d matches played, %d failed pairs, %.1f s' % (
+        options.bots, run.matches, run.failedPairs, elapsed))
+    print()
+    print('%-20s %8s %6s %9s %9s %9s %9s' % (
+        'step', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for step in run.steps:
+        values = sorted(run.latencies[step])
+        print('%-20s %8d %6d %9.2f %9.2f %9.2f %9.2f' % (
+            step, len(values), run.errors.get(step, 0),
+            percentile(values, 50), percentile(values, 95),
+            percentile(values, 99), values[-1] if values else 0.0))
+    if run.failures:
+        print()
+        for message, count in sorted(run.failures.items()):
+            print('failed pairs: %d x %s' % (count, message))
+    print()
+    print('wire (TCP payload): sent %d packets, %d bytes (%.1f KB/s); '
+          'received %d packets, %d bytes (%.1f KB/s)' % (
+        run.packetsSent, run.bytesSent, run.bytesSent / elapsed / 1024,
+        run.packetsReceived, run.bytesReceived,
+        run.bytesReceived / elapsed / 1024))
+    if serverCpu is not None:
+        print('server CPU: %.2f s (%.1f%% of one core)' % (
+            serverCpu, serverCpu / elapsed * 100))
+    print('bots CPU: %.2f s (%.1f%% of one core)' % (
+        botsCpu, botsCpu / elapsed * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Headless PES6 bots: load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=20200,
+        help='main service port (default: %(default)s)')
+    parser.add_argument('--bots', type=int, default=1000,
+        help='number of bots, in host/guest pairs (default: %(default)s)')
+    parser.add_argument('--matches', type=int, default=1,
+        help='matches per pair (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=500.0,
+        help='bots started per second (default: %(default)s)')
+    parser.add_argument('--lobbies', type=int, default=0,
+        help='lobbies to spread the bots over '
+             '(default: one per %d bots)' % PLAYERS_PER_LOBBY)
+    parser.add_argument('--tick', type=float, default=0.05,
+        help='seconds between match clock updates (default: %(default)s)')
+    parser.add_argument('--clock-step', type=int, default=5,
+        help='match minutes per clock update (default: %(default)s)')
+    parser.add_argument('--goals', type=float, default=3.0,
+        help='average goals per match (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--spawn-server', action='store_true',
+        help='start bench/loadserver.py for the run')
+    parser.add_argument('--server-pid', type=int, default=None,
+        help='pid of the server, for its CPU usage')
+    parser.add_argument('--db-latency', type=float, default=0.0,
+        help='(spawned server) seconds added to every DB call')
+    parser.add_argument('--show-stats', action='store_true',
+        help='(spawned server) serve profile stats')
+    parser.add_argument('--handler-stats', action='store_true',
+        help='(spawned server) print per-handler stats at the end')
+    options = parser.parse_args()
+    options.bots += options.bots % 2
+    if options.lobbies <= 0:
+        options.lobbies = max(1, int(math.ceil(
+            options.bots / float(PLAYERS_PER_LOBBY))))
+    random.seed(options.seed)
+    raiseFileLimit()
+
+    server = None
+    if options.spawn_server:
+        server = spawnServer(options)
+        options.server_pid = server.pid
+    run = Run()
+    serverCpu = None
+    if options.server_pid:
+        serverCpu = readCpu(options.server_pid)
+    botsCpu = time.process_time()
+    started = time.perf_counter()
+
+    def _start():
+        numPairs = options.bots // 2
+        ds = [task.deferLater(reactor, i * 2 / options.rate,
+                  playPair, run, i, options)
+              for i in range(numPairs)]
+        d = defer.DeferredList(ds)
+        # give the last disconnects time to reach the server
+        d.addCallback(lambda _: task.deferLater(reactor, 0.5, lambda: None))
+        d.addCallback(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(_start)
+    reactor.run()
+
+    elapsed = time.perf_counter() - started
+    if serverCpu is not None:
+        serverCpu = readCpu(options.server_pid) - serverCpu
+    report(run, options, elapsed, serverCpu, time.process_time() - botsCpu)
+    if server is not None:
+        server.terminate()
+        output = server.communicate()[0]
+        if output.strip():
+            print()
+            print(output.rstrip())
+    return 0 if run.failedPairs == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+Benchmark: rank-compute with the old paged loop (LIMIT/OFFSET pages
+of 50, one UPDATE per profile) vs. the set-based RANK() update of
+ProfileData._computeRanksTxn, and the incremental band update after
+a typical batch of point changes.
+
+Needs MySQLdb and an EMPTY scratch database created from
+sql/schema6.sql. Profiles are added up to each of the given sizes
+(default: 10000 100000 1000000). The old loop is skipped above
+100000 profiles unless --all is given: it is quadratic.
+
+Usage: PYTHONPATH=lib python3 bench/ranks_bench.py \\
+           host user password database [--all] [size ...]
+"""
+
+import random
+import sys
+import time
+
+import MySQLdb
+
+from fiveserver import data6
+
+
+OLD_LOOP_LIMIT = 100000
+CHANGED_PROFILES = 50
+
+
+def oldComputeRanksTxn(transaction):
+    """
+    Previous ProfileData._computeRanksTxn, kept as the reference.
+    """
+    rank, count = 1, 1
+    last_points = None
+    limit, offset = 50, 0
+    while True:
+        sql = ('SELECT id, points FROM profiles '
+               'ORDER BY points DESC, seconds_played DESC '
+               'LIMIT %s OFFSET %s')
+        transaction.execute(sql, [limit, offset])
+        rows = transaction.fetchall()
+        for (id, points) in rows:
+            if last_points is not None:
+                if last_points > points:
+                    rank = count
+            transaction.execute(
+                'UPDATE profiles SET `rank`=%s WHERE id=%s', [rank, id])
+            last_points = points
+            count += 1
+        if len(rows) < limit:
+            break
+        offset += limit
+
+
+def seed(conn, size):
+    cursor = conn.cursor()
+    cursor.execute('SELECT count(*) FROM profiles')
+    count = cursor.fetchone()[0]
+    if count >= size:
+        return
+    print('seeding %d profiles...' % (size - count))
+    for start in range(count, size, 1000):
+        users = [('rank%d' % i, '%020d' % i, '%032d' % i)
+                 for i in range(start, min(start + 1000, size))]
+        cursor.executemany(
+            'INSERT INTO users (username, serial, hash) '
+            'VALUES (%s, %s, %s)', users)
+        cursor.execute('SELECT id, username FROM users '
+                       'WHERE username IN (%s)' % ','.join(
+                           ['%s'] * len(users)),
+                       [u[0] for u in users])
+        cursor.executemany(
+            'INSERT INTO profiles (user_id, name, points, seconds_played) '
+            'VALUES (%s, %s, %s, %s)',
+            [(userId, name, int(random.expovariate(1 / 500.0)),
+              random.randint(0, 10**6))
+             for userId, name in cursor.fetchall()])
+        conn.commit()
+
+
+def timed(label, conn, func, *args):
+    t0 = time.perf_counter()
+    result = func(conn.cursor(), *args)
+    conn.commit()
+    print('  %-32s %10.1f ms  (%s rows)' % (
+        label, (time.perf_counter() - t0) * 1000, result))
+
+
+def ranks(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, `rank` FROM profiles ORDER BY id')
+    return cursor.fetchall()
+
+
+def main():
+    args = sys.argv[1:]
+    runAll = '--all' in args
+    args = [arg for arg in args if arg != '--all']
+    if len(args) < 4:
+        print(__doc__)
+        return 1
+    host, user, passwd, db = args[:4]
+    sizes = [int(size) for size in args[4:]] or [10000, 100000, 1000000]
+    conn = MySQLdb.connect(host=host, user=user, passwd=passwd, db=db)
+    profileData = data6.ProfileData(None)
+
+    for size in sizes:
+        seed(conn, size)
+        print('%d profiles:' % size)
+        if size <= OLD_LOOP_LIMIT or runAll:
+            conn.cursor().execute('UPDATE profiles SET `rank`=0')
+            conn.commit()
+            timed('old paged loop', conn, oldComputeRanksTxn)
+            expected = ranks(conn)
+        else:
+            expected = None
+        conn.cursor().execute('UPDATE profiles SET `rank`=0')
+        conn.commit()
+        timed('set-based full', conn, profileData._computeRanksTxn)
+        if expected is not None:
+            assert ranks(conn) == expected
+        timed('set-based full (no changes)', conn,
+              profileData._computeRanksTxn)
+
+        # a batch of finished matches: a few profiles move a little
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, points FROM profiles '
+                       'ORDER BY RAND() LIMIT %s', [CHANGED_PROFILES])
+        band = None
+        for id, points in cursor.fetchall():
+            newPoints = max(0, points + random.randint(-30, 30))
+            cursor.execute('UPDATE profiles SET points=%s WHERE id=%s',
+                           [newPoints, id])
+            lo, hi = min(points, newPoints), max(points, newPoints)
+            if band is not None:
+                lo, hi = min(lo, band[0]), max(hi, band[1])
+            band = (lo, hi)
+        conn.commit()
+        timed('incremental band %s-%s' % band, conn,
+              profileData._computeRanksBandTxn, band[0], band[1])
+        incremental = ranks(conn)
+        profileData._computeRanksTxn(conn.cursor())
+        conn.commit()
+        assert ranks(conn) == incremental
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Benchmark: room list (0x4302 payloads) of a lobby with 50 busy
+rooms, serialized from scratch for every request vs. taken from
+the per-room cache of MainService.formatRoomInfo, which is only
+redone for rooms whose version changed (here: one match clock
+update between two requests).
+
+Usage: PYTHONPATH=lib python3 bench/roomlist_bench.py [iterations]
+"""
+
+import sys
+import time
+
+from fiveserver.protocol import pes6
+
+from schema_bench import Factory, makeRoom
+
+
+NUM_ROOMS = 50
+
+
+def main():
+    try: iterations = int(sys.argv[1])
+    except IndexError: iterations = 2000
+
+    service = pes6.MainService()
+    service.factory = Factory()
+    rooms = [makeRoom(4)[0] for i in range(NUM_ROOMS)]
+    for room in rooms:
+        assert service.formatRoomInfo(room) == service.serializeRoomInfo(room)
+
+    def uncached():
+        return [service.serializeRoomInfo(room) for room in rooms]
+
+    def cached():
+        return [service.formatRoomInfo(room) for room in rooms]
+
+    def cachedWithUpdate(i):
+        room = rooms[i % NUM_ROOMS]
+        room.match.clock = (room.match.clock + 1) % 120
+        room.touch()
+        return cached()
+
+    for label, func in [
+            ('serialized every time', lambda i: uncached()),
+            ('cached', lambda i: cached()),
+            ('cached, 1 room changed', cachedWithUpdate)]:
+        start = time.perf_counter()
+        for i in range(iterations):
+            func(i)
+        elapsed = (time.perf_counter() - start) / iterations
+        print('%-24s %8.1f us per %d-room list' % (
+            label, elapsed * 1e6, NUM_ROOMS))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""
+Benchmark: payload formatters of pes6.MainService built from
+declarative layouts (model/schema.py, one precompiled struct.Struct
+per packet) vs. the previous %-formatting over many struct.pack
+and util.padWithZeros calls; and the 0x4202/0x4369 decoders vs.
+the previous per-field slicing. Both versions must produce the
+same bytes.
+
+Usage: PYTHONPATH=lib python3 bench/schema_bench.py [iterations]
+"""
+
+from datetime import datetime
+import struct
+import sys
+import time
+
+from fiveserver import rating
+from fiveserver.model import lobby, user, util
+from fiveserver.protocol import pes5, pes6
+
+
+class Factory:
+
+    def __init__(self):
+        self.ratingMath = rating.RatingMath(0.44, 0.56)
+        self.serverConfig = type('ServerConfig', (), {'ShowStats': True})
+
+
+class OldFormatters(pes6.MainService):
+    """
+    Previous formatters, kept as the reference.
+    """
+
+    def formatPlayerInfo(self, usr, roomId, stats=None):
+        if stats is None:
+            stats = user.Stats(usr.profile.id, 0,0,0,0,0,0,0)
+        return (b'%(id)s%(name)s%(groupid)s%(groupname)s'
+                b'%(groupmemberstatus)s%(division)s%(roomid)s'
+                b'%(points)s%(rating)s%(matches)s%(wins)s'
+                b'%(losses)s%(draws)s%(pad1)s' % {
+            b'id': struct.pack('!i',usr.profile.id),
+            b'name': util.padWithZeros(usr.profile.name,48),
+            b'groupid': struct.pack('!i',0),
+            b'groupname': b'\0'*48,
+            b'groupmemberstatus': struct.pack('!B',0),
+            b'division': struct.pack('!B', 
+                self.factory.ratingMath.getDivision(usr.profile.points)),
+            b'roomid': struct.pack('!i',roomId),
+            b'points': struct.pack('!i',usr.profile.points),
+            b'rating': struct.pack('!H',0),
+            b'matches': struct.pack('!H',
+                stats.wins + stats.losses + stats.draws),
+            b'wins': struct.pack('!H',stats.wins),
+            b'losses': struct.pack('!H',stats.losses),
+            b'draws': struct.pack('!H',stats.draws),
+            b'pad1': b'\0'*3,
+        })
+
+    def formatProfileInfo(self, profile, stats):
+        if not self.factory.serverConfig.ShowStats:
+            profile = self.makePristineProfile(profile)
+        return (b'%(id)s%(name)s%(groupid)s%(groupname)s'
+                    b'%(groupmemberstatus)s%(division)s'
+                    b'%(points)s%(rating)s%(matches)s'
+                    b'%(wins)s%(losses)s%(draws)s%(win-strk)s'
+                    b'%(win-best)s%(disconnects)s'
+                    b'%(goals-scored)s%(goals-allowed)s'
+                    b'%(comment)s%(rank)s'
+                    b'%(competition-gold-medals)s%(competition-silver-medals)s'
+                    b'%(unknown1)s'
+                    b'%(winnerscup-gold-medals)s%(winnerscup-silver-medals)s'
+                    b'%(unknown2)s%(unknown3)s'
+                    b'%(language)s%(recent-used-teams)s' % {
+                b'id': struct.pack('!i',profile.id),
+                b'name': util.padWithZeros(profile.name,48),
+                b'groupid': struct.pack('!i',0),
+                b'groupname': util.padWithZeros('Playmakers',48),
+                b'groupmemberstatus': struct.pack('!B',1),
+                b'division': struct.pack('!B', 
+                    self.factory.ratingMath.getDivision(profile.points)),
+                b'points': struct.pack('!i',profile.points),
+                b'rating': struct.pack('!H',profile.rating),
+                b'matches': struct.pack('!H',
+                    stats.wins + stats.losses + stats.draws),
+                b'wins': struct.pack('!H',stats.wins),
+                b'losses': struct.pack('!H',stats.losses),
+                b'draws': struct.pack('!H',stats.draws),
+                b'win-strk': struct.pack('!H', stats.streak_current),
+                b'win-best': struct.pack('!H', stats.streak_best),
+                b'disconnects': struct.pack(
+                    '!H', profile.disconnects),
+                b'goals-scored': struct.pack('!i', stats.goals_scored),
+                b'goals-allowed': struct.pack('!i', stats.goals_allowed),
+                b'comment': util.padWithZeros((
+                    profile.comment or 'Fiveserver rules!'), 256),
+                b'rank': struct.pack('!i',profile.rank),
+                b'competition-gold-medals': struct.pack('!H', 0),
+                b'competition-silver-medals': struct.pack('!H', 0),
+                b'unknown1': struct.pack('!H', 0),
+                b'winnerscup-gold-medals': struct.pack('!H', 0),
+                b'winnerscup-silver-medals': struct.pack('!H', 0),
+                b'unknown2': struct.pack('!H', 0),
+                b'unknown3': struct.pack('!B', 0),
+                b'language': struct.pack('!B', 0),
+                b'recent-used-teams': b''.join([struct.pack('!H', team) 
+                    for team in stats.teams]) + b'\xff\xff'*(5-len(stats.teams)) 
+            })
+            
+    def formatHomeOrAway(self, room, usr):
+        if room.teamSelection:
+            return room.teamSelection.getHomeOrAway(usr)
+        return 0xff
+
+    def formatTeamsAndGoals(self, room):
+        homeTeam, awayTeam = 0xffff, 0xffff
+        if room.teamSelection:
+            homeTeam = (room.teamSelection.home_team_id
+            if room.teamSelection.home_team_id != None else 0xffff)
+            awayTeam = (room.teamSelection.away_team_id
+            if room.teamSelection.away_team_id != None else 0xffff)
+        (homeGoals1st, homeGoals2nd, homeGoalsEt1, 
+         homeGoalsEt2, homeGoalsPen) = 0, 0, 0, 0, 0
+        (awayGoals1st, awayGoals2nd, awayGoalsEt1, 
+         awayGoalsEt2, awayGoalsPen) = 0, 0, 0, 0, 0
+        if room.match:
+            homeGoals1st = room.match.score_home_1st
+            homeGoals2nd = room.match.score_home_2nd
+            homeGoalsEt1 = room.match.score_home_et1
+            homeGoalsEt2 = room.match.score_home_et2
+            homeGoalsPen = room.match.score_home_pen
+            awayGoals1st = room.match.score_away_1st
+            awayGoals2nd = room.match.score_away_2nd
+            awayGoalsEt1 = room.match.score_away_et1
+            awayGoalsEt2 = room.match.score_away_et2
+            awayGoalsPen = room.match.score_away_pen
+        return b'%s%s%s%s%s%s%s%s%s%s%s%s' % (
+            struct.pack('!H', homeTeam),
+            struct.pack('!B', homeGoals1st), # 1st
+            struct.pack('!B', homeGoals2nd), # 2nd
+            struct.pack('!B', homeGoalsEt1), # et1
+            struct.pack('!B', homeGoalsEt2), # et2
+            struct.pack('!B', homeGoalsPen), # pen
+            struct.pack('!H', awayTeam),
+            struct.pack('!B', awayGoals1st), # 1st
+            struct.pack('!B', awayGoals2nd), # 2nd
+            struct.pack('!B', awayGoalsEt1), # et1
+            struct.pack('!B', awayGoalsEt2), # et2
+            struct.pack('!B', awayGoalsPen)) # pen
+
+    def formatRoomInfo(self, room):
+        n = len(room.players)
+        if room.match:
+            match_state = room.match.state
+            match_clock = room.match.clock
+        else:
+            match_state, match_clock = 0, 0
+        return b'%s%s%s%s%s%s%s%s%s%s%s' % (
+            struct.pack('!i',room.id),
+            struct.pack('!B',room.phase),
+            struct.pack('!B',match_state),
+            util.padWithZeros(room.name,64),
+            struct.pack('!B',match_clock),
+            b''.join([b'%s%s%s%s%s%s%s' % (
+                struct.pack('!i',usr.profile.id),
+                struct.pack('!B',room.isOwner(usr)),
+                # matchstarter or 1st host?
+                struct.pack('!B',room.isMatchStarter(usr)), 
+                struct.pack('!B',self.formatHomeOrAway(room, usr)), # team
+                struct.pack('!B',usr.state.spectator), # spectator
+                struct.pack('!B',room.getPlayerPosition(usr)), # pos in room
+                struct.pack('!B',room.getPlayerParticipate(usr))) # participate
+                for usr in room.players]),
+            b'\0\0\0\0\0\0\xff\0\0\xff'*(4-n), # empty players
+            self.formatTeamsAndGoals(room),
+            b'\0', #padding
+            struct.pack('!B', int(room.usePassword)), # room locked
+            b'\0\x02\0\0') # competition flag, match chat setting, 2 unknowns
+
+    # compared with the uncached serializer
+    serializeRoomInfo = formatRoomInfo
+
+    def formatStunInfo(self, room, usr, padding=32):
+        return (b'%(pad1)s%(ip1)s%(port1)s'
+            b'%(ip2)s%(port2)s%(id)s'
+            b'%(someField)s%(participate)s') % {
+        b'pad1': b'\0'*padding,
+        b'ip1': util.padWithZeros(usr.state.ip1, 16),
+        b'port1': struct.pack('!H', usr.state.udpPort1),
+        b'ip2': util.padWithZeros(usr.state.ip2, 16),
+        b'port2': struct.pack('!H', usr.state.udpPort2),
+        b'id': struct.pack('!i', usr.profile.id),
+        b'someField': struct.pack('!H', 0),
+        b'participate': struct.pack('!B',
+            room.getPlayerParticipate(usr)),
+        }
+
+
+def oldDecodeLobbySelect(data):
+    return (struct.unpack('!B',data[0:1])[0],
+            data[19:35],
+            struct.unpack('!H',data[17:19])[0],
+            struct.unpack('!H',data[35:37])[0],
+            struct.unpack('!H',data[37:39])[0])
+
+
+def newDecodeLobbySelect(data):
+    s = pes5.LOBBY_SELECT.unpack(data)
+    return s.lobbyId, s.ip2, s.udpPort1, s.udpPort2, s.someField
+
+
+def oldDecodePlayerSettings(data):
+    return [(struct.unpack('!i',data[x*8:x*8+4])[0], 1 == data[x*8+4])
+            for x in range(4)]
+
+
+def newDecodePlayerSettings(data):
+    settings = pes6.PLAYER_SETTINGS.unpackValues(data)
+    return [(settings[x*2], 1 == settings[x*2+1]) for x in range(4)]
+
+
+def makeRoom(numPlayers):
+    aLobby = lobby.Lobby('Bench', 100)
+    room = lobby.Room(aLobby)
+    room.name = b'benchmark room'
+    aLobby.addRoom(room)
+    players = []
+    for i in range(numPlayers):
+        usr = user.User('hash%d' % i)
+        usr.state = user.UserState()
+        usr.state.ip1 = util.padWithZeros('10.0.0.%d' % i, 16)
+        usr.state.ip2 = util.padWithZeros('192.168.1.%d' % i, 16)
+        usr.state.udpPort1 = 5730 + i
+        usr.state.udpPort2 = 5739 + i
+        usr.profile = user.Profile(0)
+        usr.profile.id = 1000 + i
+        usr.profile.name = 'player%d' % i
+        usr.profile.points = 300 * i
+        usr.profile.comment = 'hi there'
+        room.enter(usr)
+        room.participate(usr)
+        players.append(usr)
+    ts = lobby.TeamSelection()
+    ts.home_captain = players[0].profile
+    ts.away_captain = players[1].profile
+    ts.home_team_id, ts.away_team_id = 11, 42
+    room.teamSelection = ts
+    room.match = lobby.Match6(ts)
+    room.match.startDatetime = datetime.now()
+    room.match.state = lobby.MatchState.SECOND_HALF
+    room.match.clock = 67
+    room.match.score_home_1st, room.match.score_away_2nd = 2, 1
+    room.phase = lobby.RoomState.ROOM_MATCH_STARTED
+    return room, players
+
+
+def timeIt(func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    try: iterations = int(sys.argv[1])
+    except IndexError: iterations = 100000
+
+    old, new = OldFormatters(), pes6.MainService()
+    old.factory = new.factory = Factory()
+    room, players = makeRoom(4)
+    usr = players[2]
+    stats = user.Stats(usr.profile.id, 10, 4, 3, 40, 22, 2, 5, [11, 42])
+    lobbyData = (b'\x02' + util.padWithZeros('10.0.0.2', 16) +
+                 struct.pack('!H', 5730) +
+                 util.padWithZeros('192.168.1.2', 16) +
+                 struct.pack('!HH', 5739, 0))
+    settingsData = (struct.pack('!iB3x', 1000, 0) +
+                    struct.pack('!iB3x', 1001, 1) + b'\0' * 16)
+
+    cases = [
+        ('formatPlayerInfo',
+            lambda f: f.formatPlayerInfo(usr, room.id, stats)),
+        ('formatProfileInfo',
+            lambda f: f.formatProfileInfo(usr.profile, stats)),
+        ('formatTeamsAndGoals',
+            lambda f: f.formatTeamsAndGoals(room)),
+        ('formatRoomInfo (4 players)',
+            lambda f: f.serializeRoomInfo(room)),
+        ('0x4347 stun info',
+            lambda f: f.formatStunInfo(room, usr)),
+    ]
+    decoders = [
+        ('decode 0x4202', oldDecodeLobbySelect, newDecodeLobbySelect,
+            lobbyData),
+        ('decode 0x4369', oldDecodePlayerSettings, newDecodePlayerSettings,
+            settingsData),
+    ]
+
+    print('%-28s %10s %10s %8s' % ('', 'old us', 'schema us', 'speedup'))
+    for label, call in cases:
+        assert call(old) == call(new), label
+        tOld = timeIt(lambda: call(old), iterations)
+        tNew = timeIt(lambda: call(new), iterations)
+        print('%-28s %10.2f %10.2f %7.1fx' % (label, tOld, tNew, tOld / tNew))
+    for label, oldDecode, newDecode, data in decoders:
+        assert oldDecode(data) == newDecode(data), label
+        tOld = timeIt(lambda: oldDecode(data), iterations)
+        tNew = timeIt(lambda: newDecode(data), iterations)
+        print('%-28s %10.2f %10.2f %7.1fx' % (label, tOld, tNew, tOld / tNew))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+In-memory stand-in for the PES6 data layer (data6), used by
+the load-test server (bench/loadserver.py). Same interfaces as
+data6.UserData, ProfileData and MatchData, but nothing is stored
+in MySQL: users and profiles of the bots are seeded in memory.
+An optional latency delays every call, to mimic a DB round-trip.
+"""
+
+import hashlib
+
+from twisted.internet import defer, reactor
+
+from fiveserver import data6
+from fiveserver.model import user
+
+
+def botName(i):
+    return 'bot%d' % i
+
+
+def botHash(i):
+    """
+    User hash of bot number i (hex string, as stored in users.hash)
+    """
+    return hashlib.md5(botName(i).encode('utf-8')).hexdigest()
+
+
+class StandInDatabase:
+    """
+    Tables shared by the stand-in data objects
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.users = dict()        # id -> User
+        self.usersByHash = dict()  # hash -> User
+        self.profiles = dict()     # id -> Profile
+        self.profilesByUser = dict()  # user id -> [profile id, ...]
+        self.profilesByName = dict()  # name -> profile id
+        self.stats = dict()        # profile id -> [w, l, d, scored, allowed]
+        self.matches = 0
+        self.calls = 0
+
+    def result(self, value):
+        self.calls += 1
+        if self.latency > 0:
+            d = defer.Deferred()
+            reactor.callLater(self.latency, d.callback, value)
+            return d
+        return defer.succeed(value)
+
+    def seed(self, numUsers):
+        for i in range(numUsers):
+            usr = user.User(botHash(i))
+            usr.id = i + 1
+            usr.username = botName(i)
+            usr.serial = '%020d' % i
+            usr.nonce = None
+            self.users[usr.id] = usr
+            self.usersByHash[usr.hash] = usr
+            profile = user.Profile(0)
+            profile.id = i + 1
+            profile.userId = usr.id
+            profile.name = botName(i)
+            self.putProfile(profile)
+
+    def putProfile(self, profile):
+        old = self.profiles.get(profile.id)
+        if old is not None and self.profilesByName.get(old.name) == old.id:
+            del self.profilesByName[old.name]
+        self.profiles[profile.id] = profile
+        self.profilesByName[profile.name] = profile.id
+        ids = self.profilesByUser.setdefault(profile.userId, [])
+        if profile.id not in ids:
+            ids.append(profile.id)
+
+
+def copyProfile(p):
+    c = user.Profile(p.index)
+    c.__dict__.update(p.__dict__)
+    return c
+
+
+def copyUser(u):
+    c = user.User(u.hash)
+    c.id = u.id
+    c.username = u.username
+    c.serial = u.serial
+    c.nonce = u.nonce
+    return c
+
+
+class UserData(data6.UserData):
+
+    def __init__(self, db):
+        data6.UserData.__init__(self, None)
+        self.db = db
+
+    def get(self, id):
+        usr = self.db.users.get(id)
+        return self.db.result([copyUser(usr)] if usr else [])
+
+    def findByHash(self, hash):
+        if isinstance(hash, bytes):
+            hash = hash.decode('ascii')
+        usr = self.db.usersByHash.get(hash)
+        return self.db.result([copyUser(usr)] if usr else [])
+
+    def store(self, usr):
+        if usr.id is None:
+            usr.id = len(self.db.users) + 1
+        self.db.users[usr.id] = copyUser(usr)
+        self.db.usersByHash[usr.hash] = self.db.users[usr.id]
+        return self.db.result(True)
+
+
+class ProfileData(data6.ProfileData):
+
+    def __init__(self, db):
+        data6.ProfileData.__init__(self, None)
+        self.db = db
+
+    def get(self, id):
+        p = self.db.profiles.get(id)
+        return self.db.result([copyProfile(p)] if p else [])
+
+    def getByUserId(self, userId):
+        return self.db.result([copyProfile(self.db.profiles[id])
+            for id in self.db.profilesByUser.get(userId, [])])
+
+    def findByName(self, profileName):
+        id = self.db.profilesByName.get(profileName)
+        return self.db.result(
+            [copyProfile(self.db.profiles[id])] if id is not None else [])
+
+    def store(self, p):
+        if p.id is None:
+            p.id = max(self.db.profiles or [0]) + 1
+        old = self.db.profiles.get(p.id)
+        self.markPointsChanged(old.points if old else 0, p.points)
+        self.db.putProfile(copyProfile(p))
+        return self.db.result(True)
+
+    def getSettings(self, profileId):
+        return self.db.result(user.ProfileSettings(None, None))
+
+    def storeSettings(self, profileId, settings):
+        return self.db.result(settings)
+
+    def computeRanks(self, incremental=False):
+        self._rankBand = None
+        return self.db.result(0)
+
+
+class MatchData(data6.MatchData):
+
+    def __init__(self, db):
+        data6.MatchData.__init__(self, None)
+        self.db = db
+
+    def store(self, match):
+        home_players, away_players = self.getPlayers(match)
+        home, away = match.score_home, match.score_away
+        for players, scored, allowed in [
+                (home_players, home, away), (away_players, away, home)]:
+            for profile in players:
+                s = self.db.stats.setdefault(profile.id, [0] * 5)
+                s[0] += scored > allowed
+                s[1] += scored < allowed
+                s[2] += scored == allowed
+                s[3] += scored
+                s[4] += allowed
+        self.db.matches += 1
+        for listener in self.storeListeners:
+            listener([profile.id for profile in home_players + away_players])
+        return self.db.result(self.db.matches)
+
+    def getGames(self, profileId):
+        s = self.db.stats.get(profileId, [0] * 5)
+        return self.db.result(s[0] + s[1] + s[2])
+
+    def getAggregateStatsMany(self, profileIds):
+        results = dict()
+        for profileId in profileIds:
+            wins, losses, draws, scored, allowed = self.db.stats.get(
+                profileId, [0] * 5)
+            results[profileId] = user.Stats(profileId, wins, losses, draws,
+                scored, allowed, 0, 0)
+        return self.db.result(results)
+
+    def rebuildProfileStats(self):
+        return self.db.result(len(self.db.stats))
@@ -0,0 +1,158 @@
+"""
+Benchmark: per-profile stats with the old six queries
+(wins, losses, draws, home/away goals, streaks) over the match
+history vs. the profile_stats read of MatchData.getAggregateStats,
+and the batched getAggregateStatsMany for a lobby-sized group
+of profiles.
+
+Needs MySQLdb and an EMPTY scratch database created from
+sql/schema6.sql. It is seeded with users/profiles and
+the given number of matches (default: 100000) on first run.
+
+Usage: PYTHONPATH=lib python3 bench/stats_bench.py \\
+           host user password database [num-matches]
+"""
+
+import random
+import sys
+import time
+
+import MySQLdb
+from twisted.internet import defer
+
+from fiveserver import data6
+
+
+NUM_PROFILES = 1000
+BATCH_SIZE = 50
+ROUNDS = 200
+
+
+class SyncDbController:
+    """
+    Minimal stand-in for StorageController that runs the
+    queries synchronously: deferreds are already fired, so
+    the inlineCallbacks code runs without a reactor.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.queries = 0
+
+    def dbRead(self, key, sql, *args):
+        self.queries += 1
+        cursor = self.conn.cursor()
+        cursor.execute(sql, args)
+        return defer.succeed(cursor.fetchall())
+
+    def dbWriteInteraction(self, key, interaction, *args):
+        result = interaction(self.conn.cursor(), *args)
+        self.conn.commit()
+        return defer.succeed(result)
+
+
+def seed(conn, numMatches):
+    cursor = conn.cursor()
+    cursor.execute('SELECT count(*) FROM matches')
+    if cursor.fetchone()[0] >= numMatches:
+        return
+    print('seeding %d profiles and %d matches...' % (
+        NUM_PROFILES, numMatches))
+    for i in range(NUM_PROFILES):
+        cursor.execute(
+            'INSERT INTO users (username, serial, hash) '
+            'VALUES (%s, %s, %s)',
+            ('bench%d' % i, '%020d' % i, '%032d' % i))
+        cursor.execute(
+            'INSERT INTO profiles (user_id, name) VALUES (%s, %s)',
+            (cursor.lastrowid, 'bench%d' % i))
+        cursor.execute(
+            'INSERT INTO streaks (profile_id, wins, best) '
+            'VALUES (%s, %s, %s)',
+            (cursor.lastrowid, random.randint(0, 5), random.randint(5, 10)))
+    cursor.execute('SELECT id FROM profiles')
+    profileIds = [row[0] for row in cursor.fetchall()]
+    for i in range(numMatches):
+        cursor.execute(
+            'INSERT INTO matches (score_home, score_away, '
+            'team_id_home, team_id_away) VALUES (%s, %s, %s, %s)',
+            (random.randint(0, 5), random.randint(0, 5),
+             random.randint(0, 200), random.randint(0, 200)))
+        matchId = cursor.lastrowid
+        home, away = random.sample(profileIds, 2)
+        cursor.executemany(
+            'INSERT INTO matches_played (match_id, profile_id, home) '
+            'VALUES (%s, %s, %s)',
+            [(matchId, home, 1), (matchId, away, 0)])
+        if i % 10000 == 0:
+            conn.commit()
+    conn.commit()
+
+
+@defer.inlineCallbacks
+def oldStats(matchData, profileId):
+    wins = yield matchData.getWins(profileId)
+    losses = yield matchData.getLosses(profileId)
+    draws = yield matchData.getDraws(profileId)
+    scored_home, allowed_home = yield matchData.getGoalsHome(profileId)
+    scored_away, allowed_away = yield matchData.getGoalsAway(profileId)
+    streak, best = yield matchData.getStreaks(profileId)
+    defer.returnValue((wins, losses, draws,
+        scored_home + scored_away, allowed_home + allowed_away,
+        streak, best))
+
+
+def run(label, controller, func, profileGroups):
+    controller.queries = 0
+    t0 = time.perf_counter()
+    for group in profileGroups:
+        func(group)
+    elapsed = time.perf_counter() - t0
+    numProfiles = sum(len(group) for group in profileGroups)
+    print('%-28s %8.1f ms  %6.3f ms/profile  %d queries' % (
+        label, elapsed * 1000, elapsed * 1000 / numProfiles,
+        controller.queries))
+
+
+def main():
+    if len(sys.argv) < 5:
+        print(__doc__)
+        return 1
+    host, user, passwd, db = sys.argv[1:5]
+    numMatches = int(sys.argv[5]) if len(sys.argv) > 5 else 100000
+    conn = MySQLdb.connect(host=host, user=user, passwd=passwd, db=db)
+    seed(conn, numMatches)
+
+    controller = SyncDbController(conn)
+    matchData = data6.MatchData(controller)
+    t0 = time.perf_counter()
+    matchData.rebuildProfileStats()
+    print('rebuildProfileStats: %.1f ms' % (
+        (time.perf_counter() - t0) * 1000))
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM profiles')
+    profileIds = [row[0] for row in cursor.fetchall()]
+
+    # sanity check: both paths agree
+    for profileId in random.sample(profileIds, 10):
+        s = matchData.getAggregateStats(profileId).result
+        expected = oldStats(matchData, profileId).result
+        assert expected == (s.wins, s.losses, s.draws, s.goals_scored,
+            s.goals_allowed, s.streak_current, s.streak_best), profileId
+
+    singles = [[random.choice(profileIds)] for i in range(ROUNDS)]
+    batches = [random.sample(profileIds, BATCH_SIZE)
+               for i in range(ROUNDS // 10)]
+    run('six queries', controller,
+        lambda group: oldStats(matchData, group[0]), singles)
+    run('getAggregateStats', controller,
+        lambda group: matchData.getAggregateStats(group[0]), singles)
+    run('six queries x%d' % BATCH_SIZE, controller,
+        lambda group: [oldStats(matchData, p) for p in group], batches)
+    run('getAggregateStatsMany x%d' % BATCH_SIZE, controller,
+        lambda group: matchData.getAggregateStatsMany(group), batches)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
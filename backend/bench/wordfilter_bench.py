@@ -0,0 +1,89 @@
+"""
+Benchmark: the chat banned-word check done for every lobby chat
+message, with the word list compiled by makeChatFilter into a
+wordfilter.WordFilter, against the previous check of every word
+in turn against the decoded message.
+
+Usage: PYTHONPATH=lib python3 bench/wordfilter_bench.py [words] [messages]
+"""
+
+import random
+import string
+import sys
+import time
+
+from fiveserver.wordfilter import WordFilter
+
+
+SIZES = [10, 100, 1000, 5000]
+
+
+def anyIsBanned(words, message):
+    return any(word in message.decode('utf-8') for word in words)
+
+
+def makeWord(rng):
+    return ''.join(rng.choice(string.ascii_lowercase)
+                   for i in range(rng.randrange(4, 10)))
+
+
+def makeMessages(count, words, rng):
+    messages = []
+    for i in range(count):
+        text = ' '.join(makeWord(rng) for j in range(rng.randrange(3, 15)))
+        if i % 10 == 0:
+            text += ' ' + rng.choice(words)
+        messages.append(text[:126].encode('utf-8'))
+    return messages
+
+
+def timeIt(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    try: sizes = [int(sys.argv[1])]
+    except IndexError: sizes = SIZES
+    try: numMessages = int(sys.argv[2])
+    except IndexError: numMessages = 5000
+
+    checks = [
+        (['foo', 'foobar', 'bar'], b'xfoobx', True),
+        (['Ball'], b'BALLS', False),
+        (['über'], 'ÜBER'.encode('utf-8'), False),
+    ]
+    for words, message, expected in checks:
+        assert WordFilter(words).matches(message) == expected
+    assert WordFilter(['Ball'], ignoreCase=True).matches(b'BALLS')
+    assert WordFilter(['über'], ignoreCase=True).matches(
+        'x ÜBER'.encode('utf-8'))
+    assert not WordFilter(['ball'], wholeWords=True).matches(b'balls')
+    assert not WordFilter(['ni'], wholeWords=True).matches(
+        'el niño'.encode('utf-8'))
+    assert WordFilter(['ball', 'balls'], wholeWords=True).matches(b'balls!')
+    assert WordFilter(['a.b']).matches(b'xa.b') and \
+        not WordFilter(['a.b']).matches(b'axb')
+    assert not WordFilter([]).matches(b'anything')
+    assert not WordFilter(['']).matches(b'anything')
+
+    print('%8s %16s %16s %10s' % ('words', 'any() loop', 'filter', 'compile'))
+    for size in sizes:
+        rng = random.Random(size)
+        words = [makeWord(rng) for i in range(size)]
+        messages = makeMessages(numMessages, words, rng)
+        start = time.perf_counter()
+        wordFilter = WordFilter(words)
+        compileTime = (time.perf_counter() - start) * 1e3
+        for message in messages:
+            assert wordFilter.matches(message) == anyIsBanned(words, message)
+        print('%8d %13.2f us %13.2f us %7.1f ms' % (size,
+            timeIt(lambda m: anyIsBanned(words, m), messages),
+            timeIt(wordFilter.matches, messages), compileTime))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
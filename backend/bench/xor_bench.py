@@ -0,0 +1,44 @@
+"""
+Micro-benchmark: bulk XOR cipher vs. the old per-byte implementation.
+
+Usage: PYTHONPATH=lib python3 bench/xor_bench.py
+"""
+
+import operator
+import os
+import struct
+import sys
+import timeit
+
+from fiveserver import stream
+
+
+def xorDataPerByte(data, start=0):
+    """
+    Previous implementation, kept here as the reference.
+    """
+    bs = []
+    key_size = len(stream.XOR_KEY)
+    for i,c in enumerate(data):
+        bs.append(struct.pack('!B', operator.xor(
+            stream.XOR_KEY[(start+i) % key_size], c)
+        ))
+    return b''.join(bs)
+
+
+def main():
+    for size in [64, 1024, 64*1024]:
+        data = os.urandom(size)
+        for start in range(4):
+            assert stream.xorData(data, start) == xorDataPerByte(data, start)
+        number = max(1, 200000 // size)
+        old = timeit.timeit(
+            lambda: xorDataPerByte(data, 8), number=number) / number
+        new = timeit.timeit(
+            lambda: stream.xorData(data, 8), number=number*10) / (number*10)
+        print('%6d bytes: per-byte %10.2f us, bulk %8.2f us, x%.0f' % (
+            size, old*1e6, new*1e6, old/new))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Pretty-print or filter a binary packet capture
+written by the server (see PacketCapture in sixserver.yaml).
+
+Usage: PYTHONPATH=lib python3 capture_dump.py [options] capture-file
+
+    --id 0x4400[,0x4401]   only these packet ids
+    --conn N[,M]           only these connections
+    --dir send|recv        only one direction
+    --brief                header lines only, no hex dump
+"""
+
+import argparse
+import sys
+import time
+
+from fiveserver import capture
+from fiveserver.model.util import PacketFormatter
+
+
+def parseIds(value):
+    return set(int(x, 16) for x in value.split(','))
+
+
+def parseConns(value):
+    return set(int(x) for x in value.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pretty-print a fiveserver packet capture')
+    parser.add_argument('file')
+    parser.add_argument('--id', type=parseIds, dest='ids')
+    parser.add_argument('--conn', type=parseConns, dest='conns')
+    parser.add_argument('--dir', choices=['send', 'recv'])
+    parser.add_argument('--brief', action='store_true')
+    args = parser.parse_args()
+
+    direction = None
+    if args.dir is not None:
+        direction = {'send': capture.SEND, 'recv': capture.RECV}[args.dir]
+    with open(args.file, 'rb') as f:
+        try:
+            for timestamp, dir, conn, pkt in capture.readCapture(f):
+                if args.ids and pkt.header.id not in args.ids:
+                    continue
+                if args.conns and conn not in args.conns:
+                    continue
+                if direction is not None and dir != direction:
+                    continue
+                when = '%s.%03d' % (
+                    time.strftime('%Y-%m-%d %H:%M:%S',
+                        time.localtime(timestamp)),
+                    int(timestamp * 1000) % 1000)
+                if args.brief:
+                    print('%s [%s {%d}]: id=0x%04x, length=0x%x, '
+                          'count=%d' % (
+                        when, capture.DIRECTIONS[dir], conn,
+                        pkt.header.id, pkt.header.length,
+                        pkt.header.packet_count))
+                else:
+                    print('%s [%s {%d}]: %s' % (
+                        when, capture.DIRECTIONS[dir], conn,
+                        PacketFormatter.format(pkt)))
+        except ValueError as info:
+            print('ERROR: %s' % info)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,8 @@ from twisted.web import static, server, resource
 from twisted.internet import reactor, defer
 from twisted.words.xish import domish
 from xml.sax.saxutils import escape
-from fiveserver import log
+from fiveserver import log, handlerstats, outbound, watchdog, idle
+from fiveserver import floodcontrol
 from fiveserver.model.lobby import MatchState, Match, Match6, RoomState
 from fiveserver.model import util
 from Crypto.Cipher import Blowfish
@@ -153,6 +154,8 @@ class AdminRootResource(BaseXmlResource):
                 <banned href="/banned"/>\
                 <server-ip href="/server-ip"/>\
                 <processInfo href="/ps"/>\
+                <handlerStats href="/handlers"/>\
+                <reactorLag href="/lag"/>\
                 </adminService>' % (
                         XML_HEADER, 
                         self.config.VERSION,
@@ -179,7 +182,9 @@ class AdminRootResource(BaseXmlResource):
                 'onlineUsers': '/users/online',
                 'stats': '/stats',
                 'banned': '/banned',
-                'processInfo': '/ps'
+                'processInfo': '/ps',
+                'handlerStats': '/handlers',
+                'reactorLag': '/lag'
             }
         }
         return json.dumps(data).encode('utf-8')
@@ -610,7 +615,7 @@ class StatsResource(BaseXmlResource):
             if getattr(lobby, 'chatHistory', None):
                 try:
                     # Get last 10 messages
-                    recent_chat = lobby.chatHistory[-10:]
+                    recent_chat = lobby.getChatHistory()[-10:]
                     for msg in recent_chat:
                         if not msg: continue
                         
@@ -1226,6 +1231,17 @@ class RosterResource(BaseXmlResource):
 
 class ProcessInfoResource(BaseXmlResource):
 
+    def getBroadcastStats(self):
+        totals = dict()
+        for aLobby in self.config.getLobbies():
+            for key, value in aLobby.broadcastStats.items():
+                totals[key] = totals.get(key, 0) + value
+        totals['cpu'] = round(totals.get('cpu', 0.0), 3)
+        return totals
+
+    def getStatsCacheInfo(self):
+        return self.config.profileLogic.getStatsCacheInfo()
+
     def render_GET(self, request):
         def writeInfo(p, request):
             if p is None:
@@ -1255,6 +1271,21 @@ class ProcessInfoResource(BaseXmlResource):
                     p.get_memory_info()[0]/1024.0/1024)
             extra = procInfo.addElement('info')
             extra['cmdline'] = ' '.join(sys.argv)
+            broadcasts = procInfo.addElement('broadcasts')
+            for key, value in self.getBroadcastStats().items():
+                broadcasts[key] = str(value)
+            statsCache = procInfo.addElement('statsCache')
+            for key, value in self.getStatsCacheInfo().items():
+                statsCache[key] = str(value)
+            outboundQueues = procInfo.addElement('outbound')
+            for key, value in outbound.getStats().items():
+                outboundQueues[key] = str(value)
+            idleConnections = procInfo.addElement('idle')
+            for key, value in idle.getStats().items():
+                idleConnections[key] = str(value)
+            chatFlood = procInfo.addElement('chatFlood')
+            for key, value in floodcontrol.getStats().items():
+                chatFlood[key] = str(value)
             request.write(XML_HEADER.encode('utf-8'))
             request.write(procInfo.toXml().encode('utf-8'))
             request.write(procInfo.toXml().encode('utf-8'))
@@ -1291,7 +1322,12 @@ class ProcessInfoResource(BaseXmlResource):
                         'cpu': p.get_cpu_percent(),
                         'mem': p.get_memory_info()[0]/1024.0/1024
                     },
-                    'cmdline': ' '.join(sys.argv)
+                    'cmdline': ' '.join(sys.argv),
+                    'broadcasts': self.getBroadcastStats(),
+                    'statsCache': self.getStatsCacheInfo(),
+                    'outbound': outbound.getStats(),
+                    'idle': idle.getStats(),
+                    'chatFlood': floodcontrol.getStats(),
                 }
                 request.write(json.dumps(data).encode('utf-8'))
                 request.finish()
@@ -1321,6 +1357,96 @@ class ProcessInfoResource(BaseXmlResource):
         return server.NOT_DONE_YET
 
 
+class HandlerStatsResource(BaseXmlResource):
+    """
+    Per-packet-id handler call counts, CPU time and
+    latency percentiles (milliseconds). POST enabled=1/0
+    to switch the instrumentation, reset=1 to clear it.
+    """
+
+    def render_GET(self, request):
+        # JSON is rendered here rather than in render_JSON,
+        # so that it stays behind authentication
+        is_json = request.args.get(b'format') == [b'json'] or \
+                  b'application/json' in (request.getHeader(b'accept') or b'')
+        if is_json:
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({
+                'enabled': handlerstats.getEnabled(),
+                'handlers': handlerstats.getStats(),
+            }).encode('utf-8')
+        request.setHeader('Content-Type','text/xml')
+        handlers = domish.Element((None,'handlerStats'))
+        handlers['href'] = '/home'
+        handlers['enabled'] = str(handlerstats.getEnabled())
+        for stats in handlerstats.getStats():
+            handler = handlers.addElement('handler')
+            for key, value in stats.items():
+                handler[key] = str(value)
+        return ('%s%s' % (XML_HEADER, handlers.toXml())).encode('utf-8')
+
+    def render_POST(self, request):
+        try: enabledStr = request.args[b'enabled'][0].lower()
+        except KeyError: enabledStr = b''
+        if enabledStr in [b'0',b'false',b'no']:
+            handlerstats.setEnabled(False)
+        elif enabledStr in [b'1',b'true',b'yes']:
+            handlerstats.setEnabled(True)
+        try: resetStr = request.args[b'reset'][0].lower()
+        except KeyError: resetStr = b''
+        if resetStr in [b'1',b'true',b'yes']:
+            handlerstats.reset()
+        return self.render_GET(request)
+
+
+class ReactorLagResource(BaseXmlResource):
+    """
+    Reactor loop lag percentiles and histogram (milliseconds),
+    and the recent stalls with the stack that caused them.
+    POST reset=1 to clear them.
+    """
+
+    def render_GET(self, request):
+        stats = watchdog.getStats()
+        stalls = watchdog.getStalls()
+        # JSON is rendered here rather than in render_JSON,
+        # so that it stays behind authentication
+        is_json = request.args.get(b'format') == [b'json'] or \
+                  b'application/json' in (request.getHeader(b'accept') or b'')
+        if is_json:
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({
+                'enabled': stats is not None,
+                'lag': stats,
+                'stalls': stalls,
+            }).encode('utf-8')
+        request.setHeader('Content-Type','text/xml')
+        lag = domish.Element((None,'reactorLag'))
+        lag['href'] = '/home'
+        lag['enabled'] = str(stats is not None)
+        if stats is not None:
+            for key, value in stats.items():
+                if key != 'histogram':
+                    lag[key] = str(value)
+            for bound, count in stats['histogram']:
+                bucket = lag.addElement('bucket')
+                bucket['upTo'] = str(bound)
+                bucket['count'] = str(count)
+        for info in stalls:
+            stall = lag.addElement('stall')
+            stall['time'] = str(datetime.fromtimestamp(info['time']))
+            stall['duration'] = str(info['duration'])
+            stall.addContent(info['stack'])
+        return ('%s%s' % (XML_HEADER, lag.toXml())).encode('utf-8')
+
+    def render_POST(self, request):
+        try: resetStr = request.args[b'reset'][0].lower()
+        except KeyError: resetStr = b''
+        if resetStr in [b'1',b'true',b'yes'] and watchdog.getWatchdog():
+            watchdog.getWatchdog().reset()
+        return self.render_GET(request)
+
+
 class UserAccountResource(resource.Resource):
     isLeaf = True
 
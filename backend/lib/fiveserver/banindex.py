@@ -0,0 +1,92 @@
+"""
+Index of banned IP networks, for the checks done on every login
+service connection and registration request.
+"""
+
+from collections import OrderedDict
+import bisect
+import ipaddress
+import socket
+
+
+CACHE_SIZE = 4096
+
+
+def aggregate(networks, width):
+    """
+    Turn (net, bits) networks into sorted, disjoint
+    [start, end] address ranges: overlapping and adjacent
+    networks are merged. Returns (starts, ends) lists.
+    """
+    full = (1 << width) - 1
+    ranges = []
+    for net, bits in networks:
+        mask = full ^ (full >> bits)
+        ranges.append((net & mask, (net & mask) | (full ^ mask)))
+    ranges.sort()
+    starts, ends = [], []
+    for start, end in ranges:
+        if ends and start <= ends[-1] + 1:
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def _inRanges(starts, ends, ip):
+    i = bisect.bisect_right(starts, ip) - 1
+    return i >= 0 and ip <= ends[i]
+
+
+class BanIndex:
+    """
+    Banned networks as sorted address ranges, one list for IPv4
+    and one for IPv6: a lookup is a bisect, O(log n). IPv4-mapped
+    IPv6 addresses (::ffff:a.b.c.d) are checked as IPv4.
+    Recent verdicts are kept in an LRU cache. An index does not
+    change once built: a new banned list makes a new index.
+    """
+
+    def __init__(self, networks4=(), networks6=(), cacheSize=None):
+        self._starts4, self._ends4 = aggregate(networks4, 32)
+        self._starts6, self._ends6 = aggregate(networks6, 128)
+        if cacheSize is None:
+            cacheSize = CACHE_SIZE
+        self.cacheSize = cacheSize
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._starts4) + len(self._starts6)
+
+    def isBanned(self, ipAddress):
+        cache = self._cache
+        try:
+            verdict = cache[ipAddress]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(ipAddress)
+            return verdict
+        verdict = self._lookup(ipAddress)
+        if self.cacheSize > 0:
+            cache[ipAddress] = verdict
+            if len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+        return verdict
+
+    def _lookup(self, ipAddress):
+        try:
+            ip = int.from_bytes(socket.inet_aton(ipAddress), 'big')
+        except OSError:
+            try: address = ipaddress.ip_address(ipAddress)
+            except ValueError:
+                return False
+            if address.version == 4:
+                ip = int(address)
+            elif address.ipv4_mapped is not None:
+                ip = int(address.ipv4_mapped)
+            else:
+                return _inRanges(self._starts6, self._ends6, int(address))
+        return _inRanges(self._starts4, self._ends4, ip)
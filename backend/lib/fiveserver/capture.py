@@ -0,0 +1,174 @@
+"""
+Binary packet capture. When debug is on, sent and received
+packets are put as raw records into a bounded in-memory ring,
+which is flushed in batches to a capture file by a writer thread.
+No formatting happens on the reactor thread: use capture_dump.py
+to pretty-print or filter capture files offline.
+
+File format: MAGIC, then records of
+RECORD (timestamp, direction, connection, id, length, count)
+followed by length bytes of packet data.
+"""
+
+from collections import deque
+import os
+import struct
+import time
+
+from twisted.internet import reactor, task, threads, defer
+
+from fiveserver import log
+from fiveserver.model import packet
+
+
+MAGIC = b'FSCAP\x01'
+RECORD = struct.Struct('!dBIHHI')
+
+RECV, SEND = 0, 1
+DIRECTIONS = {RECV: 'RECV', SEND: 'SEND'}
+
+RING_SIZE = 50000
+FLUSH_INTERVAL = 1.0
+MAX_FILE_SIZE = 64 * 1024 * 1024
+
+
+class PacketCapture:
+    """
+    Bounded ring of captured packets plus its background writer.
+    When the writer falls behind, the oldest records are dropped.
+    """
+
+    def __init__(self, filename, ringSize=None, flushInterval=None,
+                 maxFileSize=None):
+        self.filename = filename
+        self.ringSize = ringSize or RING_SIZE
+        self.flushInterval = flushInterval or FLUSH_INTERVAL
+        self.maxFileSize = maxFileSize or MAX_FILE_SIZE
+        self._ring = deque(maxlen=self.ringSize)
+        self._writing = None
+        self._loop = None
+        self.stats = dict(records=0, dropped=0, written=0, bytes=0)
+
+    def record(self, direction, connection, packetId, count, data):
+        if len(self._ring) == self.ringSize:
+            self.stats['dropped'] += 1
+        self._ring.append(
+            (time.time(), direction, connection, packetId, count, data))
+        self.stats['records'] += 1
+
+    def start(self):
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self.flushInterval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Stop the periodic flushes and write out the rest of the
+        ring, after the write still in progress (if any), so that
+        records of the two never mix in the file. Returns a
+        Deferred that fires when all is written.
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        d = defer.Deferred()
+        d.addCallback(self._writeRest)
+        d.addErrback(self._writeError)
+        if self._writing is None:
+            d.callback(None)
+        else:
+            self._writing.addBoth(lambda result: d.callback(None))
+        return d
+
+    def _writeRest(self, result):
+        # the reactor is shutting down: written synchronously
+        batch = self._takeBatch()
+        if batch:
+            self._write(batch)
+
+    def _takeBatch(self):
+        batch = list(self._ring)
+        self._ring.clear()
+        return batch
+
+    def flush(self):
+        if self._writing is not None or not self._ring:
+            return
+        self._writing = threads.deferToThread(
+            self._write, self._takeBatch())
+        self._writing.addErrback(self._writeError)
+        self._writing.addBoth(self._writeDone)
+
+    def _writeDone(self, result):
+        self._writing = None
+
+    def _writeError(self, error):
+        log.msg('ERROR: packet capture write failed: %s' % error.value)
+
+    def _write(self, batch):
+        """
+        Runs in the writer thread
+        """
+        chunks = []
+        for timestamp, direction, connection, packetId, count, data in batch:
+            chunks.append(RECORD.pack(timestamp, direction, connection,
+                packetId, len(data), count))
+            chunks.append(data)
+        data = b''.join(chunks)
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if size + len(data) > self.maxFileSize and size > 0:
+            os.replace(self.filename, self.filename + '.1')
+            size = 0
+        with open(self.filename, 'ab') as f:
+            if size == 0:
+                f.write(MAGIC)
+            f.write(data)
+        self.stats['written'] += len(batch)
+        self.stats['bytes'] += len(data)
+
+
+_capture = None
+
+
+def getCapture():
+    return _capture
+
+
+def setCapture(filename, ringSize=None, flushInterval=None,
+               maxFileSize=None):
+    """
+    Create and start the global packet capture
+    """
+    global _capture
+    if _capture is not None:
+        _capture.stop()
+    _capture = PacketCapture(
+        filename, ringSize, flushInterval, maxFileSize)
+    _capture.start()
+    log.msg('SYSTEM: Packet capture goes to: %s' % filename)
+    return _capture
+
+
+def record(direction, connection, packetId, count, data):
+    if _capture is not None:
+        _capture.record(direction, connection, packetId, count, data)
+
+
+def readCapture(f):
+    """
+    Generate (timestamp, direction, connection, packet)
+    tuples from a capture file object
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a packet capture file')
+    while True:
+        head = f.read(RECORD.size)
+        if len(head) < RECORD.size:
+            return
+        (timestamp, direction, connection,
+         packetId, length, count) = RECORD.unpack(head)
+        data = f.read(length)
+        yield timestamp, direction, connection, packet.Packet(
+            packet.PacketHeader(packetId, length, count), data)
@@ -10,10 +10,11 @@ from datetime import datetime, timedelta
 import time
 import random
 import struct
-import socket
+import ipaddress
 
 from fiveserver.model import lobby, user
-from fiveserver import storagecontroller, errors, rating, log
+from fiveserver import storagecontroller, errors, rating, log, banindex
+from fiveserver import wordfilter, floodcontrol
 import yaml
 import os
 
@@ -254,6 +255,10 @@ class FiveServerConfig:
         # make banned-list structure for quick checks
         self.makeFastBannedList()
 
+        # compile chat banned-words filter
+        self.makeChatFilter()
+        self.makeChatFloodPolicy()
+
         # set up periodical rank-compute
         reactor.callLater(5, self.computeRanks)
 
@@ -276,17 +281,20 @@ class FiveServerConfig:
                 if player.lobbyConnection:
                     player.lobbyConnection.broadcastSystemChat(
                         aLobby, message)
-            # purge old chat messages
-            aLobby.purgeOldChat()
         # reschedule for next day change
         now = datetime.now()
         today = datetime(now.year, now.month, now.day)
         td = today + timedelta(days=1) - now
         reactor.callLater(td.seconds+1, self.systemDayChange)
 
-    def computeRanks(self):
+    def computeRanks(self, incremental=False):
         def _reschedule(result):
-            log.msg('NOTICE: Ranks successfully computed for all profiles.')
+            if incremental:
+                log.msg('NOTICE: Ranks successfully re-computed for '
+                        'changed points (%s profiles updated).' % result)
+            else:
+                log.msg('NOTICE: Ranks successfully computed for '
+                        'all profiles (%s profiles updated).' % result)
             try: days = int(
                 self.serverConfig.ComputeRanksInterval['days'])
             except: days = None
@@ -306,19 +314,43 @@ class FiveServerConfig:
             log.msg('Scheduling next rank-compute for: %s' % (
                 datetime.now() + td))
             seconds = td.days*24*60*60 + td.seconds
-            reactor.callLater(seconds, self.computeRanks)
-        d = self.profileData.computeRanks()
+            # after the initial full compute, only re-rank the band
+            # of points that changed, if so configured
+            reactor.callLater(seconds, self.computeRanks,
+                bool(self.serverConfig.get('ComputeRanksIncremental')))
+        d = self.profileData.computeRanks(incremental)
         d.addCallback(_reschedule)
         return d
 
     def makeFastBannedList(self):
-        self.fastBannedList = []
+        """
+        Compile the banned list into a new banindex.BanIndex.
+        IPv4 entries: a.b.c.d, a.b.c.d/bits or a partial address
+        (a.b, a.b.) whose given parts make the mask. IPv6 entries
+        (with a ':') are standard networks, like 2001:db8::/32.
+        """
+        networks4, networks6 = [], []
         for spec in self.bannedList.Banned:
+            if ':' in spec:
+                try: network = ipaddress.ip_network(spec, strict=False)
+                except ValueError:
+                    log.msg(
+                        'WARN: illegal spec in bannedList: '
+                        '%s (skipping it)' % spec)
+                    continue
+                mapped = network.network_address.ipv4_mapped
+                if mapped is not None and network.prefixlen >= 96:
+                    networks4.append(
+                        (int(mapped), network.prefixlen - 96))
+                else:
+                    networks6.append(
+                        (int(network.network_address), network.prefixlen))
+                continue
             parts = spec.split('/')
             if len(parts)==2:
                 try: net, bits = parts[0], int(parts[1])
                 except ValueError: net, bits = parts[0],0
-                if not bits>0:
+                if not 0<bits<=32:
                     log.msg(
                         'WARN: illegal spec in bannedList: '
                         '%s (skipping it)' % spec)
@@ -350,11 +382,37 @@ class FiveServerConfig:
             if bits == 0:
                 # determine mask based on net
                 bits = sum([8 for quad in quads if quad!=0])
-            mask = (2**int(bits)-1)<<(32-int(bits))
-            self.fastBannedList.append((net,mask))
-        # output for debugging
-        for net, mask in self.fastBannedList:
-            log.msg('%s, %s' % (hex(net),hex(mask)))
+            networks4.append((net, bits))
+        # swapped in at once: lookups never see a half-built index
+        self.bannedIndex = banindex.BanIndex(networks4, networks6)
+        log.msg('Banned list: %d entries, %d address ranges' % (
+            len(self.bannedList.Banned), len(self.bannedIndex)))
+
+    def makeChatFilter(self):
+        """
+        Compile Chat.bannedWords into a new wordfilter.WordFilter.
+        Must be called again after the Chat settings change.
+        Chat.ignoreCase and Chat.wholeWords (both false by
+        default) select case-insensitive and whole-word matching.
+        """
+        chat = self.serverConfig.get('Chat') or dict()
+        self.chatFilter = wordfilter.WordFilter(
+            chat.get('bannedWords') or [],
+            ignoreCase=bool(chat.get('ignoreCase', False)),
+            wholeWords=bool(chat.get('wholeWords', False)))
+        log.msg('Chat filter: %d banned words' % len(self.chatFilter))
+
+    def makeChatFloodPolicy(self):
+        """
+        Make the per-user chat limits from Chat.floodControl.
+        Must be called again after the Chat settings change.
+        """
+        chat = self.serverConfig.get('Chat') or dict()
+        self.chatFloodPolicy = floodcontrol.FloodPolicy.fromConfig(
+            chat.get('floodControl'))
+        log.msg('Chat flood control: %s' % ', '.join(
+            '%s %d/%0.1fs' % (kind, burst, rate) for kind, (burst, rate)
+            in sorted(self.chatFloodPolicy.limits.items())))
 
     def setIP(self, retryDelay=1, resetTime=True):
         def _setIP(result):
@@ -522,11 +580,13 @@ class FiveServerConfig:
         defer.returnValue(results[0])
 
     def isBanned(self, ipAddress):
-        for net, mask in self.fastBannedList:
-            ip = struct.unpack('!I',socket.inet_aton(ipAddress))[0]
-            if (net & mask) == (ip & mask):
-                return True
-        return False
+        return self.bannedIndex.isBanned(ipAddress)
+
+    def hasBannedWords(self, message):
+        return self.chatFilter.matches(message)
+
+    def allowChat(self, buckets, kind):
+        return self.chatFloodPolicy.allow(buckets, kind)
 
     def atCapacity(self):
         return self.serverConfig.MaxUsers <= self.getNumUsersOnline()
@@ -123,8 +123,13 @@ class UserData:
 
 class ProfileData:
 
+    # whether store() reports point changes through markPointsChanged,
+    # which is what makes incremental rank-computes possible
+    tracksPointsChanges = False
+
     def __init__(self, dbController):
         self.dbController = dbController
+        self._rankBand = None
 
     @defer.inlineCallbacks
     def get(self, id):
@@ -265,42 +270,72 @@ class ProfileData:
         print(results)
         defer.returnValue(results)
 
+    def markPointsChanged(self, *points):
+        """
+        Widen the band of points whose ranks are affected
+        by changes made since the last rank-compute
+        """
+        lo, hi = min(points), max(points)
+        if self._rankBand is not None:
+            lo = min(lo, self._rankBand[0])
+            hi = max(hi, self._rankBand[1])
+        self._rankBand = (lo, hi)
+
     @defer.inlineCallbacks
-    def computeRanks(self):
-        result = yield self.dbController.dbWriteInteraction(
-            0, self._computeRanksTxn)
+    def computeRanks(self, incremental=False):
+        """
+        Re-compute ranks of all profiles, or (incremental mode)
+        only of the profiles in the band of points that changed
+        since the last run. Returns number of updated profiles.
+        """
+        if not incremental or not self.tracksPointsChanges:
+            self._rankBand = None
+            result = yield self.dbController.dbWriteInteraction(
+                0, self._computeRanksTxn)
+            defer.returnValue(result)
+        band, self._rankBand = self._rankBand, None
+        if band is None:
+            defer.returnValue(0)
+        try:
+            result = yield self.dbController.dbWriteInteraction(
+                0, self._computeRanksBandTxn, band[0], band[1])
+        except:
+            # keep the band for the next attempt
+            self.markPointsChanged(*band)
+            raise
         defer.returnValue(result)
 
     def _computeRanksTxn(self, transaction):
-        rank, count, rank_range = 1, 1, 100
-        last_points = None
-        limit, offset = 50, 0
-        while True:
-            sql = ('SELECT id, points FROM profiles '
-                   'ORDER BY points DESC, seconds_played DESC '
-                   'LIMIT %s OFFSET %s')
-            params = [limit, offset]
-            transaction.execute(sql, params)
-            rows = transaction.fetchall()
-            for (id, points) in rows:
-                if last_points is not None:
-                    # check if rank needs to be lowered
-                    if last_points > points:
-                        rank = count
-                sql = ('UPDATE profiles SET `rank`=%s WHERE id=%s')
-                params = [rank, id]
-                transaction.execute(sql, params)
-                last_points = points
-                count += 1
-            if len(rows) < limit:
-                break
-            offset += limit
+        # one pass with a window function, one bulk update
+        # (rows whose rank does not change are left alone)
+        sql = ('UPDATE profiles p JOIN ('
+               'SELECT id, RANK() OVER (ORDER BY points DESC) AS new_rank '
+               'FROM profiles) ranked ON ranked.id=p.id '
+               'SET p.`rank`=ranked.new_rank '
+               'WHERE p.`rank`<>ranked.new_rank')
+        transaction.execute(sql)
+        return transaction.rowcount
+
+    def _computeRanksBandTxn(self, transaction, lo, hi):
+        # rank within the band, offset by everybody above it
+        sql = ('UPDATE profiles p JOIN ('
+               'SELECT id, RANK() OVER (ORDER BY points DESC) AS band_rank '
+               'FROM profiles WHERE points BETWEEN %s AND %s) ranked '
+               'ON ranked.id=p.id '
+               'JOIN (SELECT COUNT(*) AS above FROM profiles '
+               'WHERE points > %s) higher '
+               'SET p.`rank`=ranked.band_rank+higher.above '
+               'WHERE p.`rank`<>ranked.band_rank+higher.above')
+        transaction.execute(sql, (lo, hi, hi))
+        return transaction.rowcount
 
 
 class MatchData:
 
     def __init__(self, dbController):
         self.dbController = dbController
+        # callables notified with profile ids of stored matches
+        self.storeListeners = []
 
     @defer.inlineCallbacks
     def getGames(self, profileId):
@@ -365,6 +400,8 @@ class MatchData:
     def store(self, match):
         matchId = yield self.dbController.dbWriteInteraction(
             0, self._storeTxn, match)
+        for listener in self.storeListeners:
+            listener([match.home_profile.id, match.away_profile.id])
         defer.returnValue(matchId)
 
     def _storeTxn(self, transaction, match):
@@ -19,8 +19,12 @@ class ProfileData(data.ProfileData):
     of new fields: rating, comment
     """
 
-    def __init__(self, dbController):
+    def __init__(self, dbController, tracksPointsChanges=False):
         self.dbController = dbController
+        self._rankBand = None
+        # reading the old points costs a locking read on every
+        # store: only done for incremental rank-computes
+        self.tracksPointsChanges = tracksPointsChanges
 
     @defer.inlineCallbacks
     def get(self, id):
@@ -105,6 +109,26 @@ class ProfileData(data.ProfileData):
 
     @defer.inlineCallbacks
     def store(self, p):
+        oldPoints = yield self.dbController.dbWriteInteraction(
+            0, self._storeTxn, p)
+        if not self.tracksPointsChanges:
+            defer.returnValue(True)
+        # a new profile counts as coming up from 0 points. Even with
+        # unchanged points the profile itself is re-ranked, because
+        # the stored rank is the one it was loaded with.
+        if oldPoints is None:
+            oldPoints = 0
+        self.markPointsChanged(oldPoints, p.points)
+        defer.returnValue(True)
+
+    def _storeTxn(self, transaction, p):
+        oldPoints = None
+        if p.id is not None and self.tracksPointsChanges:
+            sql = 'SELECT points FROM profiles WHERE id=%s FOR UPDATE'
+            transaction.execute(sql, (p.id,))
+            rows = transaction.fetchall()
+            if rows:
+                oldPoints = rows[0][0]
         sql = ('INSERT INTO profiles (id,user_id,ordinal,name,'
                '`rank`,rating,points,disconnects,seconds_played,comment) '
                'VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) '
@@ -117,8 +141,8 @@ class ProfileData(data.ProfileData):
                   p.comment, p.userId, p.index, p.name, p.rank,
                   p.rating, p.points, p.disconnects, int(p.playTime.total_seconds()),
                   p.comment)
-        yield self.dbController.dbWrite(0, sql, *params)
-        defer.returnValue(True)
+        transaction.execute(sql, params)
+        return oldPoints
 
     @defer.inlineCallbacks
     def findByName(self, profileName):
@@ -149,8 +173,13 @@ class ProfileData(data.ProfileData):
 
 class MatchData:
 
+    # recent teams kept in profile_stats.last_teams
+    NUM_LAST_TEAMS = 5
+
     def __init__(self, dbController):
         self.dbController = dbController
+        # callables notified with profile ids of stored matches
+        self.storeListeners = []
 
     @defer.inlineCallbacks
     def getGames(self, profileId):
@@ -207,6 +236,168 @@ class MatchData:
         allowed = rows[0][1] or 0
         defer.returnValue((int(scored), int(allowed)))
 
+    @defer.inlineCallbacks
+    def getAggregateStats(self, profileId):
+        """
+        Wins, losses, draws, goals, streaks and last teams
+        of a profile in a single query. Returns a user.Stats object
+        """
+        results = yield self.getAggregateStatsMany([profileId])
+        defer.returnValue(results[profileId])
+
+    @defer.inlineCallbacks
+    def getAggregateStatsMany(self, profileIds):
+        """
+        Batched version of getAggregateStats: one primary-key
+        read of profile_stats for all given profiles. Profiles
+        without a profile_stats row (not backfilled yet) are
+        aggregated from the match history instead.
+        Returns a dict of profileId -> Stats
+        """
+        results = dict(
+            (profileId, user.Stats(profileId, 0, 0, 0, 0, 0, 0, 0, []))
+            for profileId in profileIds)
+        if not results:
+            defer.returnValue(results)
+        sql = ('SELECT ps.profile_id, ps.wins, ps.losses, ps.draws, '
+               'ps.goals_for, ps.goals_against, ps.last_teams, '
+               's.wins, s.best '
+               'FROM profile_stats ps '
+               'LEFT JOIN streaks s ON s.profile_id=ps.profile_id '
+               'WHERE ps.profile_id IN (%s)' % (
+                   ','.join(['%s'] * len(results))))
+        rows = yield self.dbController.dbRead(0, sql, *results.keys())
+        missing = set(results)
+        for row in rows:
+            (profileId, wins, losses, draws,
+             scored, allowed, lastTeams, streak, best) = row
+            teams = [int(team) for team in lastTeams.split(',') if team]
+            results[profileId] = user.Stats(
+                profileId, wins, losses, draws, scored, allowed,
+                streak or 0, best or 0, teams)
+            missing.discard(profileId)
+        if missing:
+            history = yield self.getHistoryStatsMany(missing)
+            results.update(history)
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def getHistoryStatsMany(self, profileIds):
+        """
+        Stats of the given profiles computed from matches_played:
+        one aggregate query for the counters, one for the last
+        teams. Returns a dict of profileId -> Stats
+        """
+        results = dict(
+            (profileId, user.Stats(profileId, 0, 0, 0, 0, 0, 0, 0, []))
+            for profileId in profileIds)
+        if not results:
+            defer.returnValue(results)
+        placeholders = ','.join(['%s'] * len(results))
+        sql = ('SELECT mp.profile_id, '
+               'SUM(CASE WHEN (mp.home=1 AND m.score_home>m.score_away) '
+               'OR (mp.home=0 AND m.score_home<m.score_away) '
+               'THEN 1 ELSE 0 END), '
+               'SUM(CASE WHEN (mp.home=1 AND m.score_home<m.score_away) '
+               'OR (mp.home=0 AND m.score_home>m.score_away) '
+               'THEN 1 ELSE 0 END), '
+               'SUM(CASE WHEN m.score_home=m.score_away '
+               'THEN 1 ELSE 0 END), '
+               'SUM(CASE WHEN mp.home=1 '
+               'THEN m.score_home ELSE m.score_away END), '
+               'SUM(CASE WHEN mp.home=1 '
+               'THEN m.score_away ELSE m.score_home END), '
+               's.wins, s.best '
+               'FROM matches_played mp '
+               'JOIN matches m ON m.id=mp.match_id '
+               'LEFT JOIN streaks s ON s.profile_id=mp.profile_id '
+               'WHERE mp.profile_id IN (%s) '
+               'GROUP BY mp.profile_id, s.wins, s.best' % placeholders)
+        rows = yield self.dbController.dbRead(0, sql, *results.keys())
+        for row in rows:
+            (profileId, wins, losses, draws,
+             scored, allowed, streak, best) = row
+            results[profileId] = user.Stats(
+                profileId, int(wins or 0), int(losses or 0),
+                int(draws or 0), int(scored or 0), int(allowed or 0),
+                streak or 0, best or 0, [])
+        sql = ('SELECT profile_id, team_id FROM ('
+               'SELECT mp.profile_id, '
+               'IF(mp.home, m.team_id_home, m.team_id_away) AS team_id, '
+               'ROW_NUMBER() OVER ('
+               'PARTITION BY mp.profile_id ORDER BY mp.match_id DESC) AS n '
+               'FROM matches_played mp '
+               'JOIN matches m ON m.id=mp.match_id '
+               'WHERE mp.profile_id IN (%s)) recent '
+               'WHERE n <= %%s ORDER BY profile_id, n' % placeholders)
+        args = list(results.keys()) + [self.NUM_LAST_TEAMS]
+        rows = yield self.dbController.dbRead(0, sql, *args)
+        for profileId, teamId in rows:
+            results[profileId].teams.append(teamId)
+        defer.returnValue(results)
+
+    def rebuildProfileStats(self):
+        """
+        Recompute profile_stats from the full match history.
+        One-shot backfill/repair: normally the table is kept
+        up to date by store()
+        """
+        return self.dbController.dbWriteInteraction(
+            0, self._rebuildProfileStatsTxn)
+
+    # profile_stats rows aggregated from the match history
+    HISTORY_TOTALS_SQL = (
+        'SELECT mp.profile_id, COUNT(*) AS games, '
+        'SUM(CASE WHEN (mp.home=1 AND m.score_home>m.score_away) '
+        'OR (mp.home=0 AND m.score_home<m.score_away) '
+        'THEN 1 ELSE 0 END) AS wins, '
+        'SUM(CASE WHEN m.score_home=m.score_away '
+        'THEN 1 ELSE 0 END) AS draws, '
+        'SUM(CASE WHEN (mp.home=1 AND m.score_home<m.score_away) '
+        'OR (mp.home=0 AND m.score_home>m.score_away) '
+        'THEN 1 ELSE 0 END) AS losses, '
+        'SUM(CASE WHEN mp.home=1 '
+        'THEN m.score_home ELSE m.score_away END) AS goals_for, '
+        'SUM(CASE WHEN mp.home=1 '
+        'THEN m.score_away ELSE m.score_home END) AS goals_against, '
+        'SUBSTRING_INDEX(GROUP_CONCAT('
+        'IF(mp.home, m.team_id_home, m.team_id_away) '
+        'ORDER BY mp.match_id DESC), \',\', %s) AS last_teams '
+        'FROM matches_played mp '
+        'JOIN matches m ON m.id=mp.match_id ')
+
+    def _rebuildProfileStatsTxn(self, transaction):
+        sql = ('INSERT INTO profile_stats (profile_id, games, wins, '
+               'draws, losses, goals_for, goals_against, last_teams) '
+               'SELECT * FROM (' + self.HISTORY_TOTALS_SQL +
+               'GROUP BY mp.profile_id) agg '
+               'ON DUPLICATE KEY UPDATE '
+               'games=agg.games, wins=agg.wins, draws=agg.draws, '
+               'losses=agg.losses, goals_for=agg.goals_for, '
+               'goals_against=agg.goals_against, '
+               'last_teams=agg.last_teams')
+        transaction.execute(sql, (self.NUM_LAST_TEAMS,))
+        transaction.execute('SELECT COUNT(*) FROM profile_stats')
+        return transaction.fetchall()[0][0]
+
+    def _seedProfileStatsTxn(self, transaction, profileIds):
+        """
+        Create the missing profile_stats rows of these profiles
+        from their match history, so that the increments of a
+        new match apply to complete totals (profiles that have
+        not been backfilled yet). A no-op for existing rows.
+        """
+        sql = ('INSERT INTO profile_stats (profile_id, games, wins, '
+               'draws, losses, goals_for, goals_against, last_teams) '
+               'SELECT * FROM (' + self.HISTORY_TOTALS_SQL +
+               'WHERE mp.profile_id IN (' +
+               ','.join(['%s'] * len(profileIds)) + ') AND NOT EXISTS ('
+               'SELECT 1 FROM profile_stats ps '
+               'WHERE ps.profile_id=mp.profile_id) '
+               'GROUP BY mp.profile_id) agg '
+               'ON DUPLICATE KEY UPDATE profile_id=agg.profile_id')
+        transaction.execute(sql, [self.NUM_LAST_TEAMS] + list(profileIds))
+
     @defer.inlineCallbacks
     def getStreaks(self, profileId):
         sql = ('SELECT wins, best FROM streaks '
@@ -238,28 +429,19 @@ class MatchData:
     def store(self, match):
         matchId = yield self.dbController.dbWriteInteraction(
             0, self._storeTxn, match)
+        home_players, away_players = self.getPlayers(match)
+        for listener in self.storeListeners:
+            listener([profile.id for profile in home_players + away_players])
         defer.returnValue(matchId)
 
-    def _storeTxn(self, transaction, match):
-        def _writeStreak(profile_id, win):
-            wins, best = 0, 0
-            sql = ('SELECT wins, best FROM streaks '
-                   'WHERE profile_id=%s')
-            transaction.execute(sql, (profile_id,))
-            data = transaction.fetchall()
-            if len(data)>0:
-                wins, best = data[0][0], data[0][1]
-            if win:
-                wins += 1
-                best = max(wins, best)
-            else:
-                wins = 0
-            sql = ('INSERT INTO streaks (profile_id, wins, best) '
-                   'VALUES (%s,%s,%s) ON DUPLICATE KEY UPDATE '
-                   'wins=%s, best=%s')
-            transaction.execute(sql, (
-                profile_id, wins, best, wins, best))
+    def getPlayers(self, match):
+        home_players = [match.teamSelection.home_captain]
+        home_players.extend(match.teamSelection.home_more_players)
+        away_players = [match.teamSelection.away_captain]
+        away_players.extend(match.teamSelection.away_more_players)
+        return home_players, away_players
 
+    def _storeTxn(self, transaction, match):
         # record match result
         sql = ('INSERT INTO matches '
                '(score_home, score_away, team_id_home, team_id_away) '
@@ -267,39 +449,58 @@ class MatchData:
         transaction.execute(sql, ( 
             match.score_home, match.score_away, 
             match.teamSelection.home_team_id, match.teamSelection.away_team_id))
-        transaction.execute('SELECT LAST_INSERT_ID()')
-        matchId = transaction.fetchall()[0][0]
+        matchId = transaction.lastrowid
+        # one row per participant: (profile_id, home, team_id,
+        # scored, allowed), in profile_id order, so that concurrent
+        # transactions lock the per-profile rows in the same order
+        home_players, away_players = self.getPlayers(match)
+        rows = [(profile.id, 1, match.teamSelection.home_team_id,
+                 match.score_home, match.score_away)
+                for profile in home_players]
+        rows.extend([(profile.id, 0, match.teamSelection.away_team_id,
+                      match.score_away, match.score_home)
+                     for profile in away_players])
+        rows.sort()
+        # complete totals first, before this match is in the history
+        self._seedProfileStatsTxn(
+            transaction, [row[0] for row in rows])
+        placeholders = ','.join(['(%s,%s,%s)'] * len(rows))
         # record players of the match
-        home_players = [match.teamSelection.home_captain]
-        home_players.extend(match.teamSelection.home_more_players)
-        away_players = [match.teamSelection.away_captain]
-        away_players.extend(match.teamSelection.away_more_players)
-        for profile in home_players:
-            sql = ('INSERT INTO matches_played (match_id, profile_id, home) '
-                   'VALUES (%s, %s, 1)')
-            transaction.execute(sql, (matchId, profile.id))
-        for profile in away_players:
-            sql = ('INSERT INTO matches_played (match_id, profile_id, home) '
-                   'VALUES (%s, %s, 0)')
-            transaction.execute(sql, (matchId, profile.id))
-        # update winning streaks
-        if match.score_home > match.score_away:
-            # home win
-            for profile in home_players:
-                _writeStreak(profile.id, True)
-            for profile in away_players:
-                _writeStreak(profile.id, False)
-        elif match.score_home < match.score_away:
-            # away win
-            for profile in home_players:
-                _writeStreak(profile.id, False)
-            for profile in away_players:
-                _writeStreak(profile.id, True)
-        else:
-            # draw
-            for profile in home_players:
-                _writeStreak(profile.id, False)
-            for profile in away_players:
-                _writeStreak(profile.id, False)
+        sql = ('INSERT INTO matches_played (match_id, profile_id, home) '
+               'VALUES %s' % placeholders)
+        params = []
+        for profile_id, home, team_id, scored, allowed in rows:
+            params.extend((matchId, profile_id, home))
+        transaction.execute(sql, params)
+        # update winning streaks: the inserted wins value is
+        # the win flag (assignments are applied left to right,
+        # so best sees the updated wins)
+        sql = ('INSERT INTO streaks (profile_id, wins, best) '
+               'VALUES %s ON DUPLICATE KEY UPDATE '
+               'wins=IF(VALUES(wins)>0, wins+1, 0), '
+               'best=GREATEST(best, wins)' % placeholders)
+        params = []
+        for profile_id, home, team_id, scored, allowed in rows:
+            win = int(scored > allowed)
+            params.extend((profile_id, win, win))
+        transaction.execute(sql, params)
+        # update per-profile totals
+        sql = ('INSERT INTO profile_stats (profile_id, games, wins, '
+               'draws, losses, goals_for, goals_against, last_teams) '
+               'VALUES %s ON DUPLICATE KEY UPDATE '
+               'games=games+1, wins=wins+VALUES(wins), '
+               'draws=draws+VALUES(draws), losses=losses+VALUES(losses), '
+               'goals_for=goals_for+VALUES(goals_for), '
+               'goals_against=goals_against+VALUES(goals_against), '
+               'last_teams=SUBSTRING_INDEX(CONCAT_WS(\',\', '
+               'VALUES(last_teams), NULLIF(last_teams, \'\')), '
+               '\',\', %%s)' % ','.join(
+                   ['(%s,1,%s,%s,%s,%s,%s,%s)'] * len(rows)))
+        params = []
+        for profile_id, home, team_id, scored, allowed in rows:
+            params.extend((profile_id, int(scored > allowed),
+                int(scored == allowed), int(scored < allowed),
+                scored, allowed, str(team_id)))
+        params.append(self.NUM_LAST_TEAMS)
+        transaction.execute(sql, params)
         return matchId
-
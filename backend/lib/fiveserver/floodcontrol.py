@@ -0,0 +1,91 @@
+"""
+Chat flood control. Every chat message is sent on to its whole
+audience (for lobby chat, one packet per lobby member), so the
+messages each user may send are limited by a token bucket, one per
+user and chat type: a user can send up to 'burst' messages at once,
+and then 'rate' messages per second. Messages over the limit are
+dropped.
+"""
+
+import time
+
+from fiveserver import log
+
+
+# chat type: (burst, rate in messages per second)
+CHAT_LIMITS = dict(
+    lobby=(5, 0.5),
+    room=(10, 2.0),
+    private=(5, 1.0),
+    match=(10, 2.0),
+    stadium=(10, 2.0))
+
+_stats = dict(allowed=0, dropped=0)
+
+
+def getStats():
+    return dict(_stats)
+
+
+class FloodPolicy:
+    """
+    Chat limits: a dict of chat type -> (burst, rate). Chat types
+    that are not in the dict are not limited. The buckets themselves
+    are dicts of chat type -> [tokens, timestamp], one per user.
+    """
+
+    def __init__(self, limits, clock=time.monotonic):
+        self.limits = dict(limits)
+        self.clock = clock
+
+    @classmethod
+    def fromConfig(cls, floodControl):
+        """
+        Policy from the Chat.floodControl setting: a dict of
+        chat type -> {burst: n, rate: n}. Types not given keep
+        their default limits, and a type set to false (or the
+        whole setting set to false) is not limited.
+        """
+        limits = dict(CHAT_LIMITS)
+        if floodControl is False:
+            limits.clear()
+        elif floodControl:
+            for kind, limit in floodControl.items():
+                if not limit:
+                    limits.pop(kind, None)
+                    continue
+                burst, rate = limits.get(kind, (1, 1.0))
+                try:
+                    burst = int(limit.get('burst', burst))
+                    rate = float(limit.get('rate', rate))
+                except (AttributeError, ValueError):
+                    log.msg('WARN: illegal Chat.floodControl setting '
+                            'for %s: %s (using defaults)' % (kind, limit))
+                    continue
+                limits[kind] = (max(burst, 1), max(rate, 0.0))
+        return cls(limits)
+
+    def allow(self, buckets, kind):
+        """
+        Take a token from the user's bucket for this chat type.
+        Returns False if there is none: the message must be dropped.
+        """
+        try:
+            burst, rate = self.limits[kind]
+        except KeyError:
+            return True
+        now = self.clock()
+        bucket = buckets.get(kind)
+        if bucket is None:
+            bucket = buckets[kind] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            _stats['allowed'] += 1
+            return True
+        _stats['dropped'] += 1
+        key = '%sDropped' % kind
+        _stats[key] = _stats.get(key, 0) + 1
+        return False
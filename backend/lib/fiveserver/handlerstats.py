@@ -0,0 +1,146 @@
+"""
+Per-packet-id handler instrumentation for PacketDispatcher:
+call counts, synchronous CPU time and deferred completion
+latency histograms, per service class and packet id.
+Disabled by default: then the only cost is the getEnabled() check.
+"""
+
+import bisect
+import time
+
+from twisted.internet import defer
+
+from fiveserver import log
+
+
+# latency histogram bucket upper bounds, in milliseconds:
+# 4 buckets per doubling, from 0.01ms up to ~40s
+BUCKETS = [0.01 * 2 ** (i / 4.0) for i in range(88)]
+
+_enabled = False
+_stats = dict()
+
+
+def getEnabled():
+    return _enabled
+
+
+def setEnabled(value):
+    global _enabled
+    _enabled = bool(value)
+    log.msg('SYSTEM: Handler stats are %s' % {
+        True:'ON', False:'OFF'}.get(_enabled))
+
+
+def reset():
+    _stats.clear()
+
+
+class Histogram:
+    """
+    Log-scale latency histogram (values in milliseconds)
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile
+        """
+        if self.total == 0:
+            return 0.0
+        rank = p / 100.0 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+
+class HandlerStats:
+    """
+    Numbers for one packet id of one service class
+    """
+
+    def __init__(self, service, packetId):
+        self.service = service
+        self.packetId = packetId
+        self.calls = 0
+        self.errors = 0
+        self.pending = 0
+        self.cpu = 0.0
+        self.latency = Histogram()
+
+    def done(self, result, started):
+        self.pending -= 1
+        self.latency.add((time.perf_counter() - started) * 1000.0)
+        return result
+
+    def failed(self, failure):
+        self.errors += 1
+        return failure
+
+    def toDict(self):
+        return {
+            'service': self.service,
+            'packetId': '0x%04x' % self.packetId,
+            'calls': self.calls,
+            'errors': self.errors,
+            'pending': self.pending,
+            'cpu': round(self.cpu, 6),
+            'cpuPerCall': round(self.cpu / self.calls, 6) if self.calls else 0,
+            'p50': round(self.latency.percentile(50), 3),
+            'p95': round(self.latency.percentile(95), 3),
+            'p99': round(self.latency.percentile(99), 3),
+            'max': round(self.latency.max, 3),
+        }
+
+
+def call(service, packetId, handler, pkt):
+    """
+    Call the handler and account for it. The latency of
+    a handler returning an unfired Deferred is measured
+    until the Deferred fires.
+    """
+    try:
+        stats = _stats[service, packetId]
+    except KeyError:
+        stats = _stats[service, packetId] = HandlerStats(service, packetId)
+    stats.calls += 1
+    started = time.perf_counter()
+    cpuStarted = time.process_time()
+    try:
+        result = handler(pkt)
+    except:
+        stats.errors += 1
+        raise
+    finally:
+        stats.cpu += time.process_time() - cpuStarted
+    if isinstance(result, defer.Deferred) and not result.called:
+        stats.pending += 1
+        result.addErrback(stats.failed)
+        result.addBoth(stats.done, started)
+    else:
+        stats.latency.add((time.perf_counter() - started) * 1000.0)
+    return result
+
+
+def getStats():
+    """
+    List of per-handler dicts, busiest (by CPU time) first
+    """
+    results = [stats.toDict() for stats in _stats.values()]
+    results.sort(key=lambda x: x['cpu'], reverse=True)
+    return results
@@ -0,0 +1,111 @@
+"""
+Idle-connection reaper. Clients send a heartbeat (0x0005) every few
+seconds, so a connection that has been silent for much longer is
+half-dead: its user would otherwise stay online, in its lobby and
+room, and keep getting broadcasts until TCP notices the loss.
+
+Connections are kept in a hashed timing wheel: one slot per tick,
+as many slots as ticks in the timeout (plus two). A received packet
+moves its connection to the slot that expires last (nothing to do
+if it is already there), and each tick only looks at the one slot
+that expires: every connection still in it has been silent for at
+least the timeout, and is dropped.
+"""
+
+import math
+
+from twisted.internet import reactor, task
+
+from fiveserver import log
+
+
+TICK = 1.0  # seconds
+
+_reaper = None
+
+
+class IdleReaper:
+    """
+    Timing wheel of connections (PacketReceiver instances)
+    """
+
+    def __init__(self, timeout, tick=None):
+        self.timeout = timeout
+        self.tick = tick or TICK
+        self.numSlots = int(math.ceil(timeout / self.tick)) + 2
+        self.slots = [set() for i in range(self.numSlots)]
+        self.position = 0
+        self._loop = None
+        self.stats = dict(tracked=0, reaped=0, ticks=0)
+
+    def start(self):
+        self._loop = task.LoopingCall(self.advance)
+        self._loop.start(self.tick, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def add(self, conn):
+        conn._idleSlot = None
+        self.stats['tracked'] += 1
+        self.touch(conn)
+
+    def touch(self, conn):
+        """
+        The connection has just shown signs of life
+        """
+        slot = (self.position - 1) % self.numSlots
+        if conn._idleSlot != slot:
+            if conn._idleSlot is not None:
+                self.slots[conn._idleSlot].discard(conn)
+            self.slots[slot].add(conn)
+            conn._idleSlot = slot
+
+    def remove(self, conn):
+        slot = getattr(conn, '_idleSlot', None)
+        if slot is not None:
+            self.slots[slot].discard(conn)
+            conn._idleSlot = None
+            self.stats['tracked'] -= 1
+
+    def advance(self):
+        self.position = (self.position + 1) % self.numSlots
+        self.stats['ticks'] += 1
+        expired = self.slots[self.position]
+        if not expired:
+            return
+        self.slots[self.position] = set()
+        for conn in expired:
+            conn._idleSlot = None
+            self.stats['tracked'] -= 1
+            self.stats['reaped'] += 1
+            log.msg('WARN: no packets from %s for %d seconds: '
+                    'dropping connection' % (
+                conn.transport.getPeer(), self.timeout))
+            conn.transport.abortConnection()
+
+
+def start(timeout, tick=None):
+    """
+    Drop connections that are silent for timeout seconds
+    """
+    global _reaper
+    if _reaper is not None:
+        return _reaper
+    _reaper = IdleReaper(timeout, tick)
+    reactor.callWhenRunning(_reaper.start)
+    log.msg('SYSTEM: Idle connections are dropped after '
+            '%d seconds' % timeout)
+    return _reaper
+
+
+def getReaper():
+    return _reaper
+
+
+def getStats():
+    if _reaper is None:
+        return dict(tracked=0, reaped=0, ticks=0)
+    return dict(_reaper.stats)
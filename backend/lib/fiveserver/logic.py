@@ -1,16 +1,33 @@
 from twisted.internet import defer
+from collections import OrderedDict
 from fiveserver.model import user
 from fiveserver import errors
 
 
+STATS_CACHE_SIZE = 2000
+
+
 class ProfileLogic:
     """
     Various logic related to a user profile.
     """
 
-    def __init__(self, matchData, profileData):
+    def __init__(self, matchData, profileData, statsCacheSize=None):
         self.matchData = matchData
         self.profileData = profileData
+        if statsCacheSize is None:
+            statsCacheSize = STATS_CACHE_SIZE
+        self.statsCacheSize = statsCacheSize
+        self._statsCache = OrderedDict()
+        # bumped on every invalidation, so that a load that was
+        # started before it does not put stale stats into the cache
+        self._statsGeneration = 0
+        self.statsCacheInfo = dict(
+            hits=0, misses=0, evictions=0, invalidations=0)
+        # drop cached stats of everybody who played a stored match
+        try: matchData.storeListeners.append(self.invalidateStats)
+        except AttributeError:
+            pass
 
     @defer.inlineCallbacks
     def getFullProfileInfoByName(self, profileName):
@@ -30,8 +47,74 @@ class ProfileLogic:
                 'profile not found for id: %s' % profileId)
         defer.returnValue((profiles[0], stats))
 
+    def invalidateStats(self, profileIds):
+        self._statsGeneration += 1
+        for profileId in profileIds:
+            if self._statsCache.pop(profileId, None) is not None:
+                self.statsCacheInfo['invalidations'] += 1
+
+    def getStatsCacheInfo(self):
+        info = dict(self.statsCacheInfo)
+        info['size'] = len(self._statsCache)
+        info['capacity'] = self.statsCacheSize
+        return info
+
+    def _cacheStats(self, profileId, stats):
+        self._statsCache[profileId] = stats
+        while len(self._statsCache) > self.statsCacheSize:
+            self._statsCache.popitem(last=False)
+            self.statsCacheInfo['evictions'] += 1
+
+    def _getCachedStats(self, profileId):
+        try:
+            stats = self._statsCache[profileId]
+        except KeyError:
+            self.statsCacheInfo['misses'] += 1
+            return None
+        self._statsCache.move_to_end(profileId)
+        self.statsCacheInfo['hits'] += 1
+        return stats
+
     @defer.inlineCallbacks
     def getStats(self, profileId):
+        stats = self._getCachedStats(profileId)
+        if stats is not None:
+            defer.returnValue(stats)
+        generation = self._statsGeneration
+        stats = yield self.loadStats(profileId)
+        if generation == self._statsGeneration and self.statsCacheSize > 0:
+            self._cacheStats(profileId, stats)
+        defer.returnValue(stats)
+
+    @defer.inlineCallbacks
+    def getStatsMany(self, profileIds):
+        """
+        Stats for several profiles at once: cache misses
+        are loaded together. Returns a dict of profileId -> Stats
+        """
+        results, missing = dict(), []
+        for profileId in profileIds:
+            stats = self._getCachedStats(profileId)
+            if stats is None:
+                missing.append(profileId)
+            else:
+                results[profileId] = stats
+        if missing:
+            generation = self._statsGeneration
+            loaded = yield self.loadStatsMany(missing)
+            if (generation == self._statsGeneration and
+                    self.statsCacheSize > 0):
+                for profileId, stats in loaded.items():
+                    self._cacheStats(profileId, stats)
+            results.update(loaded)
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def loadStats(self, profileId):
+        if hasattr(self.matchData, 'getAggregateStats'):
+            # single read of the per-profile totals
+            stats = yield self.matchData.getAggregateStats(profileId)
+            defer.returnValue(stats)
         # wins, losses, draws
         results = yield defer.DeferredList([
             self.matchData.getWins(profileId),
@@ -61,3 +144,12 @@ class ProfileLogic:
             current, best, teams)
         defer.returnValue(stats)
 
+    @defer.inlineCallbacks
+    def loadStatsMany(self, profileIds):
+        if not hasattr(self.matchData, 'getAggregateStatsMany'):
+            results = dict()
+            for profileId in profileIds:
+                results[profileId] = yield self.loadStats(profileId)
+            defer.returnValue(results)
+        results = yield self.matchData.getAggregateStatsMany(profileIds)
+        defer.returnValue(results)
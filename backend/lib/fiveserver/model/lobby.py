@@ -2,11 +2,13 @@
 Lobby and related classes
 """
 
+from collections import deque
 from datetime import datetime, timedelta
 import struct
 import random
+import time
 
-from fiveserver import log
+from fiveserver import log, stream
 from fiveserver.model import util, user
 
 
@@ -19,6 +21,17 @@ SYSTEM_PROFILE.id = 0
 
 SECONDS_CANCELLED_FORCED_PARTICIATION = 10
 
+
+def indexOf(items):
+    """
+    dict: item -> position of its first occurrence
+    """
+    index = dict()
+    for i, item in enumerate(items):
+        index.setdefault(item, i)
+    return index
+
+
 class ChatMessage:
 
     def __init__(self, fromProfile, text, toProfile=None, special=None):
@@ -27,6 +40,16 @@ class ChatMessage:
         self.toProfile = toProfile
         self.special = special
         self.timestamp  = datetime.now()
+        # profile ids that may see it (private message), or None
+        if toProfile is not None:
+            self.audience = frozenset([fromProfile.id, toProfile.id])
+        else:
+            self.audience = None
+        # 0x4402 chat history packet, encoded on first replay
+        self.historyFrame = None
+
+    def isVisibleTo(self, profileId):
+        return self.audience is None or profileId in self.audience
 
 
 class Lobby:
@@ -36,12 +59,21 @@ class Lobby:
         self.maxPlayers = maxPlayers
         self.players = dict()
         self.rooms = dict()
+        # secondary indexes, kept by enter/exit, addRoom/deleteRoom
+        self.playersByProfileId = dict()
+        self.roomsById = dict()
         self.typeStr = None
         self.typeCode = 0
         self.showMatches = True
         self.checkRosterHash = True
         self.roomOrdinal = 0
-        self.chatHistory = list()
+        # ring of the last MAX_MESSAGES messages, oldest first
+        self.chatHistory = deque(maxlen=MAX_MESSAGES)
+        self.broadcastStats = dict(
+            broadcasts=0, packets=0, bytes=0, cpu=0.0, mergedRoomUpdates=0)
+        self.dirtyRooms = dict()
+        # pending DelayedCall that flushes dirtyRooms
+        self.roomFlushCall = None
 
     def __bytes__(self):
         """
@@ -53,37 +85,90 @@ class Lobby:
                 struct.pack('!H',len(self.players)))
 
     def getPlayerByProfileId(self, id):
-        for usr in self.players.values():
-            if usr.profile.id == id:
-                return usr
-        return None
+        return self.playersByProfileId.get(id)
+
+    def broadcastData(self, packetId, data, players=None):
+        """
+        Send the same packet to every player in the lobby
+        (or to the given players). The payload is encoded once,
+        only header and md5 are redone for each connection.
+        """
+        if players is None:
+            players = self.players.values()
+        start = time.process_time()
+        frame = stream.BroadcastFrame(packetId, data)
+        numPackets, numBytes = 0, 0
+        for usr in players:
+            numBytes += usr.sendBroadcast(frame)
+            numPackets += 1
+        cpu = time.process_time() - start
+        stats = self.broadcastStats
+        stats['broadcasts'] += 1
+        stats['packets'] += numPackets
+        stats['bytes'] += numBytes
+        stats['cpu'] += cpu
+        if log.getDebug():
+            log.debug('BROADCAST 0x%04x to %d players: '
+                      '%d bytes, %0.3f ms CPU' % (
+                packetId, numPackets, numBytes, cpu*1000))
+
+    def markRoomDirty(self, room):
+        """
+        Remember that room info needs to be re-sent to the lobby.
+        Returns True if no flush is pending (i.e. one needs to be
+        scheduled, and kept in roomFlushCall)
+        """
+        if room.id in self.dirtyRooms:
+            self.broadcastStats['mergedRoomUpdates'] += 1
+        self.dirtyRooms[room.id] = room
+        return self.roomFlushCall is None
+
+    def unmarkRoomDirty(self, room):
+        """
+        Forget a queued update of the room (superseded, or the
+        room is gone). The pending flush is cancelled once there
+        is nothing left for it to send.
+        """
+        self.dirtyRooms.pop(room.id, None)
+        if not self.dirtyRooms and self.roomFlushCall is not None:
+            if self.roomFlushCall.active():
+                self.roomFlushCall.cancel()
+            self.roomFlushCall = None
+
+    def popDirtyRooms(self):
+        """
+        Return rooms marked dirty since the last flush,
+        skipping those that no longer exist in this lobby.
+        """
+        rooms = [room for room in self.dirtyRooms.values()
+                 if self.rooms.get(room.name) is room]
+        self.dirtyRooms = dict()
+        self.roomFlushCall = None
+        return rooms
 
     def addToChatHistory(self, chatMessage):
+        # a full ring drops its oldest message
         self.chatHistory.append(chatMessage)
-        # keep only last MAX_MESSAGES messages. We don't want this
-        # to be a memory leak
-        del self.chatHistory[0:-MAX_MESSAGES] 
 
-    def purgeOldChat(self):
+    def getChatHistory(self):
         """
-        This method should be called periodically to purge
-        old chat messages. (It may be that there is no 
-        conversation going on, and displaying messages that
-        are over week old is probably useless)
+        Chat messages, oldest first. Messages older than
+        MAX_AGE_DAYS are dropped here: it may be that there is
+        no conversation going on, and displaying messages that
+        are over a few days old is probably useless.
         """
-        newHistory = []
-        now = datetime.now()
-        maxAge = timedelta(days=MAX_AGE_DAYS)
-        for chatMessage in self.chatHistory:
-            age = now - chatMessage.timestamp 
-            if age < maxAge:
-                newHistory.append(chatMessage)
-        self.chatHistory = newHistory
+        history = self.chatHistory
+        if history:
+            oldest = datetime.now() - timedelta(days=MAX_AGE_DAYS)
+            while history and history[0].timestamp <= oldest:
+                history.popleft()
+        return list(history)
 
     def addRoom(self, room):
         self.roomOrdinal += 1
         room.id = self.roomOrdinal
         self.rooms[room.name] = room
+        self.roomsById[room.id] = room
 
     def renameRoom(self, room, newName):
         try:
@@ -98,6 +183,9 @@ class Lobby:
                 room.id, room.name))
 
     def deleteRoom(self, room):
+        self.unmarkRoomDirty(room)
+        if self.roomsById.get(room.id) is room:
+            del self.roomsById[room.id]
         try: 
             del self.rooms[room.name]
             log.msg('Room(id=%d, name=%s) destroyed' % (
@@ -109,28 +197,44 @@ class Lobby:
         return self.rooms[name]
 
     def getRoomById(self, roomId):
-        for room in self.rooms.values():
-            if room.id == roomId:
-                return room
-        return None
+        return self.roomsById.get(roomId)
         
     def isRoom(self, name):
         return self.rooms.has_key(name)
 
     def enter(self, usr, lobbyConnection):
         usr.lobbyConnection = lobbyConnection
+        replaced = self.players.get(usr.hash)
+        if replaced is not None:
+            self._unindexPlayer(replaced)
         self.players[usr.hash] = usr
+        self.playersByProfileId[usr.profile.id] = usr
 
     def exit(self, usr):
         try: del self.players[usr.hash]
         except KeyError:
             pass
+        else:
+            self._unindexPlayer(usr)
         usr.lobbyConnection = None
 
+    def _unindexPlayer(self, usr):
+        if self.playersByProfileId.get(usr.profile.id) is usr:
+            del self.playersByProfileId[usr.profile.id]
+
 
 class Room:
 
+    # attributes that make it into the room info sent to clients:
+    # assigning any of them makes a new version of the room
+    VERSIONED_ATTRIBUTES = frozenset([
+        'id', 'name', 'phase', 'match', 'owner', 'matchStarter',
+        'teamSelection', 'usePassword'])
+
     def __init__(self, lobby=None):
+        self.version = 0
+        # (version, payload) of the last serialized room info
+        self.serializedInfo = None
         self.id = 0
         self.name = 'unnamed'
         self.matchTime = 5
@@ -146,8 +250,24 @@ class Room:
         self.lobby = lobby
         
         self.participatingPlayers = list()
+        # user -> index in players / participatingPlayers
+        self.playerPositions = dict()
+        self.participantSlots = dict()
         self.phase = 1 # Phase of room and used in 0x4344
 
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        if name in self.VERSIONED_ATTRIBUTES:
+            self.__dict__['version'] += 1
+
+    def touch(self):
+        """
+        Make a new version of the room, after a change the room
+        does not see itself: match score, clock or state, team
+        selection, spectator status of a player
+        """
+        self.version += 1
+
     def __cmp__(self, another):
         if another is None:
             return -1
@@ -169,14 +289,18 @@ class Room:
         usr.state.timeCancelledParticipation = None
         if not self.players:
             self.owner = usr
+        self.playerPositions.setdefault(usr, len(self.players))
         self.players.append(usr)
+        self.touch()
 
     def exit(self, usr):
         usr.state.inRoom = 0
         usr.state.noLobbyChat = 0
         usr.state.room = None
+        self.touch()
         try: 
             exiting = self.players.pop(self.getPlayerPosition(usr))
+            self.playerPositions = indexOf(self.players)
         except ValueError:
             log.msg(
                 'WARN: player (%s) exiting, but was not in the room' % (
@@ -189,26 +313,30 @@ class Room:
                     self.setOwner(self.players[0])
 
     def getPlayerPosition(self, usr):
-        return self.players.index(usr)
+        try:
+            return self.playerPositions[usr]
+        except KeyError:
+            raise ValueError('player is not in the room')
         
     def getPlayerParticipate(self, usr):
-        try:
-            return self.participatingPlayers.index(usr)
-        except ValueError:
-            return 0xff
+        return self.participantSlots.get(usr, 0xff)
 
     def participate(self, usr):
         try:
-            return self.participatingPlayers.index(usr)
-        except ValueError:
+            return self.participantSlots[usr]
+        except KeyError:
+            slot = self.participantSlots[usr] = len(
+                self.participatingPlayers)
             self.participatingPlayers.append(usr)
-            return len(self.participatingPlayers)-1
+            self.touch()
+            return slot
 
     def cancelParticipation(self, usr):
         try:
-            self.participatingPlayers.pop(
-                self.participatingPlayers.index(usr))
-        except ValueError:
+            self.participatingPlayers.pop(self.participantSlots[usr])
+            self.participantSlots = indexOf(self.participatingPlayers)
+            self.touch()
+        except KeyError:
             log.msg(
                 'WARN player (%s) is cancelling participation, '
                 'but was not among participants.' % (
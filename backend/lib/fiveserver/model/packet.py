@@ -7,16 +7,65 @@ import hashlib
 import struct
 import binascii
 
-from fiveserver import errors
+from fiveserver import errors, log
+
+
+HEADER_STRUCT = struct.Struct('!HHI')
+
+# MD5 verification policies for incoming packets
+VERIFY_ALWAYS = 'always'
+VERIFY_SAMPLED = 'sampled'
+VERIFY_OFF = 'off'
+
+_verifyPolicy = VERIFY_ALWAYS
+_verifySampleEvery = 100
+_verifyCounter = 0
+
+
+def getVerifyPolicy():
+    return _verifyPolicy, _verifySampleEvery
+
+
+def setVerifyPolicy(policy, sampleEvery=None):
+    """
+    Set how incoming packets are checked against their md5:
+    always, sampled (every n-th packet) or off. Turning checks
+    off is only sensible for trusted LAN deployments.
+    """
+    global _verifyPolicy, _verifySampleEvery
+    if policy not in [VERIFY_ALWAYS, VERIFY_SAMPLED, VERIFY_OFF]:
+        raise errors.ConfigurationError(
+            'Unknown packet verification policy: %s' % policy)
+    if sampleEvery is not None:
+        if int(sampleEvery) < 1:
+            raise errors.ConfigurationError(
+                'sampleEvery must be >= 1')
+        _verifySampleEvery = int(sampleEvery)
+    _verifyPolicy = policy
+    log.msg('SYSTEM: Packet MD5 verification is %s' % {
+        VERIFY_ALWAYS: 'ON',
+        VERIFY_SAMPLED: 'SAMPLED (1 in %d)' % _verifySampleEvery,
+        VERIFY_OFF: 'OFF'}.get(_verifyPolicy))
+
+
+def _shouldVerify():
+    global _verifyCounter
+    if _verifyPolicy == VERIFY_ALWAYS:
+        return True
+    if _verifyPolicy == VERIFY_OFF:
+        return False
+    _verifyCounter += 1
+    if _verifyCounter >= _verifySampleEvery:
+        _verifyCounter = 0
+        return True
+    return False
 
 
 def makePacketHeader(bs):
     """
     Create a packet header from a string buffer
     """
-    id = struct.unpack('!H', bs[0:2])[0]
-    length = struct.unpack('!H', bs[2:4])[0]
-    packet_count = struct.unpack('!I',bs[4:8])[0]
+    id, length, packet_count = HEADER_STRUCT.unpack_from(bs)
     return PacketHeader(id, length, packet_count)
      
 
@@ -32,15 +81,7 @@ def makePacket(bs):
     Read bytes from the stream and create a packet
     """
     header = makePacketHeader(bs[0:8])
-    md5 = bs[8:24]
-    data = bs[24:24 + header.length]
-    p = Packet(header, data)
-    if p.md5.digest() != md5:
-        raise errors.NetworkError(
-            'Wrong MD5-checksum! (expected: %s, got: %s)' % (
-            p.md5.hexdigest(),
-            binascii.b2a_hex(md5)))
-    return p
+    return makeVerifiedPacket(header, bs[8:24], bs[24:24 + header.length])
 
 
 def readPacket(stream):
@@ -50,8 +91,17 @@ def readPacket(stream):
     header = readPacketHeader(stream)
     md5 = stream.read(16)
     data = stream.read(header.length)
+    return makeVerifiedPacket(header, md5, data)
+
+
+def makeVerifiedPacket(header, md5, data):
+    """
+    Create a packet from already split parts
+    and check it against the received md5
+    (subject to the verification policy)
+    """
     p = Packet(header, data)
-    if p.md5.digest() != md5:
+    if _shouldVerify() and p.md5.digest() != md5:
         raise errors.NetworkError(
             'Wrong MD5-checksum! (expected: %s, got: %s)' % (
             p.md5.hexdigest(),
@@ -69,10 +119,7 @@ class PacketHeader:
         self.packet_count = packet_count
 
     def __bytes__(self):
-        return b'%s%s%s' % (
-                struct.pack('!H',self.id),
-                struct.pack('!H',self.length),
-                struct.pack('!I',self.packet_count))
+        return HEADER_STRUCT.pack(self.id, self.length, self.packet_count)
 
     def __repr__(self):
         return 'PacketHeader(0x%04x,%d,%d)' % (
@@ -89,13 +136,36 @@ class Packet:
     def __init__(self, header, data):
         self.header = header
         self.data = data
-        self.md5 = hashlib.md5(b'%s%s' % (header,data))
-        
+        self._md5 = None
+
+    def getMd5(self):
+        """
+        Digest of header and data. Computed on first
+        access and cached from then on.
+        """
+        if self._md5 is None:
+            self._md5 = hashlib.md5(bytes(self.header))
+            self._md5.update(self.data)
+        return self._md5
+    md5 = property(getMd5)
+
+    def serialize(self):
+        """
+        Build header, md5 and data in one preallocated buffer
+        """
+        header = self.header
+        frame = bytearray(24 + len(self.data))
+        HEADER_STRUCT.pack_into(
+            frame, 0, header.id, header.length, header.packet_count)
+        if self._md5 is None:
+            self._md5 = hashlib.md5(frame[0:8])
+            self._md5.update(self.data)
+        frame[8:24] = self._md5.digest()
+        frame[24:] = self.data
+        return frame
+
     def __bytes__(self):
-        return b'%s%s%s' % (
-                self.header,
-                self.md5.digest(),
-                self.data)
+        return bytes(self.serialize())
 
     def __repr__(self): 
         return 'Packet(%s,md5="%s",data:"%s")' % (
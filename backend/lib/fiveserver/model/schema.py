@@ -0,0 +1,54 @@
+"""
+Declarative packet payload layouts. A layout is described once,
+as a list of (name, struct-format) fields, and compiled into
+a single struct.Struct that encodes and decodes the whole payload.
+"""
+
+from collections import namedtuple
+import struct
+
+
+class Schema:
+    """
+    Payload layout: (name, format) fields in network byte order.
+    Every field holds one value ('i', 'H', 'B', '16s', ...), except
+    padding ('3x'), which has no value and is written as zeros.
+    Byte-string fields are zero-padded or truncated to their size,
+    just like util.padWithZeros does.
+    """
+
+    def __init__(self, name, *fields):
+        self.name = name
+        self.fields = fields
+        self.names = [
+            fieldName for fieldName, fmt in fields if not fmt.endswith('x')]
+        self._struct = struct.Struct(
+            '!' + ''.join(fmt for fieldName, fmt in fields))
+        self.size = self._struct.size
+        self.record = namedtuple(name, self.names, rename=True)
+        # values in field order
+        self.pack = self._struct.pack
+
+    def unpack(self, data, offset=0):
+        """
+        Decode one record. Extra trailing bytes are ignored,
+        a short payload raises struct.error.
+        """
+        return self.record._make(self._struct.unpack_from(data, offset))
+
+    def unpackValues(self, data, offset=0):
+        """
+        Decode into a plain tuple of values in field order
+        (cheaper than unpack(), for hot paths)
+        """
+        return self._struct.unpack_from(data, offset)
+
+    def repeat(self, count):
+        """
+        Fields of count consecutive records, to be used
+        as part of a larger layout
+        """
+        return self.fields * count
+
+    def __repr__(self):
+        return 'Schema(%s, %d bytes)' % (self.name, self.size)
@@ -62,6 +62,14 @@ class User:
         else:
             self.lobbyConnection.sendData(packetId, data)
 
+    def sendBroadcast(self, frame):
+        if self.lobbyConnection is None:
+            log.msg(
+                'WARN: Cannot send data to user {%s}: '
+                'no lobby connection' % self.hash)
+            return 0
+        return self.lobbyConnection.sendBroadcast(frame)
+
     def getProfileById(self, profileId):
         for i, profile in enumerate(self.profiles):
             if profile.id == profileId:
@@ -21,6 +21,12 @@ def padWithZeros(s, total):
     return ns
 
 
+def toBytes(s):
+    if isinstance(s, str):
+        return s.encode('utf-8', 'replace')
+    return s
+
+
 def toUnicode(s):
     if isinstance(s, str):
         return s
@@ -0,0 +1,161 @@
+"""
+Outbound backpressure. Every connection has an OutboundQueue,
+registered with its transport as a streaming producer. While the
+transport's send buffer is full (the client does not read fast
+enough), packets are held in the queue instead: they only get their
+packet count and encoding when they are actually written.
+Queued updates that are superseded by a newer one (room info,
+player info) are dropped, so that only the latest version is sent.
+A connection whose queue grows past the byte limit is dropped.
+"""
+
+from collections import deque
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+from fiveserver import log
+
+
+MAX_QUEUE_BYTES = 256 * 1024
+
+_maxQueueBytes = MAX_QUEUE_BYTES
+_stats = dict(
+    queued=0,      # packets that went through a queue
+    superseded=0,  # queued updates replaced by a newer one
+    dropped=0,     # packets discarded with an overflowing connection
+    overflows=0,   # connections dropped for exceeding the limit
+    pauses=0,      # times a transport paused us
+    packets=0,     # packets waiting in all queues right now
+    bytes=0,       # bytes waiting in all queues right now
+    maxBytes=0)    # largest single queue seen, in bytes
+
+
+def getMaxQueueBytes():
+    return _maxQueueBytes
+
+
+def setMaxQueueBytes(value):
+    global _maxQueueBytes
+    _maxQueueBytes = int(value or MAX_QUEUE_BYTES)
+    log.msg('SYSTEM: Outbound queue limit is %d bytes' % _maxQueueBytes)
+
+
+def getStats():
+    return dict(_stats)
+
+
+@implementer(IPushProducer)
+class OutboundQueue:
+    """
+    Packets of one connection waiting for its transport.
+    Entries are [key, packetId, data, frame] lists: frame is a
+    stream.BroadcastFrame or None. A superseded entry is blanked
+    in place (its packetId set to None) and the newer one goes to
+    the back, so the latest version is never sent ahead of a packet
+    queued before it.
+    """
+
+    def __init__(self, protocol, supersedable=()):
+        self.protocol = protocol
+        self.supersedable = supersedable
+        self.paused = False
+        self.closed = False
+        self.entries = deque()
+        self.keyed = dict()
+        self.numPackets = 0
+        self.numBytes = 0
+
+    def isHolding(self):
+        """
+        True if packets must go through the queue
+        """
+        return self.paused or self.numPackets > 0
+
+    def put(self, packetId, data, frame=None):
+        """
+        Queue a packet. Returns False if the connection
+        went over the limit and should be dropped.
+        """
+        if self.closed:
+            _stats['dropped'] += 1
+            return True
+        size = len(data) + 24
+        key = None
+        if packetId in self.supersedable:
+            key = (packetId, data[:4])
+            old = self.keyed.get(key)
+            if old is not None:
+                self._remove(old)
+                old[1:] = [None, b'', None]
+                _stats['superseded'] += 1
+        entries = self.entries
+        if len(entries) > 2 * self.numPackets + 64:
+            # mostly blanked entries: drop them
+            self.entries = entries = deque(
+                entry for entry in entries if entry[1] is not None)
+        entry = [key, packetId, data, frame]
+        entries.append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+        self.numPackets += 1
+        self.numBytes += size
+        _stats['queued'] += 1
+        _stats['packets'] += 1
+        _stats['bytes'] += size
+        if self.numBytes > _stats['maxBytes']:
+            _stats['maxBytes'] = self.numBytes
+        if self.numBytes > _maxQueueBytes:
+            _stats['overflows'] += 1
+            return False
+        return True
+
+    def pop(self):
+        """
+        Oldest live entry: (packetId, data, frame) or None
+        """
+        entries = self.entries
+        while entries:
+            entry = entries.popleft()
+            if entry[1] is None:
+                continue
+            if entry[0] is not None:
+                del self.keyed[entry[0]]
+            self._remove(entry)
+            return entry[1:]
+        return None
+
+    def _remove(self, entry):
+        size = len(entry[2]) + 24
+        self.numPackets -= 1
+        self.numBytes -= size
+        _stats['packets'] -= 1
+        _stats['bytes'] -= size
+
+    def clear(self):
+        """
+        Discard everything, and accept nothing from now on
+        """
+        _stats['dropped'] += self.numPackets
+        _stats['packets'] -= self.numPackets
+        _stats['bytes'] -= self.numBytes
+        self.entries.clear()
+        self.keyed.clear()
+        self.numPackets = 0
+        self.numBytes = 0
+        self.closed = True
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused = True
+            _stats['pauses'] += 1
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.closed:
+            self.protocol.drainOutbound()
+
+    def stopProducing(self):
+        self.clear()
@@ -3,11 +3,25 @@ Protocol implementations for PES5/PES6 packet server.
 """
 
 from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.internet import reactor, task
+from contextlib import contextmanager
 import time
 
 from fiveserver.model import packet
 from fiveserver.model.util import PacketFormatter
-from fiveserver import log, stream, errors
+from fiveserver import log, stream, errors, handlerstats, capture, outbound
+from fiveserver import idle
+
+
+def handles(*packetIds):
+    """
+    Decorator marking a PacketDispatcher method as
+    the handler of the given packet ids.
+    """
+    def decorate(method):
+        method.packetIds = getattr(method, 'packetIds', ()) + packetIds
+        return method
+    return decorate
 
 
 def isSameGame(factory, userA, userB):
@@ -29,6 +43,11 @@ class PacketReceiver(Protocol):
     Base class for packet-receiving protocols
     """
 
+    # updates that a newer packet with the same id and the
+    # same first 4 bytes (room id, profile id) makes obsolete:
+    # only the latest one is sent to a client that lags behind
+    SUPERSEDED_UPDATES = frozenset()
+
     def packetReceived(self, pkt):
         """
         Override this.
@@ -37,53 +56,197 @@ class PacketReceiver(Protocol):
 
     def connectionMade(self):
         #print dir(self)
-        self._recvd = b""
+        self._framer = stream.PacketFramer()
         self._count = 1
+        # outgoing packets held back while corked: runs of
+        # serialized frames still to be XOR-ed, and ready chunks
+        self._corkDepth = 0
+        self._plainFrames = []
+        self._corkedData = []
+        self._outbound = outbound.OutboundQueue(
+            self, self.SUPERSEDED_UPDATES)
+        self.transport.registerProducer(self._outbound, True)
+        self._idle = idle.getReaper()
+        if self._idle is not None:
+            self._idle.add(self)
 
     def connectionLost(self, reason):
         log.msg('Connection lost: %s' % reason.getErrorMessage())
+        if self._idle is not None:
+            self._idle.remove(self)
 
     def dataReceived(self, data):
-        self._recvd += data
-        while len(self._recvd) >= 8:
-            hdr = packet.makePacketHeader(stream.xorData(self._recvd[:8], 0))
-            if len(self._recvd) < hdr.length + 24:
-                break
-            pkt = packet.makePacket(
-                stream.xorData(self._recvd[:hdr.length + 24], 8))
-            self._recvd = self._recvd[hdr.length + 24:]
-            self._packetReceived(pkt)
+        # responses to all packets of this read go out together
+        self.cork()
+        try:
+            for pkt in self._framer.feed(data):
+                self._packetReceived(pkt)
+        finally:
+            self.uncork()
+
+    def cork(self):
+        """
+        Hold back outgoing packets until the matching uncork().
+        They then go out in a single transport write, with
+        the XOR of consecutive packets done in one go.
+        """
+        self._corkDepth += 1
+
+    def uncork(self):
+        self._corkDepth -= 1
+        if self._corkDepth == 0:
+            self.flush()
+
+    @contextmanager
+    def corked(self):
+        self.cork()
+        try:
+            yield
+        finally:
+            self.uncork()
+
+    def flush(self):
+        """
+        Write out packets held back by cork()
+        """
+        if self._plainFrames:
+            self._corkedData.append(stream.xorFrames(self._plainFrames))
+            self._plainFrames = []
+        if self._corkedData:
+            data = b''.join(self._corkedData)
+            self._corkedData = []
+            self.transport.write(data)
+
+    def writeFrame(self, frame):
+        """
+        Write a serialized (not yet XOR-ed) frame
+        """
+        if self._corkDepth:
+            self._plainFrames.append(frame)
+        else:
+            self.transport.write(stream.xorData(frame, 0))
 
     def send(self, pkt):
         #log.msg('sending: %s' % repr(pkt))
+        if self._outbound.isHolding():
+            self.holdPacket(pkt.header.id, pkt.data)
+            return
+        self._send(pkt)
+
+    def _send(self, pkt):
+        if self.factory.serverConfig.Debug:
+            self.debugPacket(capture.SEND, pkt)
+        self.writeFrame(pkt.serialize())
+        self._count += 1
+
+    def sendBroadcast(self, frame):
+        """
+        Send a pre-encoded stream.BroadcastFrame.
+        Returns number of bytes written (0 if it was queued).
+        """
+        if self._outbound.isHolding():
+            self.holdPacket(frame.id, frame.data, frame)
+            return 0
+        return self._sendBroadcast(frame)
+
+    def _sendBroadcast(self, frame):
         if self.factory.serverConfig.Debug:
-            try:
-                username = self._user.profile.name
-            except AttributeError:
-                username = ''
-            log.debug('[SEND {%s}]: %s' % (
-                username, PacketFormatter.format(pkt)))
-        self.transport.write(stream.xorData(bytes(pkt),0))
+            self.debugPacket(capture.SEND, frame.makePacket(self._count))
+        data = frame.frameFor(self._count)
+        if self._corkDepth:
+            # already XOR-ed: keep it in order after pending frames
+            if self._plainFrames:
+                self._corkedData.append(
+                    stream.xorFrames(self._plainFrames))
+                self._plainFrames = []
+            self._corkedData.append(data)
+        else:
+            self.transport.write(data)
         self._count += 1
+        return len(data)
+
+    def holdPacket(self, packetId, data, frame=None):
+        """
+        Queue a packet until the transport wants more data.
+        A client that lets its queue grow over the limit
+        gets disconnected.
+        """
+        if not self._outbound.put(packetId, data, frame):
+            log.msg('WARN: outbound queue over %d bytes: '
+                    'dropping connection from %s' % (
+                outbound.getMaxQueueBytes(), self.transport.getPeer()))
+            self._outbound.clear()
+            self.transport.abortConnection()
+
+    def drainOutbound(self):
+        """
+        Write out queued packets (with their packet counts assigned
+        now), until the transport pauses us again or none are left.
+        """
+        queue = self._outbound
+        while not queue.paused:
+            entry = queue.pop()
+            if entry is None:
+                break
+            packetId, data, frame = entry
+            if frame is None:
+                self._send(packet.Packet(
+                    packet.PacketHeader(packetId, len(data), self._count),
+                    data))
+            else:
+                self._sendBroadcast(frame)
+
+    def debugPacket(self, direction, pkt):
+        """
+        Put the packet into the capture ring. Without a configured
+        capture, fall back to (slow) formatted debug logging.
+        """
+        if capture.getCapture() is not None:
+            capture.record(direction,
+                getattr(self.transport, 'sessionno', 0),
+                pkt.header.id, pkt.header.packet_count, pkt.data)
+            return
+        try:
+            username = self._user.profile.name
+        except AttributeError:
+            username = ''
+        log.debug('[%s {%s}]: %s' % (
+            capture.DIRECTIONS[direction], username,
+            PacketFormatter.format(pkt)))
 
     def sleep(self, result, seconds):
+        """
+        Blocks the whole reactor (every connection) for the
+        given seconds. Use delay() instead.
+        """
         time.sleep(seconds)
 
-    def _packetReceived(self, pkt):
-        if self.factory.serverConfig.Debug:
-            try:
-                username = self._user.profile.name
-            except AttributeError:
-                username = ''            
-            log.debug('[RECV {%s}]: %s' % (
-                username, PacketFormatter.format(pkt)))
+    def delay(self, result, seconds):
+        """
+        Non-blocking sleep(): as a Deferred callback, holds back
+        the rest of the callback chain for the given seconds,
+        passing the result on.
+        """
+        return task.deferLater(reactor, seconds, lambda: result)
 
+    def _packetReceived(self, pkt):
+        if self._idle is not None:
+            self._idle.touch(self)
         # handle heartbeat packet here, since it's the same
-        # across all types of servers
+        # across all types of servers. Fast path: echoed back
+        # without going through debug formatting
         if pkt.header.id == 0x0005:
-            pkt.header.packet_count = self._count
-            self.send(pkt)
+            if self._outbound.isHolding():
+                # slow reader: queued behind the packets held back
+                self.sendData(0x0005, pkt.data)
+                return
+            self.writeFrame(packet.Packet(
+                packet.PacketHeader(0x0005, len(pkt.data), self._count),
+                pkt.data).serialize())
+            self._count += 1
             return
+        if self.factory.serverConfig.Debug:
+            self.debugPacket(capture.RECV, pkt)
         # let subclasses handle it
         self.packetReceived(pkt)
 
@@ -116,30 +279,42 @@ class PacketDispatcher(PacketReceiver):
     """
     Base class for dispatcher-type services.
     Packet ID is examined and corresponding handler method
-    is called to take care of it.
+    is called to take care of it. Handler methods are marked
+    with the @handles decorator; the packet-id table is built
+    once per class (subclasses override by method name or by
+    marking another method for the same packet id).
     """
 
+    @classmethod
+    def getDispatchTable(cls):
+        try:
+            return cls.__dict__['_dispatchTable']
+        except KeyError:
+            pass
+        table = dict()
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                for packetId in getattr(value, 'packetIds', ()):
+                    table[packetId] = name
+        # resolve names, so that overriding methods are used
+        cls._dispatchTable = dict(
+            (packetId, getattr(cls, name))
+            for packetId, name in table.items())
+        return cls._dispatchTable
+
     def connectionMade(self):
         PacketReceiver.connectionMade(self)
-        self._handlers = dict()
-        self.register()
-
-    def addHandler(self, packet_id, handler):
-        self._handlers[packet_id] = handler
-
-    def register(self):
-        """
-        Override this. Child classes should
-        register their unique handlers for various
-        packets by calling addHandler method
-        """
-        raise errors.NotImplementedError 
+        self._handlers = self.getDispatchTable()
 
     def packetReceived(self, pkt):
         handler = self._handlers.get(pkt.header.id)
-        if handler is not None:
-            return handler(pkt)
-        return self.defaultHandler(pkt)
+        if handler is None:
+            return self.defaultHandler(pkt)
+        if handlerstats.getEnabled():
+            return handlerstats.call(
+                self.__class__.__name__, pkt.header.id,
+                handler.__get__(self), pkt)
+        return handler(self, pkt)
 
     def defaultHandler(self, pkt):
         """
@@ -15,14 +15,23 @@ import time
 import re
 import zlib
 
-from fiveserver.model import packet, user, lobby, util
+from fiveserver.model import packet, user, lobby, util, schema
 from fiveserver.model.util import PacketFormatter
 from fiveserver import log, stream, errors
-from fiveserver.protocol import PacketDispatcher, isSameGame
+from fiveserver.protocol import PacketDispatcher, isSameGame, handles
 
 
 CHAT_HISTORY_DELAY = 3  # seconds
 
+# 0x4202: lobby selection, with the client's addresses
+LOBBY_SELECT = schema.Schema('LobbySelect',
+    ('lobbyId', 'B'),
+    ('ip1', '16s'),
+    ('udpPort1', 'H'),
+    ('ip2', '16s'),
+    ('udpPort2', 'H'),
+    ('someField', 'H'))
+
 
 class NewsProtocol(PacketDispatcher):
 
@@ -47,11 +56,7 @@ class NewsProtocol(PacketDispatcher):
     def _send(self, result, pkt):
         return self.send(pkt)
 
-    def register(self):
-        self.addHandler(0x2008, self.getNews_2008)
-        self.addHandler(0x2005, self.getServerList_2005)
-        self.addHandler(0x2006, self.getTime_2006)
-
+    @handles(0x2008)
     def getNews_2008(self, pkt):
         self.sendZeros(0x2009,4)
         # checked banned list
@@ -117,6 +122,7 @@ class NewsProtocol(PacketDispatcher):
             self.sendData(0x200a,data)
         self.sendZeros(0x200b,0)
 
+    @handles(0x2005)
     def getServerList_2005(self, pkt):
         myport = self.transport.getHost().port
         gameName = None
@@ -152,6 +158,7 @@ class NewsProtocol(PacketDispatcher):
         self.sendData(0x2003,data)
         self.sendZeros(0x2004,4)
 
+    @handles(0x2006)
     def getTime_2006(self, pkt):
         data = struct.pack('!I',int(time.time()))
         self.sendData(0x2007,data)
@@ -192,6 +199,18 @@ class LoginService(PacketDispatcher):
                 user.Stats(0, 0, 0, 0, 0, 0, 0, 0))
         defer.returnValue(stats)
 
+    @defer.inlineCallbacks
+    def getStatsMany(self, profileIds):
+        if self.factory.serverConfig.ShowStats:
+            results = yield self.factory.profileLogic.getStatsMany(
+                profileIds)
+        else:
+            results = yield defer.succeed(dict(
+                (profileId, user.Stats(0, 0, 0, 0, 0, 0, 0, 0))
+                for profileId in profileIds))
+        defer.returnValue(results)
+
+    @handles(0x3001)
     def do_3001(self, pkt):
         self.send(
             packet.Packet(packet.PacketHeader(
@@ -215,6 +234,7 @@ class LoginService(PacketDispatcher):
     def getRosterHash(self, pkt_data):
         return pkt_data[48:64]
 
+    @handles(0x3003)
     @defer.inlineCallbacks
     def authenticate_3003(self, pkt):
         cipher = Blowfish.new(binascii.a2b_hex(self.factory.cipherKey), Blowfish.MODE_ECB)
@@ -264,6 +284,7 @@ class LoginService(PacketDispatcher):
         p.id = profile.id
         return p
 
+    @handles(0x3010)
     @defer.inlineCallbacks
     def getProfiles_3010(self, pkt):
         if self.factory.serverConfig.ShowStats:
@@ -293,6 +314,7 @@ class LoginService(PacketDispatcher):
         self.sendData(0x3012, data)
         defer.returnValue(None)
 
+    @handles(0x3020)
     @defer.inlineCallbacks
     def createProfile_3020(self, pkt):
         profileIndex = struct.unpack('!B',pkt.data[0:1])[0]  # 0-2
@@ -311,6 +333,7 @@ class LoginService(PacketDispatcher):
             self.sendZeros(0x3022,4)
         defer.returnValue(None)
 
+    @handles(0x3030)
     @defer.inlineCallbacks
     def deleteProfile_3030(self, pkt):
         profileIndex = struct.unpack('!B', pkt.data[0:1])[0]
@@ -322,11 +345,13 @@ class LoginService(PacketDispatcher):
         self.sendZeros(0x3032,4)
         defer.returnValue(None)
 
+    @handles(0x3060)
     def do_3060(self, pkt):
         #self.sendZeros(0x3062,14)
         #self.sendData(0x3062,'\0\0\0\0')
         self.sendData(0x3062,b'\0')
 
+    @handles(0x3040)
     def selectProfile_3040(self, pkt):
         id = struct.unpack('!i',pkt.data[0:4])[0]
         index, self._user.profile = self._user.getProfileById(id)
@@ -338,12 +363,15 @@ class LoginService(PacketDispatcher):
                 self._user.profile.name, 16) + b'\0'*(0x18e-20)
             self.sendData(0x3042, data)
 
+    @handles(0x3050)
     def do_3050(self, pkt):
         self.sendZeros(0x3052,0x47)
 
+    @handles(0x3070)
     def getMatchResults_3070(self, pkt):
         self.sendZeros(0x3072,4)
 
+    @handles(0x308a)
     @defer.inlineCallbacks
     def askForSettings_308a(self, pkt):
         if not self.factory.isStoreSettingsEnabled():
@@ -368,6 +396,7 @@ class LoginService(PacketDispatcher):
                 self.sendZeros(0x3089, 0)
         defer.returnValue(None)
 
+    @handles(0x3087)
     @defer.inlineCallbacks
     def do_3087(self, pkt):
         # also sent at 'Exit match series'
@@ -419,6 +448,7 @@ class LoginService(PacketDispatcher):
         yield defer.succeed(None)
         defer.returnValue(None)
 
+    @handles(0x3088)
     def do_3088(self, pkt):
         if pkt.data[2] == b'\3':
             # update settings
@@ -429,6 +459,7 @@ class LoginService(PacketDispatcher):
             settings2 = zlib.compress(pkt.data)
             self._user.profile.settings.settings2 = settings2
 
+    @handles(0x3089)
     @defer.inlineCallbacks
     def do_3089(self, pkt):
         self.sendZeros(0x308b,4)
@@ -438,16 +469,20 @@ class LoginService(PacketDispatcher):
                 self._user.profile.id, self._user.profile.settings)
         defer.returnValue(None)
 
+    @handles(0x3090)
     def do_3090(self, pkt):
         self.sendZeros(0x3091,4)
 
+    @handles(0x3100)
     def do_3100(self, pkt):
         self.sendZeros(0x3101,4)
 
+    @handles(0x3120)
     def do_3120(self, pkt):
         self.sendZeros(0x3121,4)
         self.sendZeros(0x3123,0)
 
+    @handles(0x0003)
     def disconnect_0003(self, pkt):
         # disconnect (no reply needed)
         self.factory.userOffline(self._user)
@@ -455,25 +490,6 @@ class LoginService(PacketDispatcher):
     def defaultHandler(self, pkt):
         self.sendZeros(pkt.header.id+1,4)
 
-    def register(self):
-        self.addHandler(0x3001, self.do_3001)
-        self.addHandler(0x3003, self.authenticate_3003)
-        self.addHandler(0x3010, self.getProfiles_3010)
-        self.addHandler(0x3020, self.createProfile_3020)
-        self.addHandler(0x3030, self.deleteProfile_3030)
-        self.addHandler(0x3040, self.selectProfile_3040)
-        self.addHandler(0x3050, self.do_3050)
-        self.addHandler(0x3060, self.do_3060)
-        self.addHandler(0x3070, self.getMatchResults_3070)
-        self.addHandler(0x308a, self.askForSettings_308a)
-        self.addHandler(0x3087, self.do_3087)
-        self.addHandler(0x3088, self.do_3088)
-        self.addHandler(0x3089, self.do_3089)
-        self.addHandler(0x3090, self.do_3090)
-        self.addHandler(0x3100, self.do_3100)
-        self.addHandler(0x3120, self.do_3120)
-        self.addHandler(0x0003, self.disconnect_0003)
-
 
 class LoginServicePES5(LoginService):
     """
@@ -654,6 +670,7 @@ class NetworkMenuService(LoginService):
             b'randomInt':struct.pack('!i', 0),
             b'pad1':b'\0'*50})
 
+    @handles(0x4100)
     @defer.inlineCallbacks
     def do_4100(self, pkt):
         profileIndex = struct.unpack('!B',pkt.data[0:1])[0]
@@ -677,6 +694,7 @@ class NetworkMenuService(LoginService):
             self.sendZeros(0x4103,0)
         defer.returnValue(None)
 
+    @handles(0x4102)
     @defer.inlineCallbacks
     def getProfile_4102(self, pkt):
         profileId = struct.unpack('!i', pkt.data[0:4])[0]
@@ -690,6 +708,7 @@ class NetworkMenuService(LoginService):
             self.sendZeros(0x4103,0)
         defer.returnValue(None)
 
+    @handles(0x4200)
     def getLobbies_4200(self, pkt):
         self._user.gameVersion = struct.unpack('!B',pkt.data[0:1])[0]
         data = b'%s%s' % (
@@ -697,25 +716,41 @@ class NetworkMenuService(LoginService):
             b''.join([bytes(x) for x in self.factory.getLobbies()]))
         self.sendData(0x4201, data)
 
+    def formatChatHistoryEntry(self, chatMessage):
+        """
+        0x4402 payload replaying a chat history message
+        """
+        if chatMessage.toProfile is not None:
+            special = chatMessage.special
+        else:
+            special = b'\0\0\0\0'
+        return b'%s%s%s%s%s' % (
+                b'\0',
+                special,
+                struct.pack('!i', chatMessage.fromProfile.id),
+                util.padWithZeros(chatMessage.fromProfile.name,16),
+                chatMessage.text.encode('utf-8')[:126]+b'\0\0')
+
+    def getChatHistoryFrame(self, chatMessage):
+        frame = chatMessage.historyFrame
+        if frame is None:
+            frame = chatMessage.historyFrame = stream.BroadcastFrame(
+                0x4402, self.formatChatHistoryEntry(chatMessage))
+        return frame
+
     def sendChatHistory(self, aLobby, who):
+        """
+        Replay the lobby chat history to a player who has just
+        entered: every message is encoded once for all of them,
+        and the whole history goes out as a single write.
+        """
         if aLobby is None or who is None:
             return
-        for chatMessage in list(aLobby.chatHistory):
-            chatType = b'\0'
-            if chatMessage.toProfile is not None:
-                if who.profile.id not in [
-                    chatMessage.fromProfile.id, chatMessage.toProfile.id]:
-                    continue
-                special = chatMessage.special
-            else:
-                special = b'\0\0\0\0'
-            data = b'%s%s%s%s%s' % (
-                    chatType,
-                    special,
-                    struct.pack('!i', chatMessage.fromProfile.id),
-                    util.padWithZeros(chatMessage.fromProfile.name,16),
-                    chatMessage.text.encode('utf-8')[:126]+b'\0\0')
-            who.sendData(0x4402, data)
+        profileId = who.profile.id
+        with self.corked():
+            for chatMessage in aLobby.getChatHistory():
+                if chatMessage.isVisibleTo(profileId):
+                    who.sendBroadcast(self.getChatHistoryFrame(chatMessage))
 
     def broadcastSystemChat(self, aLobby, text):
         chatMessage = lobby.ChatMessage(lobby.SYSTEM_PROFILE, text)
@@ -729,18 +764,20 @@ class NetworkMenuService(LoginService):
             usr.sendData(0x4402, data)
         aLobby.addToChatHistory(chatMessage)
 
+    @handles(0x4202)
     @defer.inlineCallbacks
     def selectLobby_4202(self, pkt):
+        selection = LOBBY_SELECT.unpack(pkt.data)
         self._user.state = user.UserState()
-        self._user.state.lobbyId = struct.unpack('!B',pkt.data[0:1])[0]
+        self._user.state.lobbyId = selection.lobbyId
         # Use observed IP instead of client-reported IP (which is often private LAN IP)
         # This fixes "No Signal" issues by allowing NAT traversal via public IP
         real_ip = self.transport.getPeer().host
         self._user.state.ip1 = util.padWithZeros(real_ip, 16)
-        self._user.state.ip2 = pkt.data[19:35]
-        self._user.state.udpPort1 = struct.unpack('!H',pkt.data[17:19])[0]
-        self._user.state.udpPort2 = struct.unpack('!H',pkt.data[35:37])[0]
-        self._user.state.someField = struct.unpack('!H',pkt.data[37:39])[0]
+        self._user.state.ip2 = selection.ip2
+        self._user.state.udpPort1 = selection.udpPort1
+        self._user.state.udpPort2 = selection.udpPort2
+        self._user.state.someField = selection.someField
         self._user.state.inRoom = 0
         self._user.state.noLobbyChat = 0
         self._user.state.room = None
@@ -764,6 +801,7 @@ class NetworkMenuService(LoginService):
         reactor.callLater(
             CHAT_HISTORY_DELAY, self.sendChatHistory, thisLobby, self._user)
 
+    @handles(0x4210)
     def getUserList_4210(self, pkt):
         self.sendZeros(0x4211,4)
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -776,6 +814,7 @@ class NetworkMenuService(LoginService):
             self.sendData(0x4212,data)
         self.sendZeros(0x4213,4)
 
+    @handles(0x4300)
     def getRoomList_4300(self, pkt):
         self.sendZeros(0x4301,4)
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -793,14 +832,17 @@ class NetworkMenuService(LoginService):
             self.sendData(0x4302, data)
         self.sendZeros(0x4303,4)
 
+    @handles(0x3080)
     def do_3080(self, pkt):
         self.sendZeros(0x3082,4)
         self.sendZeros(0x3086,0)
 
+    @handles(0x4580)
     def getFriends_4580(self, pkt):
         self.sendZeros(0x4581,4)
         self.sendZeros(0x4583,4)
 
+    @handles(0x4110)
     @defer.inlineCallbacks
     def setFavouriteTeam_4110(self, pkt):
         self._user.profile.favTeam = struct.unpack('!H', pkt.data[0:2])[0]
@@ -808,6 +850,7 @@ class NetworkMenuService(LoginService):
         self.sendZeros(0x4112,4)
         defer.returnValue(None)
 
+    @handles(0x4114)
     @defer.inlineCallbacks
     def setFavouritePlayer_4114(self, pkt):
         self._user.profile.favPlayer = struct.unpack('!i', pkt.data[0:4])[0]
@@ -815,16 +858,19 @@ class NetworkMenuService(LoginService):
         self.sendZeros(0x4116,4)
         defer.returnValue(None)
 
+    @handles(0x4600)
     def searchPlayers_4600(self, pkt):
         name = util.stripZeros(pkt.data[1:17])
         log.msg('Searching for player: %s' % name)
         self.sendZeros(0x4601,4)
         self.sendZeros(0x4603,4)
 
+    @handles(0x4780)
     def getInboxMessages_4780(self, pkt):
         self.sendZeros(0x4781,4)
         self.sendZeros(0x4783,4)
 
+    @handles(0x4a00)
     def quickMatchSearch_4a00(self, pkt):
         self.sendData(0x4a01,b'\0\0\0\1')  # "no results"
         try: thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -840,6 +886,7 @@ class NetworkMenuService(LoginService):
             for usr in thisLobby.players.values():
                 usr.sendData(0x4221,struct.pack('!i',self._user.profile.id))
 
+    @handles(0x0003)
     def disconnect_0003(self, pkt):
         try: thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         except IndexError:
@@ -856,23 +903,6 @@ class NetworkMenuService(LoginService):
             for usr in thisLobby.players.values():
                 usr.sendData(0x4221,struct.pack('!i',self._user.profile.id))
  
-    def register(self):
-        LoginService.register(self) # also handle all parent packets
-        self.addHandler(0x4100, self.do_4100)
-        self.addHandler(0x4102, self.getProfile_4102)
-        self.addHandler(0x4200, self.getLobbies_4200)
-        self.addHandler(0x4202, self.selectLobby_4202)
-        self.addHandler(0x4210, self.getUserList_4210)
-        self.addHandler(0x4300, self.getRoomList_4300)
-        self.addHandler(0x3080, self.do_3080)
-        self.addHandler(0x4580, self.getFriends_4580)
-        self.addHandler(0x4110, self.setFavouriteTeam_4110)
-        self.addHandler(0x4114, self.setFavouritePlayer_4114)
-        self.addHandler(0x4600, self.searchPlayers_4600)
-        self.addHandler(0x4780, self.getInboxMessages_4780)
-        self.addHandler(0x4a00, self.quickMatchSearch_4a00)
-        self.addHandler(0x0003, self.disconnect_0003)
-
 
 class MainService(NetworkMenuService):
     """
@@ -880,6 +910,22 @@ class MainService(NetworkMenuService):
     and other important statistics.
     """
 
+    # room info, player info
+    SUPERSEDED_UPDATES = frozenset([0x4306, 0x4222])
+
+    # chat types, for flood control
+    CHAT_TYPES = {
+        b'\x00\x01': 'lobby',
+        b'\x01\x02': 'room',
+        b'\x00\x02': 'private',
+    }
+
+    def connectionMade(self):
+        # chat flood-control buckets of this user
+        self._chatBuckets = dict()
+        NetworkMenuService.connectionMade(self)
+
+    @handles(0x4310)
     def createRoom_4310(self, pkt):
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         roomName = util.stripZeros(pkt.data[0:32])
@@ -919,6 +965,7 @@ class MainService(NetworkMenuService):
             usr.sendData(0x4222,data)
         self.sendZeros(0x4311,4)
 
+    @handles(0x432a)
     def exitRoom_432a(self, pkt):
         if self._user.state.inRoom == 0:
             log.msg('WARN: user not in a room.')
@@ -969,6 +1016,7 @@ class MainService(NetworkMenuService):
                     CHAT_HISTORY_DELAY, self.sendChatHistory,
                     thisLobby, self._user)
  
+    @handles(0x4364)
     def setMatchTime_4364(self, pkt):
         matchTime = struct.unpack('!B',pkt.data[0:1])[0] * 5
         log.debug('Match time: %d' % matchTime)
@@ -993,6 +1041,7 @@ class MainService(NetworkMenuService):
                 usr.sendData(0x4306,data)
         self.sendZeros(0x4365,4)
 
+    @handles(0x4366)
     def selectTeam_4366(self, pkt):
         team = struct.unpack('!H', pkt.data[0:2])[0]
         log.msg('Team selected: %d' % team)
@@ -1011,6 +1060,7 @@ class MainService(NetworkMenuService):
                 room.match.away_team_id, room.match.away_profile.name))
         self.sendData(0x4367,b'\0\0\0\1')
 
+    @handles(0x4368)
     def goalScored_4368(self, pkt):
         room = self._user.state.room
         if pkt.data[0] == 0:
@@ -1027,6 +1077,7 @@ class MainService(NetworkMenuService):
             room.match.score_home, room.match.score_away))
         self.sendData(0x4369,b'\0\0\0\0')
 
+    @handles(0x4370)
     def matchExit_4370(self, pkt):
         #log.msg('[4370-RECV]: %s' % PacketFormatter.format(pkt))
         room = self._user.state.room
@@ -1038,12 +1089,15 @@ class MainService(NetworkMenuService):
                 room.match.away_exit = exitType
         self.sendData(0x4371,b'\0\0\0\0')
 
+    @handles(0x4400)
     def chat_4400(self, pkt):
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         chatType = pkt.data[0:2]
+        if not self.factory.configuration.allowChat(
+                self._chatBuckets, self.CHAT_TYPES.get(chatType)):
+            return
         message = util.stripZeros(pkt.data[10:])
-        if any(word in message.decode('utf-8')
-               for word in self.factory.serverConfig.Chat['bannedWords']):
+        if self.factory.configuration.hasBannedWords(message):
             message = b'[%s]' % self.factory.serverConfig.Chat['warningMessage'].encode('utf-8')
         data = b'%s%s%s%s%s' % (
                 chatType[0:1],
@@ -1083,6 +1137,7 @@ class MainService(NetworkMenuService):
                     'WARN: user with profile id = '
                     '%d not found.' % profileId)
 
+    @handles(0x4b00)
     def ping_4b00(self, pkt):
         profileId = struct.unpack('!i', pkt.data[0:4])[0]
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -1130,6 +1185,7 @@ class MainService(NetworkMenuService):
             return aInfo.rosterHash == bInfo.rosterHash
         return True
 
+    @handles(0x4325)
     def cancelChallenge_4325(self, pkt):
         if self._user.state.inRoom == 0:
             log.msg('WARN: user not in a room.')
@@ -1170,6 +1226,7 @@ class MainService(NetworkMenuService):
                     usr.sendData(0x4305,data)
                 thisLobby.deleteRoom(room)
 
+    @handles(0x4320)
     @defer.inlineCallbacks
     def challenge_4320(self, pkt):
         roomId = struct.unpack('!i',pkt.data[0:4])[0]
@@ -1229,6 +1286,7 @@ class MainService(NetworkMenuService):
                 usr.challenger = self._user
         defer.returnValue(None)
 
+    @handles(0x4323)
     def challengeResponse_4323(self, pkt):
         accepted = (struct.unpack('!B', pkt.data[0:1])[0] == 1)
         if accepted:
@@ -1280,6 +1338,7 @@ class MainService(NetworkMenuService):
             # send response to challenger
             challenger.sendData(0x4321,b'\0\0\0\1')
 
+    @handles(0x4350)
     def relayRoomSettings_4350(self, pkt):
         if not self._user.state.room is None:
             for usr in self._user.state.room.players:
@@ -1287,6 +1346,7 @@ class MainService(NetworkMenuService):
                     continue
                 usr.sendData(0x4350, pkt.data)
 
+    @handles(0x4360)
     def toggleReady_4360(self, pkt):
         ready = (struct.unpack('!B', pkt.data[0:1])[0] == 1)
         # relay to others in the room
@@ -1313,19 +1373,3 @@ class MainService(NetworkMenuService):
                 # mark the match-start time
                 room.match.startDatetime = datetime.now()
 
-    def register(self):
-        NetworkMenuService.register(self) # also handle all parent packets
-        self.addHandler(0x4310, self.createRoom_4310)
-        self.addHandler(0x432a, self.exitRoom_432a)
-        self.addHandler(0x4364, self.setMatchTime_4364)
-        self.addHandler(0x4366, self.selectTeam_4366)
-        self.addHandler(0x4368, self.goalScored_4368)
-        self.addHandler(0x4370, self.matchExit_4370)
-        self.addHandler(0x4400, self.chat_4400)
-        self.addHandler(0x4b00, self.ping_4b00)
-        self.addHandler(0x4320, self.challenge_4320)
-        self.addHandler(0x4323, self.challengeResponse_4323)
-        self.addHandler(0x4325, self.cancelChallenge_4325)
-        self.addHandler(0x4350, self.relayRoomSettings_4350)
-        self.addHandler(0x4360, self.toggleReady_4360)
-
@@ -15,14 +15,15 @@ import time
 import re
 import zlib
 
-from fiveserver.model import packet, user, lobby, util
+from fiveserver.model import packet, user, lobby, util, schema
 from fiveserver.model.util import PacketFormatter
 from fiveserver import log, stream, errors
-from fiveserver.protocol import PacketDispatcher, isSameGame
+from fiveserver.protocol import PacketDispatcher, isSameGame, handles
 from fiveserver.protocol import pes5
 
 
 CHAT_HISTORY_DELAY = 3  # seconds
+ROOM_UPDATE_INTERVAL = 0.2  # seconds
 
 ERRORS = [
     b'\xff\xff\xfd\xb6', # owner cancelled
@@ -30,6 +31,138 @@ ERRORS = [
     b'\xff\xff\xfe\x00', # deadline passed
 ]
 
+# 0x4220, 0x4222, 0x4212: player in lobby
+PLAYER_INFO = schema.Schema('PlayerInfo',
+    ('id', 'i'),
+    ('name', '48s'),
+    ('groupId', 'i'),
+    ('groupName', '48s'),
+    ('groupMemberStatus', 'B'),
+    ('division', 'B'),
+    ('roomId', 'i'),
+    ('points', 'i'),
+    ('rating', 'H'),
+    ('matches', 'H'),
+    ('wins', 'H'),
+    ('losses', 'H'),
+    ('draws', 'H'),
+    (None, '3x'))
+
+# 0x4103 (after 4 bytes of result code)
+PROFILE_INFO = schema.Schema('ProfileInfo',
+    ('id', 'i'),
+    ('name', '48s'),
+    ('groupId', 'i'),
+    ('groupName', '48s'),
+    ('groupMemberStatus', 'B'),
+    ('division', 'B'),
+    ('points', 'i'),
+    ('rating', 'H'),
+    ('matches', 'H'),
+    ('wins', 'H'),
+    ('losses', 'H'),
+    ('draws', 'H'),
+    ('winStreak', 'H'),
+    ('winBest', 'H'),
+    ('disconnects', 'H'),
+    ('goalsScored', 'i'),
+    ('goalsAllowed', 'i'),
+    ('comment', '256s'),
+    ('rank', 'i'),
+    ('competitionGoldMedals', 'H'),
+    ('competitionSilverMedals', 'H'),
+    ('unknown1', 'H'),
+    ('winnersCupGoldMedals', 'H'),
+    ('winnersCupSilverMedals', 'H'),
+    ('unknown2', 'H'),
+    ('unknown3', 'B'),
+    ('language', 'B'),
+    ('recentTeam1', 'H'),
+    ('recentTeam2', 'H'),
+    ('recentTeam3', 'H'),
+    ('recentTeam4', 'H'),
+    ('recentTeam5', 'H'))
+
+NUM_RECENT_TEAMS = 5
+
+TEAMS_AND_GOALS = schema.Schema('TeamsAndGoals',
+    ('homeTeam', 'H'),
+    ('homeGoals1st', 'B'),
+    ('homeGoals2nd', 'B'),
+    ('homeGoalsEt1', 'B'),
+    ('homeGoalsEt2', 'B'),
+    ('homeGoalsPen', 'B'),
+    ('awayTeam', 'H'),
+    ('awayGoals1st', 'B'),
+    ('awayGoals2nd', 'B'),
+    ('awayGoalsEt1', 'B'),
+    ('awayGoalsEt2', 'B'),
+    ('awayGoalsPen', 'B'))
+
+ROOM_PLAYER = schema.Schema('RoomPlayer',
+    ('profileId', 'i'),
+    ('owner', 'B'),
+    ('matchStarter', 'B'),
+    ('team', 'B'),
+    ('spectator', 'B'),
+    ('position', 'B'),
+    ('participate', 'B'))
+
+ROOM_PLAYER_SLOTS = 4
+EMPTY_ROOM_PLAYER = (0, 0, 0, 0xff, 0, 0, 0xff)
+
+_roomInfoSchemas = dict()
+
+def getRoomInfoSchema(numSlots):
+    """
+    0x4306, 0x4302: room info with the given number of player
+    slots (4, unless the room somehow has more players)
+    """
+    try:
+        return _roomInfoSchemas[numSlots]
+    except KeyError:
+        pass
+    fields = [
+        ('id', 'i'),
+        ('phase', 'B'),
+        ('matchState', 'B'),
+        ('name', '64s'),
+        ('matchClock', 'B')]
+    fields.extend(ROOM_PLAYER.repeat(numSlots))
+    fields.extend(TEAMS_AND_GOALS.fields)
+    fields.extend([
+        (None, 'x'),
+        ('locked', 'B'),
+        ('competition', 'B'),
+        ('matchChat', 'B'),
+        (None, '2x')])
+    layout = _roomInfoSchemas[numSlots] = schema.Schema('RoomInfo', *fields)
+    return layout
+
+def makeStunInfoSchema(padding):
+    return schema.Schema('StunInfo',
+        (None, '%dx' % padding),
+        ('ip1', '16s'),
+        ('port1', 'H'),
+        ('ip2', '16s'),
+        ('port2', 'H'),
+        ('profileId', 'i'),
+        ('someField', 'H'),
+        ('participate', 'B'))
+
+# 0x4347: stun info of a player in the room
+STUN_INFO = makeStunInfoSchema(32)
+# 0x4330: stun info of a joining player
+STUN_NOTIFY = makeStunInfoSchema(36)
+
+# 0x4369: who plays in which team (4 records)
+PLAYER_SETTING = schema.Schema('PlayerSetting',
+    ('profileId', 'i'),
+    ('away', 'B'),
+    (None, '3x'))
+PLAYER_SETTINGS = schema.Schema('PlayerSettings', *PLAYER_SETTING.repeat(4))
+
+
 def getHomePlayerNames(match):
     home_players = [match.teamSelection.home_captain]
     home_players.extend(match.teamSelection.home_more_players)
@@ -67,10 +200,6 @@ class NewsProtocol(pes5.NewsProtocol):
             '* introducing PES6 support!\r\n')
     }
 
-    def register(self):
-        pes5.NewsProtocol.register(self)
-        self.addHandler(0x2200, self.getWebServerList_2200)
-
     def getServerList_2005(self, pkt):
         myport = self.transport.getHost().port
         gameName = None
@@ -106,6 +235,7 @@ class NewsProtocol(pes5.NewsProtocol):
         self.sendData(0x2003,data)
         self.sendZeros(0x2004,4)
 
+    @handles(0x2200)
     def getWebServerList_2200(self, pkt):
         self.sendZeros(0x2201,4)
         #self.sendData(0x2202,data) #TODO
@@ -201,6 +331,15 @@ class MainService(RosterHandler, pes5.MainService):
     and other important statistics.
     """
 
+    # chat types, for flood control
+    CHAT_TYPES = {
+        b'\x00\x01': 'lobby',
+        b'\x01\x08': 'room',
+        b'\x00\x02': 'private',
+        b'\x01\x05': 'match',
+        b'\x01\x07': 'stadium',
+    }
+
     @defer.inlineCallbacks
     def connectionLost(self, reason):
         pes5.LoginService.connectionLost(self, reason)
@@ -218,148 +357,134 @@ class MainService(RosterHandler, pes5.MainService):
     def formatPlayerInfo(self, usr, roomId, stats=None):
         if stats is None:
             stats = user.Stats(usr.profile.id, 0,0,0,0,0,0,0)
-        return (b'%(id)s%(name)s%(groupid)s%(groupname)s'
-                b'%(groupmemberstatus)s%(division)s%(roomid)s'
-                b'%(points)s%(rating)s%(matches)s%(wins)s'
-                b'%(losses)s%(draws)s%(pad1)s' % {
-            b'id': struct.pack('!i',usr.profile.id),
-            b'name': util.padWithZeros(usr.profile.name,48),
-            b'groupid': struct.pack('!i',0),
-            b'groupname': b'\0'*48,
-            b'groupmemberstatus': struct.pack('!B',0),
-            b'division': struct.pack('!B', 
-                self.factory.ratingMath.getDivision(usr.profile.points)),
-            b'roomid': struct.pack('!i',roomId),
-            b'points': struct.pack('!i',usr.profile.points),
-            b'rating': struct.pack('!H',0),
-            b'matches': struct.pack('!H',
-                stats.wins + stats.losses + stats.draws),
-            b'wins': struct.pack('!H',stats.wins),
-            b'losses': struct.pack('!H',stats.losses),
-            b'draws': struct.pack('!H',stats.draws),
-            b'pad1': b'\0'*3,
-        })
+        return PLAYER_INFO.pack(
+            usr.profile.id,
+            util.toBytes(usr.profile.name),
+            0, # group id
+            b'', # group name
+            0, # group member status
+            self.factory.ratingMath.getDivision(usr.profile.points),
+            roomId,
+            usr.profile.points,
+            0, # rating
+            stats.wins + stats.losses + stats.draws,
+            stats.wins,
+            stats.losses,
+            stats.draws)
 
     def formatProfileInfo(self, profile, stats):
         if not self.factory.serverConfig.ShowStats:
             profile = self.makePristineProfile(profile)
-        return (b'%(id)s%(name)s%(groupid)s%(groupname)s'
-                    b'%(groupmemberstatus)s%(division)s'
-                    b'%(points)s%(rating)s%(matches)s'
-                    b'%(wins)s%(losses)s%(draws)s%(win-strk)s'
-                    b'%(win-best)s%(disconnects)s'
-                    b'%(goals-scored)s%(goals-allowed)s'
-                    b'%(comment)s%(rank)s'
-                    b'%(competition-gold-medals)s%(competition-silver-medals)s'
-                    b'%(unknown1)s'
-                    b'%(winnerscup-gold-medals)s%(winnerscup-silver-medals)s'
-                    b'%(unknown2)s%(unknown3)s'
-                    b'%(language)s%(recent-used-teams)s' % {
-                b'id': struct.pack('!i',profile.id),
-                b'name': util.padWithZeros(profile.name,48),
-                b'groupid': struct.pack('!i',0),
-                b'groupname': util.padWithZeros('Playmakers',48),
-                b'groupmemberstatus': struct.pack('!B',1),
-                b'division': struct.pack('!B', 
-                    self.factory.ratingMath.getDivision(profile.points)),
-                b'points': struct.pack('!i',profile.points),
-                b'rating': struct.pack('!H',profile.rating),
-                b'matches': struct.pack('!H',
-                    stats.wins + stats.losses + stats.draws),
-                b'wins': struct.pack('!H',stats.wins),
-                b'losses': struct.pack('!H',stats.losses),
-                b'draws': struct.pack('!H',stats.draws),
-                b'win-strk': struct.pack('!H', stats.streak_current),
-                b'win-best': struct.pack('!H', stats.streak_best),
-                b'disconnects': struct.pack(
-                    '!H', profile.disconnects),
-                b'goals-scored': struct.pack('!i', stats.goals_scored),
-                b'goals-allowed': struct.pack('!i', stats.goals_allowed),
-                b'comment': util.padWithZeros((
-                    profile.comment or 'Fiveserver rules!'), 256),
-                b'rank': struct.pack('!i',profile.rank),
-                b'competition-gold-medals': struct.pack('!H', 0),
-                b'competition-silver-medals': struct.pack('!H', 0),
-                b'unknown1': struct.pack('!H', 0),
-                b'winnerscup-gold-medals': struct.pack('!H', 0),
-                b'winnerscup-silver-medals': struct.pack('!H', 0),
-                b'unknown2': struct.pack('!H', 0),
-                b'unknown3': struct.pack('!B', 0),
-                b'language': struct.pack('!B', 0),
-                b'recent-used-teams': b''.join([struct.pack('!H', team) 
-                    for team in stats.teams]) + b'\xff\xff'*(5-len(stats.teams)) 
-            })
+        teams = list(stats.teams[:NUM_RECENT_TEAMS])
+        teams.extend([0xffff] * (NUM_RECENT_TEAMS - len(teams)))
+        return PROFILE_INFO.pack(
+            profile.id,
+            util.toBytes(profile.name),
+            0, # group id
+            b'Playmakers', # group name
+            1, # group member status
+            self.factory.ratingMath.getDivision(profile.points),
+            profile.points,
+            profile.rating,
+            stats.wins + stats.losses + stats.draws,
+            stats.wins,
+            stats.losses,
+            stats.draws,
+            stats.streak_current,
+            stats.streak_best,
+            profile.disconnects,
+            stats.goals_scored,
+            stats.goals_allowed,
+            util.toBytes(profile.comment or 'Fiveserver rules!'),
+            profile.rank,
+            0, 0, 0, # competition gold/silver medals, unknown
+            0, 0, 0, # winners-cup gold/silver medals, unknown
+            0, # unknown
+            0, # language
+            *teams)
             
     def formatHomeOrAway(self, room, usr):
         if room.teamSelection:
             return room.teamSelection.getHomeOrAway(usr)
         return 0xff
 
-    def formatTeamsAndGoals(self, room):
+    def getTeamsAndGoals(self, room):
+        """
+        Values of the TEAMS_AND_GOALS layout
+        """
         homeTeam, awayTeam = 0xffff, 0xffff
         if room.teamSelection:
             homeTeam = (room.teamSelection.home_team_id
             if room.teamSelection.home_team_id != None else 0xffff)
             awayTeam = (room.teamSelection.away_team_id
             if room.teamSelection.away_team_id != None else 0xffff)
-        (homeGoals1st, homeGoals2nd, homeGoalsEt1, 
-         homeGoalsEt2, homeGoalsPen) = 0, 0, 0, 0, 0
-        (awayGoals1st, awayGoals2nd, awayGoalsEt1, 
-         awayGoalsEt2, awayGoalsPen) = 0, 0, 0, 0, 0
-        if room.match:
-            homeGoals1st = room.match.score_home_1st
-            homeGoals2nd = room.match.score_home_2nd
-            homeGoalsEt1 = room.match.score_home_et1
-            homeGoalsEt2 = room.match.score_home_et2
-            homeGoalsPen = room.match.score_home_pen
-            awayGoals1st = room.match.score_away_1st
-            awayGoals2nd = room.match.score_away_2nd
-            awayGoalsEt1 = room.match.score_away_et1
-            awayGoalsEt2 = room.match.score_away_et2
-            awayGoalsPen = room.match.score_away_pen
-        return b'%s%s%s%s%s%s%s%s%s%s%s%s' % (
-            struct.pack('!H', homeTeam),
-            struct.pack('!B', homeGoals1st), # 1st
-            struct.pack('!B', homeGoals2nd), # 2nd
-            struct.pack('!B', homeGoalsEt1), # et1
-            struct.pack('!B', homeGoalsEt2), # et2
-            struct.pack('!B', homeGoalsPen), # pen
-            struct.pack('!H', awayTeam),
-            struct.pack('!B', awayGoals1st), # 1st
-            struct.pack('!B', awayGoals2nd), # 2nd
-            struct.pack('!B', awayGoalsEt1), # et1
-            struct.pack('!B', awayGoalsEt2), # et2
-            struct.pack('!B', awayGoalsPen)) # pen
+        match = room.match
+        if match:
+            return (
+                homeTeam,
+                match.score_home_1st, match.score_home_2nd,
+                match.score_home_et1, match.score_home_et2,
+                match.score_home_pen,
+                awayTeam,
+                match.score_away_1st, match.score_away_2nd,
+                match.score_away_et1, match.score_away_et2,
+                match.score_away_pen)
+        return (homeTeam, 0, 0, 0, 0, 0, awayTeam, 0, 0, 0, 0, 0)
+
+    def formatTeamsAndGoals(self, room):
+        return TEAMS_AND_GOALS.pack(*self.getTeamsAndGoals(room))
 
     def formatRoomInfo(self, room):
+        """
+        Serialized room info (0x4306, 0x4302 payload). It is kept
+        with the room, and only redone when the room version changes.
+        """
+        cached = room.serializedInfo
+        if cached is not None and cached[0] == room.version:
+            return cached[1]
+        data = self.serializeRoomInfo(room)
+        room.serializedInfo = (room.version, data)
+        return data
+
+    def serializeRoomInfo(self, room):
         n = len(room.players)
         if room.match:
             match_state = room.match.state
             match_clock = room.match.clock
         else:
             match_state, match_clock = 0, 0
-        return b'%s%s%s%s%s%s%s%s%s%s%s' % (
-            struct.pack('!i',room.id),
-            struct.pack('!B',room.phase),
-            struct.pack('!B',match_state),
-            util.padWithZeros(room.name,64),
-            struct.pack('!B',match_clock),
-            b''.join([b'%s%s%s%s%s%s%s' % (
-                struct.pack('!i',usr.profile.id),
-                struct.pack('!B',room.isOwner(usr)),
+        values = [room.id, room.phase, match_state,
+                  util.toBytes(room.name), match_clock]
+        for position, usr in enumerate(room.players):
+            values.extend((
+                usr.profile.id,
+                room.isOwner(usr),
                 # matchstarter or 1st host?
-                struct.pack('!B',room.isMatchStarter(usr)), 
-                struct.pack('!B',self.formatHomeOrAway(room, usr)), # team
-                struct.pack('!B',usr.state.spectator), # spectator
-                struct.pack('!B',room.getPlayerPosition(usr)), # pos in room
-                struct.pack('!B',room.getPlayerParticipate(usr))) # participate
-                for usr in room.players]),
-            b'\0\0\0\0\0\0\xff\0\0\xff'*(4-n), # empty players
-            self.formatTeamsAndGoals(room),
-            b'\0', #padding
-            struct.pack('!B', int(room.usePassword)), # room locked
-            b'\0\x02\0\0') # competition flag, match chat setting, 2 unknowns
+                room.isMatchStarter(usr),
+                self.formatHomeOrAway(room, usr), # team
+                usr.state.spectator, # spectator
+                position, # pos in room
+                room.getPlayerParticipate(usr))) # participate
+        # empty players
+        values.extend(EMPTY_ROOM_PLAYER * (ROOM_PLAYER_SLOTS - n))
+        values.extend(self.getTeamsAndGoals(room))
+        # room locked, competition flag, match chat setting
+        values.extend((int(room.usePassword), 0, 2))
+        return getRoomInfoSchema(max(n, ROOM_PLAYER_SLOTS)).pack(*values)
             
+    def formatStunInfo(self, room, usr, layout=STUN_INFO):
+        """
+        Used to format the 0x4347 (and 0x4330) payload
+        """
+        return layout.pack(
+            usr.state.ip1,
+            usr.state.udpPort1,
+            usr.state.ip2,
+            usr.state.udpPort2,
+            usr.profile.id,
+            0, # some field
+            room.getPlayerParticipate(usr))
+
     def formatRoomParticipationStatus(self, room):
         """
         Used to format the 0x4365 payload
@@ -375,10 +500,14 @@ class MainService(RosterHandler, pes5.MainService):
             b'\0\0\0\0\0\xff'*(4-n))
         return data        
 
+    @handles(0x4366)
     def becomeSpectator_4366(self, pkt):
         self._user.state.spectator = 1
+        if self._user.state.room is not None:
+            self._user.state.room.touch()
         self.sendZeros(0x4367, 4)
 
+    @handles(0x4351)
     def do_4351(self, pkt):
         """
         Contains connection information of playing players
@@ -394,6 +523,7 @@ class MainService(RosterHandler, pes5.MainService):
                 player.sendData(0x4351, data)
         self.sendZeros(0x4352, 4)
 
+    @handles(0x4383)
     def backToMatchMenu_4383(self, pkt):
         """
         Contains old,added,new points & rating
@@ -423,9 +553,11 @@ class MainService(RosterHandler, pes5.MainService):
                 struct.pack('!i',0))])) # group2 new points
         self.sendData(0x4384, data)
 
+    @handles(0x6020)
     def quickGameSearch_6020(self, pkt):
         self.sendZeros(0x6021,0)
 
+    @handles(0x4345)
     def getStunInfo_4345(self, pkt):    
         self.sendZeros(0x4346, 0)
         roomId = struct.unpack('!i',pkt.data[0:4])[0]
@@ -434,29 +566,19 @@ class MainService(RosterHandler, pes5.MainService):
         if room is not None:
             # send stun info of players in room to requester
             for usr in room.players:
-                data = (b'%(pad1)s%(ip1)s%(port1)s'
-                    b'%(ip2)s%(port2)s%(id)s'
-                    b'%(someField)s%(participate)s') % {
-                b'pad1': b'\0'*32,
-                b'ip1': util.padWithZeros(usr.state.ip1, 16),
-                b'port1': struct.pack('!H', usr.state.udpPort1),
-                b'ip2': util.padWithZeros(usr.state.ip2, 16),
-                b'port2': struct.pack('!H', usr.state.udpPort2),
-                b'id': struct.pack('!i', usr.profile.id),
-                b'someField': struct.pack('!H', 0),
-                b'participate': struct.pack('!B', 
-                    room.getPlayerParticipate(usr)),
-                }
-                self.sendData(0x4347, data)
+                self.sendData(0x4347, self.formatStunInfo(room, usr))
                 self.do_4330(room)
         self.sendZeros(0x4348, 0)        
 
+    @handles(0x4400)
     def chat_4400(self, pkt):
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         chatType = pkt.data[0:2]
+        if not self.factory.configuration.allowChat(
+                self._chatBuckets, self.CHAT_TYPES.get(chatType)):
+            return
         message = util.stripZeros(pkt.data[10:])
-        if any(word in message.decode('utf-8')
-               for word in self.factory.serverConfig.Chat['bannedWords']):
+        if self.factory.configuration.hasBannedWords(message):
             message = b'[%s]' % self.factory.serverConfig.Chat['warningMessage'].encode('utf-8')
         data = b'%s%s%s%s%s' % (
                 chatType,
@@ -470,14 +592,12 @@ class MainService(RosterHandler, pes5.MainService):
             thisLobby.addToChatHistory(
                 lobby.ChatMessage(self._user.profile, message.decode('utf-8')))
             # lobby chat
-            for usr in thisLobby.players.values():
-                usr.sendData(0x4402, data)
+            thisLobby.broadcastData(0x4402, data)
         elif chatType==b'\x01\x08':
             # room chat
             room = self._user.state.room
             if room:
-                for usr in room.players:
-                    usr.sendData(0x4402, data)
+                thisLobby.broadcastData(0x4402, data, room.players)
         elif chatType==b'\x00\x02':
             # private message
             profileId = struct.unpack('!i',pkt.data[6:10])[0]
@@ -499,87 +619,102 @@ class MainService(RosterHandler, pes5.MainService):
             # match chat
             room = self._user.state.room
             if room:
-                for usr in room.players:
-                    usr.sendData(0x4402, data)
+                thisLobby.broadcastData(0x4402, data, room.players)
         elif chatType==b'\x01\x07':
             # stadium chat    
             room = self._user.state.room
             if room:
-                for usr in room.players:
-                    usr.sendData(0x4402, data)
+                thisLobby.broadcastData(0x4402, data, room.players)
 
-    def sendChatHistory(self, aLobby, who):
-        if aLobby is None or who is None:
-            return
-        for chatMessage in list(aLobby.chatHistory):
-            chatType = b'\0\1'
-            if chatMessage.toProfile is not None:
-                if who.profile.id not in [
-                    chatMessage.fromProfile.id, chatMessage.toProfile.id]:
-                    continue
-                special = chatMessage.special
-            else:
-                special = b'\0\0\0\0'
-            data = b'%s%s%s%s%s' % (
-                    chatType,
-                    special,
-                    struct.pack('!i', chatMessage.fromProfile.id),
-                    util.padWithZeros(chatMessage.fromProfile.name,48),
-                    chatMessage.text.encode('utf-8')[:126]+b'\0\0')
-            who.sendData(0x4402, data)
+    def formatChatHistoryEntry(self, chatMessage):
+        if chatMessage.toProfile is not None:
+            special = chatMessage.special
+        else:
+            special = b'\0\0\0\0'
+        return b'%s%s%s%s%s' % (
+                b'\0\1',
+                special,
+                struct.pack('!i', chatMessage.fromProfile.id),
+                util.padWithZeros(chatMessage.fromProfile.name,48),
+                chatMessage.text.encode('utf-8')[:126]+b'\0\0')
 
     def broadcastSystemChat(self, aLobby, text):
         chatMessage = lobby.ChatMessage(lobby.SYSTEM_PROFILE, text)
-        for usr in aLobby.players.values():
-            data = b'%s%s%s%s%s' % (
-                    b'\0\1',
-                    b'\0\0\0\0',
-                    struct.pack('!i', chatMessage.fromProfile.id),
-                    util.padWithZeros(chatMessage.fromProfile.name,48),
-                    chatMessage.text.encode('utf-8')[:126]+b'\0\0')
-            usr.sendData(0x4402, data)
+        data = b'%s%s%s%s%s' % (
+                b'\0\1',
+                b'\0\0\0\0',
+                struct.pack('!i', chatMessage.fromProfile.id),
+                util.padWithZeros(chatMessage.fromProfile.name,48),
+                chatMessage.text.encode('utf-8')[:126]+b'\0\0')
+        aLobby.broadcastData(0x4402, data)
         aLobby.addToChatHistory(chatMessage)
 
     def broadcastRoomChat(self, room, text):
         chatMessage = lobby.ChatMessage(lobby.SYSTEM_PROFILE, text)
-        for usr in room.players:
-            data = b'%s%s%s%s%s' % (
-                    b'\x01\x08',
-                    b'\0\0\0\0',
-                    struct.pack('!i', chatMessage.fromProfile.id),
-                    util.padWithZeros(chatMessage.fromProfile.name,48),
-                    chatMessage.text.encode('utf-8')[:126]+b'\0\0')
-            usr.sendData(0x4402, data)
+        data = b'%s%s%s%s%s' % (
+                b'\x01\x08',
+                b'\0\0\0\0',
+                struct.pack('!i', chatMessage.fromProfile.id),
+                util.padWithZeros(chatMessage.fromProfile.name,48),
+                chatMessage.text.encode('utf-8')[:126]+b'\0\0')
+        room.lobby.broadcastData(0x4402, data, room.players)
          
-    def sendRoomUpdate(self, room):
+    def getRoomUpdateInterval(self):
+        try:
+            return float(self.factory.serverConfig.RoomUpdateInterval)
+        except AttributeError:
+            return ROOM_UPDATE_INTERVAL
+
+    def sendRoomUpdate(self, room, coalesce=False):
+        """
+        Send room info to everybody in the lobby. With coalesce=True
+        the update is only queued, and all updates to the same room
+        within one interval go out as a single 0x4306 packet.
+        """
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
+        interval = self.getRoomUpdateInterval()
+        if coalesce and interval > 0:
+            if thisLobby.markRoomDirty(room):
+                thisLobby.roomFlushCall = reactor.callLater(
+                    interval, self.flushRoomUpdates, thisLobby)
+            return
+        # this update supersedes any queued one
+        thisLobby.unmarkRoomDirty(room)
         data = self.formatRoomInfo(room)
-        for usr in thisLobby.players.values():
-            usr.sendData(0x4306,data)
+        thisLobby.broadcastData(0x4306, data)
+
+    def flushRoomUpdates(self, aLobby):
+        for room in aLobby.popDirtyRooms():
+            aLobby.broadcastData(0x4306, self.formatRoomInfo(room))
 
     @defer.inlineCallbacks
     def sendPlayerUpdate(self, roomId):
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         stats = yield self.getStats(self._user.profile.id)
         data = self.formatPlayerInfo(self._user, roomId, stats)
-        for usr in thisLobby.players.values():
-            usr.sendData(0x4222,data)
+        thisLobby.broadcastData(0x4222, data)
 
     @defer.inlineCallbacks
     def getUserList_4210(self, pkt):
         self.sendZeros(0x4211,4)
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
-        for usr in thisLobby.players.values():
-            if usr.state.inRoom == 1:
-                roomId = usr.state.room.id
-            else:
-                roomId = 0
-            stats = yield self.getStats(usr.profile.id)
-            data = self.formatPlayerInfo(usr, roomId, stats)
-            self.sendData(0x4212,data)
-        self.sendZeros(0x4213,4)
+        players = list(thisLobby.players.values())
+        allStats = yield self.getStatsMany(
+            [usr.profile.id for usr in players])
+        # resumed outside of dataReceived: cork explicitly
+        with self.corked():
+            for usr in players:
+                if usr.state.inRoom == 1:
+                    roomId = usr.state.room.id
+                else:
+                    roomId = 0
+                stats = allStats[usr.profile.id]
+                data = self.formatPlayerInfo(usr, roomId, stats)
+                self.sendData(0x4212,data)
+            self.sendZeros(0x4213,4)
         yield defer.succeed(None)
 
+    @handles(0x4310)
     def createRoom_4310(self, pkt):
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         roomName = util.stripZeros(pkt.data[0:64])
@@ -603,6 +738,7 @@ class MainService(RosterHandler, pes5.MainService):
             self.sendPlayerUpdate(room.id)
             self.sendZeros(0x4311,4)
         
+    @handles(0x4300)
     def getRoomList_4300(self, pkt):
         self.sendZeros(0x4301,4)
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -611,6 +747,7 @@ class MainService(RosterHandler, pes5.MainService):
             self.sendData(0x4302, data)
         self.sendZeros(0x4303,4)
 
+    @handles(0x4349)
     def setOwner_4349(self, pkt):
         newOwnerProfileId = struct.unpack('!i',pkt.data[0:4])[0]
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -624,6 +761,7 @@ class MainService(RosterHandler, pes5.MainService):
                 self.sendRoomUpdate(room)
         self.sendZeros(0x434a,4)
 
+    @handles(0x434d)
     def setRoomName_434d(self, pkt):
         newName = util.stripZeros(pkt.data[0:63])
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -650,21 +788,10 @@ class MainService(RosterHandler, pes5.MainService):
         for otherUsr in room.players:
             if otherUsr == self._user:
                 continue
-            data = (b'%(pad1)s%(ip1)s%(port1)s'
-            b'%(ip2)s%(port2)s%(id)s'
-            b'%(someField)s%(participate)s') % {
-            b'pad1': b'\0'*36,
-            b'ip1': util.padWithZeros(self._user.state.ip1, 16),
-            b'port1': struct.pack('!H', self._user.state.udpPort1),
-            b'ip2': util.padWithZeros(self._user.state.ip2, 16),
-            b'port2': struct.pack('!H', self._user.state.udpPort2),
-            b'id': struct.pack('!i', self._user.profile.id),
-            b'someField': struct.pack('!H', 0),
-            b'participate': struct.pack('!B', 
-                room.getPlayerParticipate(self._user)),
-            }
-            otherUsr.sendData(0x4330, data)        
+            otherUsr.sendData(0x4330,
+                self.formatStunInfo(room, self._user, STUN_NOTIFY))
 
+    @handles(0x4320)
     def joinRoom_4320(self, pkt):
         roomId = struct.unpack('!i',pkt.data[0:4])[0]
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -698,20 +825,7 @@ class MainService(RosterHandler, pes5.MainService):
         for otherUsr in room.players:
             if otherUsr == self._user:
                 continue
-            data = (b'%(pad1)s%(ip1)s%(port1)s'
-            b'%(ip2)s%(port2)s%(id)s'
-            b'%(someField)s%(participate)s') % {
-            b'pad1': b'\0'*32,
-            b'ip1': util.padWithZeros(otherUsr.state.ip1, 16),
-            b'port1': struct.pack('!H', otherUsr.state.udpPort1),
-            b'ip2': util.padWithZeros(otherUsr.state.ip2, 16),
-            b'port2': struct.pack('!H', otherUsr.state.udpPort2),
-            b'id': struct.pack('!i', otherUsr.profile.id),
-            b'someField': struct.pack('!H', 0),
-            b'participate': struct.pack('!B', 
-                room.getPlayerParticipate(otherUsr)),
-            }
-            self.sendData(0x4347, data)
+            self.sendData(0x4347, self.formatStunInfo(room, otherUsr))
         self.sendZeros(0x4348, 0)
 
     def exitingLobby(self, usr):
@@ -720,8 +834,7 @@ class MainService(RosterHandler, pes5.MainService):
         # user now considered OFFLINE
         self.factory.userOffline(usr)
         # notify every remaining occupant in the lobby
-        for otherUsr in usrLobby.players.values():
-            otherUsr.sendData(0x4221,struct.pack('!i', usr.profile.id))
+        usrLobby.broadcastData(0x4221, struct.pack('!i', usr.profile.id))
  
     def exitingRoom(self, room, usr):
         usrLobby = self.factory.getLobbies()[usr.state.lobbyId]
@@ -735,9 +848,7 @@ class MainService(RosterHandler, pes5.MainService):
         # destroy the room, if none left in it
         if room.isEmpty():
             # notify users in lobby that the room is gone
-            data = struct.pack('!i',room.id)
-            for otherUsr in usrLobby.players.values():
-                otherUsr.sendData(0x4305,data)
+            usrLobby.broadcastData(0x4305, struct.pack('!i',room.id))
             usrLobby.deleteRoom(room)
 
     def exitRoom_432a(self, pkt):
@@ -748,6 +859,7 @@ class MainService(RosterHandler, pes5.MainService):
             return self.exitingRoom(
                 self._user.state.room, self._user)
   
+    @handles(0x4363)
     def toggleParticipate_4363(self, pkt):
         participate = (struct.unpack('!B', pkt.data[0:1])[0] == 1)
         room = self._user.state.room
@@ -787,6 +899,7 @@ class MainService(RosterHandler, pes5.MainService):
                struct.pack('!B', room.getPlayerParticipate(self._user)))
         self.sendData(0x4364, data)
         
+    @handles(0x4380)
     def forcedCancelParticipation_4380(self, pkt):
         profileId = struct.unpack('!i',pkt.data[0:4])[0]
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
@@ -801,6 +914,7 @@ class MainService(RosterHandler, pes5.MainService):
         self.sendZeros(0x4381,4)
 
 
+    @handles(0x4360)
     def startMatch_4360(self, pkt):
         thisLobby = self.factory.getLobbies()[self._user.state.lobbyId]
         room = self._user.state.room
@@ -833,6 +947,7 @@ class MainService(RosterHandler, pes5.MainService):
             # Tell everyone of new phase of room
             self.sendRoomUpdate(room)
         
+    @handles(0x436f)
     def toggleReady_436f(self, pkt):
         payload = struct.unpack('!B', pkt.data[0:1])[0]
         room = self._user.state.room
@@ -846,6 +961,7 @@ class MainService(RosterHandler, pes5.MainService):
             
             # phase 7-8: match finished
             elif room.phase > lobby.RoomState.ROOM_MATCH_FORMATION_SELECT:
+                oldPhase = room.phase
                 # exit match
                 if payload == 0:
                     room.cancelParticipation(self._user)
@@ -862,7 +978,8 @@ class MainService(RosterHandler, pes5.MainService):
                 elif payload == 4:
                     room.phase = lobby.RoomState.ROOM_MATCH_FORMATION_SELECT
                     room.match = None
-                self.sendRoomUpdate(room)
+                # phase changes go out right away
+                self.sendRoomUpdate(room, coalesce=room.phase == oldPhase)
                     
             for usr in room.players:
                 if usr == self._user:
@@ -878,6 +995,7 @@ class MainService(RosterHandler, pes5.MainService):
             self.updateRoomPhase(room)
 
             
+    @handles(0x4369)
     @defer.inlineCallbacks
     def setPlayerSettings_4369(self, pkt):
         # Packet contains which players are in team1 & team2
@@ -890,9 +1008,10 @@ class MainService(RosterHandler, pes5.MainService):
             usr.sendData(0x436b, data)
         # create new TeamSelection object
         room.teamSelection = lobby.TeamSelection()
+        settings = PLAYER_SETTINGS.unpackValues(pkt.data)
         for x in range(4):
-            profile_id = struct.unpack('!i',pkt.data[x*8:x*8+4])[0]
-            away = 1 == pkt.data[x*8+4]
+            profile_id = settings[x*2]
+            away = 1 == settings[x*2+1]
             if profile_id!=0:
                 profile = yield self.factory.getPlayerProfile(profile_id)
                 if x in [0,1]:
@@ -905,8 +1024,10 @@ class MainService(RosterHandler, pes5.MainService):
                         room.teamSelection.home_more_players.append(profile)
                     else:
                         room.teamSelection.away_more_players.append(profile)
+        room.touch()
         self.sendRoomUpdate(room)
 
+    @handles(0x436c)
     def setGameSettings_436c(self, pkt):
         # Packet contains game settings(time,injuries,penalty etcetera)
         self.sendZeros(0x436d, 4)
@@ -917,6 +1038,7 @@ class MainService(RosterHandler, pes5.MainService):
             usr.sendData(0x436e, data)
         self.sendRoomUpdate(room)
 
+    @handles(0x4375)
     def goalScored_4375(self, pkt):
         room = self._user.state.room
         if not room.match:
@@ -932,6 +1054,7 @@ class MainService(RosterHandler, pes5.MainService):
                     room.teamSelection.away_team_id, 
                     getAwayPlayerNames(room.match)))
                 room.match.goalAway()
+            room.touch()
             log.msg(
                 'UPDATE: Team %d (%s) vs Team %d (%s) - %d:%d (in progress)' % (
                     room.teamSelection.home_team_id, 
@@ -941,8 +1064,9 @@ class MainService(RosterHandler, pes5.MainService):
                     room.match.score_home, room.match.score_away))
         self.sendZeros(0x4376, 4)
         # let others in the lobby know
-        self.sendRoomUpdate(room)
+        self.sendRoomUpdate(room, coalesce=True)
 
+    @handles(0x4385)
     def matchClockUpdate_4385(self, pkt):
         clock = struct.unpack('!B', pkt.data[0:1])[0]
         room = self._user.state.room
@@ -950,6 +1074,7 @@ class MainService(RosterHandler, pes5.MainService):
             log.msg('ERROR: got clock update, but no match')
         else:
             room.match.clock = clock
+            room.touch()
             log.msg('CLOCK: Team %d (%s) vs Team %d (%s). Minute: %d' % (
                 room.teamSelection.home_team_id, 
                 getHomePlayerNames(room.match),
@@ -958,7 +1083,7 @@ class MainService(RosterHandler, pes5.MainService):
                 room.match.clock))
         self.sendZeros(0x4386, 4)
         # let others in the lobby know
-        self.sendRoomUpdate(room)
+        self.sendRoomUpdate(room, coalesce=True)
 
     @defer.inlineCallbacks
     def recordMatchResult(self, room):
@@ -981,11 +1106,13 @@ class MainService(RosterHandler, pes5.MainService):
                 match.teamSelection.away_captain]
             participants.extend(match.teamSelection.home_more_players)
             participants.extend(match.teamSelection.away_more_players)
+            allStats = yield self.getStatsMany(
+                [profile.id for profile in participants])
             for profile in participants:
                 # update player play time
                 profile.playTime += duration
                 # re-calculate points
-                stats = yield self.getStats(profile.id)
+                stats = allStats[profile.id]
                 rm = self.factory.ratingMath
                 profile.points = rm.getPoints(stats)
                 # store updated profile
@@ -993,6 +1120,7 @@ class MainService(RosterHandler, pes5.MainService):
         else:
             yield defer.succeed(None)
 
+    @handles(0x4377)
     def matchStateUpdate_4377(self, pkt):
         state = struct.unpack('!B', pkt.data[0:1])[0]
         room = self._user.state.room
@@ -1020,10 +1148,14 @@ class MainService(RosterHandler, pes5.MainService):
             elif state == lobby.MatchState.FINISHED and room.match:
                 room.phase = lobby.RoomState.ROOM_MATCH_FINISHED
                 self.recordMatchResult(room)
-            # let others in the lobby know
-            self.sendRoomUpdate(room)
+            room.touch()
+            # let others in the lobby know: match start and
+            # end are sent right away, other states can wait
+            self.sendRoomUpdate(room, coalesce=state not in [
+                lobby.MatchState.FIRST_HALF, lobby.MatchState.FINISHED])
         self.sendZeros(0x4378, 4)
 
+    @handles(0x4373)
     def teamSelected_4373(self, pkt):
         team = struct.unpack('!H', pkt.data[0:2])[0]
         log.msg('Team selected: %d' % team)
@@ -1036,9 +1168,11 @@ class MainService(RosterHandler, pes5.MainService):
                 ts.home_team_id = team
             elif self._user.profile.id == ts.away_captain.id:
                 ts.away_team_id = team
+            room.touch()
         self.sendData(0x4374,b'\0\0\0\0')
-        self.sendRoomUpdate(room)
+        self.sendRoomUpdate(room, coalesce=True)
 
+    @handles(0x4110)
     @defer.inlineCallbacks
     def setComment_4110(self, pkt):
         self._user.profile.comment = pkt.data
@@ -1066,28 +1200,3 @@ class MainService(RosterHandler, pes5.MainService):
         Overriden here to mask pes5 logic
         """
     
-    def register(self):
-        pes5.MainService.register(self)
-        self.addHandler(0x6020, self.quickGameSearch_6020)
-        self.addHandler(0x4110, self.setComment_4110)
-        self.addHandler(0x4345, self.getStunInfo_4345)
-        self.addHandler(0x4400, self.chat_4400)
-        self.addHandler(0x4310, self.createRoom_4310)
-        self.addHandler(0x4300, self.getRoomList_4300)
-        self.addHandler(0x4320, self.joinRoom_4320)
-        self.addHandler(0x4363, self.toggleParticipate_4363)
-        self.addHandler(0x4360, self.startMatch_4360)
-        self.addHandler(0x436f, self.toggleReady_436f)
-        self.addHandler(0x4369, self.setPlayerSettings_4369)
-        self.addHandler(0x436c, self.setGameSettings_436c)
-        self.addHandler(0x4373, self.teamSelected_4373)
-        self.addHandler(0x4375, self.goalScored_4375)
-        self.addHandler(0x4377, self.matchStateUpdate_4377)
-        self.addHandler(0x4385, self.matchClockUpdate_4385)
-        self.addHandler(0x4349, self.setOwner_4349)
-        self.addHandler(0x434d, self.setRoomName_434d)
-        self.addHandler(0x4366, self.becomeSpectator_4366)
-        self.addHandler(0x4351, self.do_4351)
-        self.addHandler(0x4383, self.backToMatchMenu_4383)
-        self.addHandler(0x4380, self.forcedCancelParticipation_4380)
-
@@ -2,22 +2,59 @@
 Stream classes
 """
 
-import operator
-import struct
+import hashlib
+
+from fiveserver.model import packet
 
 
 XOR_KEY = b'\xa6\x77\x95\x7c'
 
+# largest frame we can ever see: 16-bit length + 24-byte header/md5
+MAX_FRAME_SIZE = 0xffff + 24
+
+# key repeated over a full frame, one copy per rotation (start % 4),
+# so that a buffer of any length can be XOR-ed with a single big-int op
+_KEY_TABLE = [
+    (XOR_KEY[i:] + XOR_KEY[:i]) * (MAX_FRAME_SIZE // len(XOR_KEY) + 1)
+    for i in range(len(XOR_KEY))]
+
+
+def _keyStream(start, size):
+    key = _KEY_TABLE[start % len(XOR_KEY)]
+    if size > len(key):
+        key = key * (size // len(key) + 1)
+    return key[:size]
+
 
 def xorData(data, start=0):
-    bs = []
-    key_size = len(XOR_KEY)
-    for i,c in enumerate(data):
-        bs.append(struct.pack('!B', operator.xor(
-            XOR_KEY[(start+i) % key_size], c)
-        ))
-    return b''.join(bs)
- 
+    """
+    XOR the whole buffer with the repeated key at once.
+    start is the stream offset of the first byte of data.
+    """
+    size = len(data)
+    if size == 0:
+        return b''
+    key = _keyStream(start, size)
+    return (int.from_bytes(data, 'big') ^
+            int.from_bytes(key, 'big')).to_bytes(size, 'big')
+
+
+def xorFrames(frames):
+    """
+    XOR several frames, each one keyed from its own start,
+    with a single big-int op. Returns the joined result.
+    """
+    if len(frames) == 1:
+        return xorData(frames[0], 0)
+    data = b''.join(frames)
+    size = len(data)
+    if size == 0:
+        return b''
+    key = _KEY_TABLE[0]
+    key = b''.join([key[:len(frame)] for frame in frames])
+    return (int.from_bytes(data, 'big') ^
+            int.from_bytes(key, 'big')).to_bytes(size, 'big')
+
 
 class XorStream:
 
@@ -35,3 +72,80 @@ class XorStream:
     def __getattr__(self, name):
         return getattr(self._stream, name)
 
+
+class PacketFramer:
+    """
+    Incremental parser for the obfuscated packet stream.
+    Received bytes are appended to a single buffer and consumed
+    through a read cursor, so that every byte is de-obfuscated
+    exactly once and nothing is re-sliced while waiting for the
+    rest of a frame.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._header = None
+
+    def feed(self, data):
+        """
+        Append received bytes and return the list
+        of packets completed by them.
+        """
+        buf = self._buf
+        buf += data
+        pos, end = 0, len(buf)
+        header = self._header
+        packets = []
+        with memoryview(buf) as view:
+            while True:
+                if header is None:
+                    if end - pos < 8:
+                        break
+                    header = packet.makePacketHeader(
+                        xorData(view[pos:pos+8], 0))
+                frameEnd = pos + 24 + header.length
+                if end < frameEnd:
+                    break
+                md5 = xorData(view[pos+8:pos+24], 8)
+                data = xorData(view[pos+24:frameEnd], 24)
+                packets.append(packet.makeVerifiedPacket(header, md5, data))
+                pos, header = frameEnd, None
+        # drop consumed bytes (bytearray trims its head in place)
+        del buf[:pos]
+        self._header = header
+        return packets
+
+    def pending(self):
+        """
+        Number of received bytes not yet turned into packets
+        """
+        return len(self._buf)
+
+
+class BroadcastFrame:
+    """
+    A payload serialized and obfuscated once, to be sent
+    to many connections. Only the header (packet counter) and
+    the md5 differ between recipients. The payload starts at
+    offset 24 of the frame, which is key-aligned, so its XOR
+    is shared by all of them.
+    """
+
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
+        self._xoredData = xorData(data, 24)
+
+    def frameFor(self, packet_count):
+        header = packet.HEADER_STRUCT.pack(
+            self.id, len(self.data), packet_count)
+        md5 = hashlib.md5(header)
+        md5.update(self.data)
+        return xorData(header + md5.digest(), 0) + self._xoredData
+
+    def makePacket(self, packet_count):
+        """
+        Equivalent ordinary packet (for debug output)
+        """
+        return packet.Packet(packet.PacketHeader(
+            self.id, len(self.data), packet_count), self.data)
@@ -0,0 +1,156 @@
+"""
+Reactor stall detector. A LoopingCall on the reactor measures how
+late each of its ticks runs (loop lag), into a latency histogram.
+A watcher thread notices when the reactor has not ticked for longer
+than the threshold, and takes the Python stack of the reactor thread
+at that moment: that is the code blocking every connection. Stalls
+are kept, with their duration and stack, in a bounded list.
+"""
+
+from collections import deque
+import sys
+import threading
+import time
+import traceback
+
+from twisted.internet import reactor, task
+
+from fiveserver import log
+from fiveserver.handlerstats import Histogram, BUCKETS
+
+
+INTERVAL = 0.05   # seconds between ticks
+THRESHOLD = 0.2   # lag, in seconds, that counts as a stall
+MAX_STALLS = 50
+
+_watchdog = None
+
+
+class Watchdog:
+    """
+    Loop lag histogram (milliseconds) and recent stalls
+    """
+
+    def __init__(self, interval=None, threshold=None, maxStalls=None):
+        self.interval = interval or INTERVAL
+        self.threshold = threshold or THRESHOLD
+        self.lag = Histogram()
+        self.stalls = deque(maxlen=maxStalls or MAX_STALLS)
+        self.numStalls = 0
+        self._loop = None
+        self._thread = None
+        self._running = False
+        self._reactorThread = None
+        self._lastTick = None
+        self._stack = None
+
+    def start(self):
+        self._reactorThread = threading.get_ident()
+        self._lastTick = time.monotonic()
+        self._running = True
+        self._loop = task.LoopingCall(self.tick)
+        self._loop.start(self.interval, now=False)
+        self._thread = threading.Thread(
+            target=self.watch, name='reactor-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        self._running = False
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def tick(self):
+        now = time.monotonic()
+        lag = now - self._lastTick - self.interval
+        self._lastTick = now
+        if lag < 0:
+            lag = 0.0
+        self.lag.add(lag * 1000.0)
+        stack, self._stack = self._stack, None
+        if lag >= self.threshold:
+            self.numStalls += 1
+            self.stalls.append(dict(
+                time=time.time() - lag,
+                duration=round(lag, 3),
+                stack=stack or ''))
+            log.msg('WARN: reactor stalled for %0.3f seconds%s' % (
+                lag, (':\n' + stack) if stack else ''))
+
+    def watch(self):
+        """
+        Watcher thread: grab the reactor thread's stack
+        once per stall, while the stall is happening
+        """
+        step = self.threshold / 2.0
+        stalledSince = None
+        while self._running:
+            time.sleep(step)
+            lastTick = self._lastTick
+            if time.monotonic() - lastTick < self.interval + self.threshold:
+                continue
+            if stalledSince == lastTick:
+                continue
+            stalledSince = lastTick
+            frame = sys._current_frames().get(self._reactorThread)
+            if frame is not None:
+                self._stack = ''.join(traceback.format_stack(frame))
+
+    def reset(self):
+        self.lag = Histogram()
+        self.stalls.clear()
+        self.numStalls = 0
+
+    def getStats(self):
+        lag = self.lag
+        return {
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'ticks': lag.total,
+            'stalls': self.numStalls,
+            'p50': round(lag.percentile(50), 3),
+            'p95': round(lag.percentile(95), 3),
+            'p99': round(lag.percentile(99), 3),
+            'max': round(lag.max, 3),
+            # (bucket upper bound, count), non-empty buckets only
+            'histogram': [
+                (round(bound, 3), count) for bound, count in
+                zip(BUCKETS + [lag.max], lag.counts) if count],
+        }
+
+
+def start(interval=None, threshold=None, maxStalls=None):
+    """
+    Start watching the reactor (once it runs)
+    """
+    global _watchdog
+    if _watchdog is not None:
+        return _watchdog
+    _watchdog = Watchdog(interval, threshold, maxStalls)
+    reactor.callWhenRunning(_watchdog.start)
+    log.msg('SYSTEM: Reactor stall detector is ON '
+            '(stalls over %0.3f seconds)' % _watchdog.threshold)
+    return _watchdog
+
+
+def getWatchdog():
+    return _watchdog
+
+
+def getStats():
+    """
+    Loop lag numbers (milliseconds), or None if not started
+    """
+    if _watchdog is None:
+        return None
+    return _watchdog.getStats()
+
+
+def getStalls():
+    """
+    Recorded stalls, most recent last
+    """
+    if _watchdog is None:
+        return []
+    return list(_watchdog.stalls)
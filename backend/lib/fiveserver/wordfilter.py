@@ -0,0 +1,75 @@
+"""
+Banned-word filter for chat. The word list is compiled once into
+a single regular expression, with the words merged into a prefix
+tree: (?:ab(?:c|d)|x) rather than (?:abc|abd|x). A message is then
+checked in one pass of the regex engine, with cost that grows with
+the message length and the longest word, not with the number of
+words. Messages are matched as text (not UTF-8 bytes), so that case
+folding and word boundaries work for accented letters too.
+"""
+
+import re
+
+from fiveserver.model import util
+
+
+_END = ''
+
+
+def _treePattern(node):
+    alternatives = [
+        re.escape(ch) + _treePattern(node[ch])
+        for ch in sorted(node) if ch != _END]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and _END not in node:
+        return alternatives[0]
+    pattern = '(?:%s)' % '|'.join(alternatives)
+    if _END in node:
+        pattern += '?'
+    return pattern
+
+
+class WordFilter:
+    """
+    Compiled list of banned words. With wholeWords, a word only
+    matches between word boundaries (any Unicode letter or digit,
+    and underscore, count as word characters).
+    """
+
+    def __init__(self, words, ignoreCase=False, wholeWords=False):
+        self.ignoreCase = ignoreCase
+        self.wholeWords = wholeWords
+        tree = dict()
+        self.numWords = 0
+        for word in words:
+            if not word:
+                continue
+            if ignoreCase:
+                word = word.lower()
+            node = tree
+            for ch in word:
+                node = node.setdefault(ch, dict())
+            if _END not in node:
+                node[_END] = None
+                self.numWords += 1
+        if not tree:
+            self._search = None
+            return
+        pattern = '(?:%s)' % _treePattern(tree)
+        if wholeWords:
+            pattern = r'\b%s\b' % pattern
+        flags = re.IGNORECASE if ignoreCase else 0
+        self._search = re.compile(pattern, flags).search
+
+    def __len__(self):
+        return self.numWords
+
+    def matches(self, message):
+        """
+        True if the message (text, or UTF-8 bytes)
+        contains a banned word
+        """
+        if self._search is None:
+            return False
+        return self._search(util.toUnicode(message)) is not None
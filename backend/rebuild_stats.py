@@ -0,0 +1,42 @@
+"""
+Backfill/rebuild the profile_stats summary table
+from the full match history.
+
+The table is created and backfilled on existing databases
+by sql/migrate6.sql (run as root: the sixserver DB user can
+not create tables). Run this whenever the totals need repairing:
+
+    ./service.sh rebuild-stats
+"""
+
+import os
+import sys
+
+from twisted.internet import defer, task
+
+from fiveserver.config import YamlConfig, DatabaseConfig
+from fiveserver import storagecontroller, data6
+
+
+@defer.inlineCallbacks
+def rebuild(reactor, configFile):
+    scfg = YamlConfig(configFile)
+    dbConfig = DatabaseConfig(**scfg.DB)
+    storageController = storagecontroller.StorageController(
+        dbConfig.getReadPool(), dbConfig.getWritePool())
+    matchData = data6.MatchData(storageController)
+    print('Rebuilding profile_stats ...')
+    count = yield matchData.rebuildProfileStats()
+    print('Done: %s profiles in profile_stats' % count)
+
+
+def main():
+    fsroot = os.environ.get('FSROOT', '.')
+    configFile = fsroot + '/etc/conf/sixserver.yaml'
+    if len(sys.argv) > 1:
+        configFile = sys.argv[1]
+    task.react(rebuild, [configFile])
+
+
+if __name__ == '__main__':
+    main()
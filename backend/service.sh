@@ -49,8 +49,11 @@ case "$1" in
             echo "$PROG is stopped"
         fi
         ;;
+    rebuild-stats)
+        ${FSENV}/bin/python3 ${fsroot}/rebuild_stats.py
+        ;;
     *)
-        echo "Usage $0 {run|runexec|start|stop|status}"
+        echo "Usage $0 {run|runexec|start|stop|status|rebuild-stats}"
         RETVAL=3
 esac
 
@@ -0,0 +1,59 @@
+-- Brings an existing sixserver database up to date with schema6.sql.
+-- Safe to run any number of times. Needs CREATE/ALTER/INDEX privileges
+-- (run it as root: the sixserver user only has SELECT/INSERT/UPDATE):
+--
+--   mysql -uroot -p sixserver < migrate6.sql
+
+-- profiles.points index, used by the rank computation
+set @has_points_key = (
+    select count(*) from information_schema.statistics
+    where table_schema = database() and table_name = 'profiles'
+    and column_name = 'points' and seq_in_index = 1);
+set @sql = if(@has_points_key = 0,
+    'alter table profiles add key(points)', 'do 0');
+prepare stmt from @sql;
+execute stmt;
+deallocate prepare stmt;
+
+-- per-profile totals, maintained by MatchData._storeTxn
+create table if not exists profile_stats (
+    profile_id int unsigned not null,
+    games int unsigned not null default 0,
+    wins int unsigned not null default 0,
+    draws int unsigned not null default 0,
+    losses int unsigned not null default 0,
+    goals_for int unsigned not null default 0,
+    goals_against int unsigned not null default 0,
+    last_teams varchar(64) not null default '',
+    updated_on timestamp not null default current_timestamp on update current_timestamp,
+    primary key(profile_id),
+    foreign key(profile_id) references profiles (id)
+
+) Engine=InnoDB default charset=utf8;
+
+-- backfill the profiles that have no totals yet
+insert into profile_stats (profile_id, games, wins,
+    draws, losses, goals_for, goals_against, last_teams)
+select * from (
+    select mp.profile_id, count(*) as games,
+        sum(case when (mp.home=1 and m.score_home>m.score_away)
+            or (mp.home=0 and m.score_home<m.score_away)
+            then 1 else 0 end) as wins,
+        sum(case when m.score_home=m.score_away
+            then 1 else 0 end) as draws,
+        sum(case when (mp.home=1 and m.score_home<m.score_away)
+            or (mp.home=0 and m.score_home>m.score_away)
+            then 1 else 0 end) as losses,
+        sum(case when mp.home=1
+            then m.score_home else m.score_away end) as goals_for,
+        sum(case when mp.home=1
+            then m.score_away else m.score_home end) as goals_against,
+        substring_index(group_concat(
+            if(mp.home, m.team_id_home, m.team_id_away)
+            order by mp.match_id desc), ',', 5) as last_teams
+    from matches_played mp
+    join matches m on m.id=mp.match_id
+    where not exists (
+        select 1 from profile_stats ps where ps.profile_id=mp.profile_id)
+    group by mp.profile_id) agg
+on duplicate key update profile_id=agg.profile_id;
@@ -24,6 +24,7 @@ create table if not exists profiles (
     seconds_played bigint unsigned not null default 0,
     comment varchar(256) default null,
     primary key(id),
+    key(points),
     foreign key(user_id) references users (id)
 
 ) Engine=InnoDB default charset=utf8;
@@ -62,6 +63,23 @@ create table if not exists streaks (
 
 ) Engine=InnoDB default charset=utf8;
 
+-- per-profile totals, maintained by MatchData._storeTxn
+-- (existing databases: migrate6.sql; repair: ./service.sh rebuild-stats)
+create table if not exists profile_stats (
+    profile_id int unsigned not null,
+    games int unsigned not null default 0,
+    wins int unsigned not null default 0,
+    draws int unsigned not null default 0,
+    losses int unsigned not null default 0,
+    goals_for int unsigned not null default 0,
+    goals_against int unsigned not null default 0,
+    last_teams varchar(64) not null default '',
+    updated_on timestamp not null default current_timestamp on update current_timestamp,
+    primary key(profile_id),
+    foreign key(profile_id) references profiles (id)
+
+) Engine=InnoDB default charset=utf8;
+
 create table if not exists friends (
     id bigint unsigned not null auto_increment,
     profile_id int unsigned not null,
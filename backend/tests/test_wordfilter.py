@@ -0,0 +1,66 @@
+"""
+Tests for the chat banned-word filter.
+
+Usage: PYTHONPATH=lib python3 -m unittest discover tests
+"""
+
+import unittest
+
+from fiveserver.wordfilter import WordFilter
+
+
+def utf8(text):
+    return text.encode('utf-8')
+
+
+class WordFilterTest(unittest.TestCase):
+
+    def testSubstring(self):
+        wordFilter = WordFilter(['foo', 'foobar', 'bar'])
+        self.assertTrue(wordFilter.matches(b'xfoobx'))
+        self.assertFalse(wordFilter.matches(b'fo ba'))
+
+    def testCaseSensitiveByDefault(self):
+        self.assertFalse(WordFilter(['Ball']).matches(b'BALLS'))
+        self.assertFalse(WordFilter(['über']).matches(utf8('ÜBER')))
+
+    def testIgnoreCase(self):
+        self.assertTrue(
+            WordFilter(['Ball'], ignoreCase=True).matches(b'BALLS'))
+        self.assertTrue(
+            WordFilter(['über'], ignoreCase=True).matches(utf8('x ÜBER')))
+        self.assertTrue(
+            WordFilter(['NIÑO'], ignoreCase=True).matches(utf8('el niño')))
+
+    def testWholeWords(self):
+        wordFilter = WordFilter(['ball', 'balls'], wholeWords=True)
+        self.assertTrue(wordFilter.matches(b'balls!'))
+        self.assertFalse(WordFilter(['ball'], wholeWords=True).matches(
+            b'football'))
+
+    def testWholeWordsAccented(self):
+        wordFilter = WordFilter(['ni', 'cana'], wholeWords=True)
+        self.assertFalse(wordFilter.matches(utf8('el niño')))
+        self.assertFalse(wordFilter.matches(utf8('mañana')))
+        self.assertFalse(wordFilter.matches(utf8('canción')))
+        self.assertFalse(wordFilter.matches(utf8('ácana')))
+        self.assertTrue(wordFilter.matches(utf8('ni él, ni ella')))
+        self.assertTrue(
+            WordFilter(['niño'], wholeWords=True).matches(utf8('¡niño!')))
+        self.assertTrue(
+            WordFilter(['jamón'], wholeWords=True).matches(utf8('el jamón')))
+
+    def testSpecialCharacters(self):
+        self.assertTrue(WordFilter(['a.b']).matches(b'xa.b'))
+        self.assertFalse(WordFilter(['a.b']).matches(b'axb'))
+
+    def testEmpty(self):
+        self.assertFalse(WordFilter([]).matches(b'anything'))
+        self.assertFalse(WordFilter(['']).matches(b'anything'))
+
+    def testInvalidUtf8(self):
+        self.assertTrue(WordFilter(['bad']).matches(b'\xff bad \xfe'))
+
+
+if __name__ == '__main__':
+    unittest.main()